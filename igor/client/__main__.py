@@ -83,7 +83,6 @@ class Context(object):
     def __init__(self):
         self.remote = "127.0.0.1"
         self.port = "8080"
-        self.event_port = "6379"
         self.session = ""
         self.notify = False
 
@@ -246,7 +245,7 @@ class IgorClient(cmd.Cmd):
         profile.new_from_livecd(_args.isoname, _args.additional_kargs)
         testplan = igor.testplan(_args.testplanname)
         testplan.start(substitutions=substitutions)
-        is_passed = self.do_watch_testplan(_args.testplanname)
+        is_passed = self.watch_testplan(testplan)
         profile.delete()
 
         if self.ctx.notify:
@@ -283,7 +282,9 @@ class IgorClient(cmd.Cmd):
         _args = self._parse_do_args("watch_testplan", line, pargs)
 
         testplan = self.__igorapi().testplan(_args.testplanname)
+        return self.watch_testplan(testplan)
 
+    def watch_testplan(self, testplan):
         def job_reportxml_cb(updated_sessiondid):
             return testplan.report_junit()
 
@@ -293,7 +294,7 @@ class IgorClient(cmd.Cmd):
         is_passed = False
 
         remote = self.ctx.remote
-        event_port = self.ctx.event_port
+        port = self.ctx.port
 
         builder = junitless.LogBuilder()
 
@@ -310,8 +311,8 @@ class IgorClient(cmd.Cmd):
             builder.from_xml(reportxml)
 
             builder.log.writeln("Waiting for event ...")
-            for ev in event.follow_events(remote, event_port):
-                reportxml = reportxml_cb(ev["session"])
+            for ev in event.follow_events(remote, port):
+                reportxml = reportxml_cb(ev.get("session"))
 
                 if reportxml is not None:
                     states, is_endstate = parse_state(reportxml)
@@ -338,7 +339,7 @@ class IgorClient(cmd.Cmd):
         """firewall_check
         Check that all relevant ports are open
         """
-        for port in [self.ctx.port, self.ctx.event_port]:
+        for port in [self.ctx.port]:
             if not Firewall().is_port_open(port):
                 msg = ("Please open port %s or jobs can fail, because " +
                        "the testrunner might not be able to reach the " +
@@ -351,7 +352,7 @@ class IgorClient(cmd.Cmd):
         """firewall_open
         Open relevant ports
         """
-        ports = [self.ctx.port, self.ctx.event_port]
+        ports = [self.ctx.port]
         self.logger.debug("About to open the relevant TCP ports: %s" % ports)
         firewall = Firewall()
         for port in ports:
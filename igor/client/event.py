@@ -19,36 +19,71 @@
 #
 
 #
-# DESCRTIPTION
+# Follows the events of igord, which are streamed as Server-Sent Events
 #
 
-from igor import reports, common
+from igor import reports
+from igor.common import routes
 from lxml import etree
+import json
 import logging
 import sys
-import redis
+import time
+import urllib
+import urllib2
 
+EVENTSBASE = "http://{host}:{port}" + routes.events
 REPORTBASE = "http://{host}:{port}/jobs/{sessionid}/status?format=xml"
 
+RECONNECT_DELAY = 2
 
-def follow_events(server, port):
-    r = redis.Redis(host=server, port=int(port))
-    p = r.pubsub()
-    p.subscribe(common.REDIS_EVENTS_PUBSUB_CHANNEL_NAME)
-    for obj in p.listen():
-        event = None
-        xmlstr = str(obj["data"]).strip()
-        if not xmlstr.startswith("<"):
-            # Sometimes just an int is sent ...
-            continue
+
+def parse_sse(lines):
+    """Yields the events of a text/event-stream as dicts
+
+    >>> lines = ["retry: 1000", "", ": keepalive", "", "id: e-2",
+    ...          "event: lost", 'data: {"id": "e-2"}', "", "id: e-3",
+    ...          "event: post-end", 'data: {"id": "e-3", "session": "s"}', ""]
+    >>> [(e["type"], e["id"], e.get("session")) for e in parse_sse(lines)]
+    [('lost', 'e-2', None), ('post-end', 'e-3', u's')]
+    """
+    fields = {}
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            if "data" in fields:
+                event = json.loads(fields["data"] or "{}")
+                event["type"] = fields.get("event", "message")
+                if "id" in fields:
+                    event["id"] = fields["id"]
+                yield event
+            fields = {}
+        elif not line.startswith(":"):
+            k, _, v = line.partition(":")
+            fields[k] = v[1:] if v.startswith(" ") else v
+
+
+def follow_events(server, port, session=None, last_id=None):
+    """Yields the events of igord (type, session, id), the stream is
+    reconnected and the events missed in between are delivered first.
+    An event of type lost tells that some events could not be delivered.
+    """
+    url = EVENTSBASE.format(host=server, port=port)
+    if session:
+        url += "?" + urllib.urlencode({"session": session})
+    while True:
+        headers = {}
+        if last_id is not None:
+            headers["Last-Event-ID"] = last_id
         try:
-            event = etree.XML(xmlstr)
-        except:
-            logging.exception("Failed to parse: %s -> %s" % (obj, xmlstr))
-        if event is not None and event.attrib:
-            yield event.attrib
-    p.unsubscribe(common.REDIS_EVENTS_PUBSUB_CHANNEL_NAME)
-    p.close()
+            stream = urllib2.urlopen(urllib2.Request(url, headers=headers))
+            for event in parse_sse(iter(stream.readline, "")):
+                if "id" in event:
+                    last_id = event["id"]
+                yield event
+        except (urllib2.URLError, IOError) as e:
+            logging.debug("Event stream %s broke: %s" % (url, e))
+        time.sleep(RECONNECT_DELAY)
 
 
 def __FIXME_retrieve_report(remote, port, sessionid):
@@ -69,6 +104,7 @@ def __FIXME_retrieve_report(remote, port, sessionid):
 
 if __name__ == "__main__":
     remote = sys.argv[1]
-    port = 8090
+    port = 8080
     for evnt in follow_events(remote, port):
-        __FIXME_retrieve_report(remote, port, evnt["session"])
+        if "session" in evnt:
+            __FIXME_retrieve_report(remote, port, evnt["session"])
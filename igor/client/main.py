@@ -20,6 +20,7 @@
 from igor.common import routes
 from lxml import etree
 import io
+import json
 import logging
 import os
 import re
@@ -36,6 +37,12 @@ def check_isfile(filename):
         raise RuntimeError("File '%s' does not exist." % filename)
 
 
+def _wait_query(wait_since, timeout):
+    if wait_since is None:
+        return {}
+    return {"wait_since": wait_since, "timeout": timeout}
+
+
 class HTTPHelper(object):
     logger = None
 
@@ -111,10 +118,11 @@ class IgordAPI(object):
                                                            route=_route,
                                                            query=_query)
 
-    def route_request(self, route, **route_args):
+    def route_request(self, route, query={}, **route_args):
         """Request a route and return an XML tree
         """
-        url = self.url(route, {"format": "xml"}, **route_args)
+        query = dict(query, format="xml")
+        url = self.url(route, query, **route_args)
         pagedata = self._http.request(url)
         tree = etree.XML(pagedata) if pagedata else None
         return tree
@@ -183,8 +191,13 @@ class JobAPI(IgordAPI):
     def abort(self):
         return self.route_request(routes.job_abort, cookie=self.sessionid)
 
-    def status(self):
-        return self.route_request(routes.job_status, cookie=self.sessionid)
+    def status(self, wait_since=None, timeout=30):
+        """The status, if wait_since is given the daemon answers when the
+        version of the job is higher or after timeout seconds
+        """
+        return self.route_request(routes.job_status,
+                                  _wait_query(wait_since, timeout),
+                                  cookie=self.sessionid)
 
     def report(self):
         url = self.url(routes.job_report, cookie=self.sessionid)
@@ -300,23 +313,38 @@ class ProfileAPI(IgordAPI):
 class TestplanAPI(IgordAPI):
     """An interface to the testplan related REST-API
     """
-    def __init__(self, host, port, name):
+    def __init__(self, host, port, name, run_id=None):
         super(TestplanAPI, self).__init__(host, port)
         self.name = name
+        self.run_id = run_id
 
     def start(self, substitutions={}):
+        """Start a new run of the plan, the following calls refer to it
+        """
         url = self.url(routes.testplan_start, query=substitutions,
                        name=self.name)
-        return self.request(url)
+        reply = self.request(url)
+        self.run_id = json.loads(reply)["run_id"]
+        return reply
+
+    def _run_query(self):
+        return {"run": self.run_id} if self.run_id else {}
 
     def abort(self):
-        return self.route_request(routes.testplan_abort, name=self.name)
+        return self.route_request(routes.testplan_abort, self._run_query(),
+                                  name=self.name)
 
-    def status(self):
-        return self.route_request(routes.testplan_status, name=self.name)
+    def status(self, wait_since=None, timeout=30):
+        """See JobAPI.status
+        """
+        query = dict(self._run_query(), **_wait_query(wait_since, timeout))
+        return self.route_request(routes.testplan_status, query,
+                                  name=self.name)
 
     def report(self):
-        return self.route_request(routes.testplan_report, name=self.name)
+        return self.route_request(routes.testplan_report, self._run_query(),
+                                  name=self.name)
 
     def report_junit(self):
-        return self.route_request(routes.testplan_report_junit, name=self.name)
+        return self.route_request(routes.testplan_report_junit,
+                                  self._run_query(), name=self.name)
@@ -30,6 +30,7 @@ class routes(object):
     testsuite_submit = '/jobs/submit/<tname>/with/<pname>/on/<hname>'
 
     jobs = '/jobs'
+    jobs_queue = '/jobs/queue'
     job = '/jobs/<cookie>'
     job_start = '/jobs/<cookie>/start'
     job_abort = '/jobs/<cookie>/abort'
@@ -37,6 +38,9 @@ class routes(object):
     job_report = '/jobs/<cookie>/report'
     job_report_junit = '/jobs/<cookie>/report/junit'
     job_testsuite = '/jobs/<cookie>/testsuite'
+    job_testsuite_manifest = '/jobs/<cookie>/testsuite/manifest'
+    job_testsuite_bundle = '/jobs/<cookie>/testsuite/bundle'
+    job_testsuite_file = '/jobs/<cookie>/testsuite/files/<name:path>'
     job_artifacts = '/jobs/<cookie>/artifacts'
     job_artifacts_archive = '/jobs/<cookie>/archive'  # FIXME
     job_artifact = '/jobs/<cookie>/artifacts/<name>'
@@ -65,16 +69,23 @@ class routes(object):
     testplan_report_junit = '/testplans/<name>/report/junit'
     testplan_summary = ''
 
+    draft = '/drafts/<dname>'
+
     profiles = '/profiles'
     profile = '/profiles/<pname>'
     profile_delete = '/profiles/<pname>/remove'
     profile_set_kernelargs = '/profiles/<pname>/kargs'
 
     hosts = '/hosts'
+    host_pools = '/hosts/pools'
 
     testcase_source = '/testcases/<suitename>/<setname>/<casename>/source'
 
+    events = '/events'
+
     server_log = '/server/log'
+    server_inventory_refresh = '/server/inventory/refresh'
+    server_inventory_health = '/server/inventory/health'
 
     datastore = '/store'
     datastore_file = '/store/<filename>'
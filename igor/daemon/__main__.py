@@ -2,18 +2,20 @@
 # -*- coding: utf-8 -*-
 
 from igor import common, log, reports, utils
-from igor.daemon import config, job, main
-from igor.daemon.hacks import IgordJSONEncoder
+from igor.daemon import compression, config, events, history, job, main, \
+    render, server
 from string import Template
 import StringIO
 import argparse
 import bottle
+import hashlib
 import importlib
-import json
 import os
 import subprocess
+import sys
 import tarfile
-import yaml
+import threading
+import time
 
 log.configure("/tmp/igord.log")
 
@@ -31,10 +33,18 @@ parser.add_argument("-s", "--set", help="Override a config entry e.g. " +
                     "/path/to/custom/testcases",
                     action="append", nargs=2, metavar=("PATH", "VALUE"),
                     dest="updates")
+parser.add_argument("--compile-index", help="Parse all testsuites, " +
+                    "testplans and hosts into the index file of the " +
+                    "backends (e.g. igor.daemon.backends.files/index) " +
+                    "and exit", action="store_true")
 ctx = parser.parse_args()
 
 CONFIG = config.parse_config(updates=ctx.updates)
 
+# The compression processes are forked before any thread is started
+compression.start_pool(CONFIG["daemon"].get("archives", {}).get(
+    "compression_workers", 1))
+
 plan_backends = []
 profile_backends = []
 testsuite_backends = []
@@ -68,6 +78,10 @@ def load_backends(hosts, profiles, testsuites, testplans):
             m = importlib.import_module(modulename)
             reload(m)
             module_origins = m.initialize_origins(category, CONFIG[modulename])
+            cache_ttls = CONFIG[modulename].get("cache_ttl", {})
+            if category in cache_ttls:
+                for oname, o in module_origins:
+                    o.cache_ttl = cache_ttls[category]
             origin_priority[category].extend(x[0] for x in module_origins)
             origin.update(dict(module_origins))
             dst.append(m)
@@ -79,48 +93,165 @@ load_backends(CONFIG["daemon"]["enable-backends"]["hosts"],
               CONFIG["daemon"]["enable-backends"]["testsuites"],
               CONFIG["daemon"]["enable-backends"]["testplans"])
 
+# Backends can keep an index of their parsed items
+indexed_backends = []
+for m in host_backends + profile_backends + testsuite_backends + \
+        plan_backends:
+    if hasattr(m, "load_index") and m not in indexed_backends:
+        indexed_backends.append(m)
+
+if ctx.compile_index:
+    for m in indexed_backends:
+        m.compile_index(CONFIG[m.__name__])
+    sys.exit(0)
+
+for m in indexed_backends:
+    m.load_index(CONFIG[m.__name__])
+
 
 #
 # Now prepare the essential objects
 #
+runtime_history = None
+if CONFIG["daemon"].get("history", {}).get("path"):
+    history_config = CONFIG["daemon"]["history"]
+    runtime_history = history.RuntimeHistory(
+        history_config["path"],
+        max_samples=history_config.get("max_samples", 100),
+        min_samples=history_config.get("min_samples", 5),
+        percentile_for_timeout=history_config.get("percentile", 99),
+        margin=history_config.get("margin", 1.5),
+        min_timeout=history_config.get("min_timeout", 10))
+
+# Event streams and long polls hold a worker of the server each, both
+# leave most of the workers to the other requests (e.g. step callbacks)
+server_config = CONFIG["daemon"].get("server")
+
+event_config = CONFIG["daemon"].get("events", {})
+event_bus = events.EventBus(
+    max_events=event_config.get("history", 1000),
+    max_pending=event_config.get("max_pending", 100))
+max_event_streams = server.held_requests_limit(
+    "events.max_streams", event_config.get("max_streams"), server_config)
+event_streams = threading.Semaphore(max_event_streams)
+
 jc = job.JobCenter(session_path=CONFIG["daemon"]["session"]["path"],
-                   hooks_path=CONFIG["daemon"]["hooks"]["path"])
+                   hooks_path=CONFIG["daemon"]["hooks"]["path"],
+                   max_workers=CONFIG["daemon"].get("jobs", {}).get(
+                       "provisioning_workers", 4),
+                   aging_interval=CONFIG["daemon"].get("jobs", {}).get(
+                       "aging_interval", 30 * 60),
+                   plan_history=CONFIG["daemon"].get("jobs", {}).get(
+                       "plan_history", 10),
+                   history=runtime_history,
+                   events=event_bus)
+
+main.archive_cache = main.ArchiveCache(
+    CONFIG["daemon"].get("archives", {}).get("path"),
+    max_archives=CONFIG["daemon"].get("archives", {}).get("max_archives",
+                                                          100),
+    min_age=CONFIG["daemon"].get("archives", {}).get("min_age", 60))
+
+validator = main.TestsuiteValidator(
+    workers=CONFIG["daemon"].get("archives", {}).get("validation_workers",
+                                                     4))
+
+# Beyond max_waiting long polls requests are answered at once
+long_poll_config = CONFIG["daemon"].get("long_poll", {})
+long_polls = threading.Semaphore(server.held_requests_limit(
+    "long_poll.max_waiting", long_poll_config.get("max_waiting"),
+    server_config))
+long_poll_max_timeout = long_poll_config.get("max_timeout", 60)
 
 inventory = main.Inventory(
     plans=plan_origins,
     testsuites=testsuite_origins,
     profiles=profile_origins,
     hosts=host_origins)
+inventory.negative_ttl = CONFIG["daemon"].get("inventory", {}).get(
+    "negative_ttl", inventory.negative_ttl)
+inventory.origin_timeout = CONFIG["daemon"].get("inventory", {}).get(
+    "origin_timeout", inventory.origin_timeout)
 inventory.check()
 
 
-def to_json(obj):
-    typ = "json"
-    root_tag = "result"
-
-    r = json.dumps(obj, cls=IgordJSONEncoder, sort_keys=True, indent=2)
-
-    if "format" in bottle.request.query:
-        typ = bottle.request.query["format"]
-    if "root" in bottle.request.query:
-        root_tag = bottle.request.query["root"]
+def response_format():
+    """The format of the response, json or as set by ?format=json|xml|yaml
+    or the x-igor-format-xml header
+    """
+    typ = bottle.request.query.get("format") or "json"
 
     if "x-igor-format-xml" in bottle.request.headers:
         typ = "xml"
 
-    if typ == "xml":
-        j = json.loads(r)
-        r = "<?xml-stylesheet type='text/xsl' href='/ui/index.xsl' ?>\n"
-        r += utils.obj2xml(root_tag, j, as_string=True)
+    if typ not in render.FORMATS:
+        bottle.abort(412, "Unknown format '%s', expected one of: %s" %
+                     (typ, ", ".join(sorted(render.FORMATS))))
+    return typ
 
-    if typ == "yaml":
-        j = json.loads(r)
-        r = yaml.dump_all(j)
 
-    bottle.response.content_type = "application/%s" % typ
+def to_json(obj):
+    """Renders obj in the response_format, ?root sets the xml root tag and
+    ?compact renders json without indentation
+    """
+    typ = response_format()
+    root_tag = bottle.request.query.get("root") or "result"
+
+    r = render.render(obj, typ, root_tag=root_tag,
+                      compact="compact" in bottle.request.query)
+
+    bottle.response.content_type = render.content_type(typ)
     return r
 
 
+def check_etag(tag):
+    """Sets the ETag of the response to the version tag of the resource,
+    the format and the query, answers 304 if the client has it
+    """
+    etag = '"%s-%s"' % (tag, hashlib.sha1("%s\0%s" % (
+        response_format(), bottle.request.query_string)).hexdigest()[:8])
+    headers = {"ETag": etag, "Cache-Control": "no-cache",
+               "Vary": "x-igor-format-xml"}
+    for k, v in headers.items():
+        bottle.response.set_header(k, v)
+    if etag in [t.strip() for t in
+                bottle.request.headers.get("If-None-Match", "").split(",")]:
+        raise bottle.HTTPResponse(status=304, headers=headers)
+
+
+def wait_for_change(version_of):
+    """With ?wait_since=<version> the request waits until version_of()
+    is higher than version, for ?timeout seconds (30 by default)
+    """
+    if not bottle.request.query.wait_since:
+        return
+    try:
+        since = int(bottle.request.query.wait_since)
+        timeout = float(bottle.request.query.timeout or 30)
+    except ValueError:
+        bottle.abort(412, "wait_since and timeout must be numbers")
+    if not long_polls.acquire(False):
+        logger.debug("Too many waiting requests, answering at once")
+        return
+    try:
+        jc.wait_for_change(version_of, since,
+                           min(timeout, long_poll_max_timeout))
+    finally:
+        long_polls.release()
+
+
+def queue_args():
+    """The priority and submitter of a submission
+    The submitter defaults to the address of the client.
+    """
+    priority = bottle.request.query.priority or None
+    if priority and priority not in job.PendingJobQueue.priorities:
+        bottle.abort(412, "Unknown priority '%s', expected one of: %s" %
+                     (priority, ", ".join(job.PendingJobQueue.priorities)))
+    submitter = bottle.request.query.submitter or bottle.request.remote_addr
+    return {"priority": priority, "submitter": submitter}
+
+
 def check_authentication(user, password):
     return user == password
 
@@ -199,31 +330,52 @@ def dav_file_trigger(filename):
 @app.route('/jobs/submit/<tname>/with/<pname>/on/<hname>')
 @app.route('/jobs/submit/<tname>/with/<pname>/on/<hname>/<cookiereq>')  # FIXME
 def submit_testsuite(tname, pname, hname, cookiereq=None):
+    """Submit a job, hname can also be the name of a host pool
+    With ?shards=<n> the testsuite is split into n shards, which run in
+    parallel on the hosts of the pool.
+    """
+    items = {}
     for key, name in [("testsuites", tname),
-                      ("profiles", pname),
-                      ("hosts", hname)]:
-        item = inventory._lookup(key, name)
-        if item is None:
+                      ("profiles", pname)]:
+        items[key] = inventory._lookup(key, name)
+        if items[key] is None:
             bottle.abort(412, "Unknown %s '%s'" % (key, name))
+    host = inventory.host_or_pool(hname)
+    if host is None:
+        bottle.abort(412, "Unknown host or host pool '%s'" % hname)
     xkargs = bottle.request.query.additional_kargs
-    spec = main.JobSpec(testsuite=inventory.testsuites()[tname],
-                        profile=inventory.profiles()[pname],
-                        host=inventory.hosts()[hname],
+    spec = main.JobSpec(testsuite=items["testsuites"],
+                        profile=items["profiles"],
+                        host=host,
                         additional_kargs=xkargs or "")
+    shards = bottle.request.query.shards
+    if shards and not shards.isdigit():
+        bottle.abort(412, "Invalid number of shards: %s" % shards)
     logger.debug("Submitting with args: %s" % str(spec))
-    resp = jc.submit(spec, cookiereq)
+    if shards and int(shards) > 1:
+        resp = jc.submit_sharded(spec, int(shards), **queue_args())
+    else:
+        resp = jc.submit(spec, cookiereq, **queue_args())
 
     return to_json(resp)
 
 
 @app.route(common.routes.jobs)
 def get_jobs():
+    wait_for_change(lambda: jc.version)
+    check_etag("jobs-%s-%s" % (jc.version, "-".join(
+        str(v) for _, v in sorted(jc.queue_status().items()))))
     return to_json(jc.get_jobs())
 
 
+@app.route(common.routes.jobs_queue)
+def get_jobs_queue():
+    return to_json(jc.queue_status())
+
+
 @app.route(common.routes.job_start)
 def start_job(cookie):
-    if cookie not in jc.jobs:
+    if jc.lookup(cookie) is None:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     m = jc.start_job(cookie)
     return to_json(m)
@@ -231,26 +383,28 @@ def start_job(cookie):
 
 @app.route(common.routes.job_status)
 def job_status(cookie):
-    if cookie not in jc.jobs:
+    m = jc.lookup(cookie)
+    if m is None:
         bottle.abort(404, "Unknown job '%s'" % cookie)
-    m = jc.jobs[cookie]
+    wait_for_change(lambda: m.version)
+    check_etag("%s-%s-%s" % (cookie, m.version, jc.queue_position(cookie)))
     return to_json(m)
 
 
 @app.route(common.routes.job_report)
 def job_report(cookie):
-    if cookie not in jc.jobs:
+    j = jc.lookup(cookie)
+    if j is None:
         bottle.abort(404, "Unknown job '%s'" % cookie)
-    j = jc.jobs[cookie]
     bottle.response.content_type = "text/plain; charset=utf8"
     return str(reports.job_status_to_report(j.__to_dict__()))
 
 
 @app.route(common.routes.job_report_junit)
 def job_report_junit(cookie):
-    if cookie not in jc.jobs:
+    j = jc.lookup(cookie)
+    if j is None:
         bottle.abort(404, "Unknown job '%s'" % cookie)
-    j = jc.jobs[cookie]
     bottle.response.content_type = "application/xml; charset=utf8"
     return str(reports.job_status_to_junit(j.__to_dict__()))
 
@@ -291,7 +445,7 @@ def annotate_step(cookie):
 @app.route(common.routes.job, method='DELETE')
 @app.route(common.routes.job_abort)
 def abort_job(cookie):
-    if cookie not in jc.jobs:
+    if jc.lookup(cookie) is None:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     try:
         m = jc.abort_job(cookie)
@@ -300,18 +454,89 @@ def abort_job(cookie):
     return to_json(m)
 
 
+def requested_compression():
+    """The compression of an archive, requested with
+    ?compression=<tar|gz|bz2|xz>&level=<n> or by the Accept header
+    """
+    try:
+        fmt = compression.negotiate(bottle.request.query.compression,
+                                    bottle.request.headers.get("Accept"))
+    except RuntimeError as e:
+        bottle.abort(406, str(e))
+    level = bottle.request.query.level
+    try:
+        level = compression.check_level(fmt, int(level) if level else None)
+    except ValueError:
+        bottle.abort(412, "Invalid compression level: %s" % level)
+    except RuntimeError as e:
+        bottle.abort(412, str(e))
+    return fmt, level
+
+
+def send_testsuite_archive(testsuite):
+    """Sends the archive of a testsuite from the archive cache
+    """
+    fmt, level = requested_compression()
+    filename = main.archive_cache.archive_file(testsuite,
+                                               compression_format=fmt,
+                                               level=level)
+    return bottle.static_file(os.path.basename(filename),
+                              root=os.path.dirname(filename),
+                              mimetype=compression.mimetype(fmt))
+
+
 @app.route(common.routes.job_testsuite)
 def get_job_testsuite_archive(cookie):
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     t = jc.jobs[cookie].testsuite
-    r = t.get_archive()
-    if not r:
-        bottle.abort(404, 'No testsuite for %s' % (cookie))
+    return send_testsuite_archive(t)
 
+
+@app.route(common.routes.job_testsuite_manifest)
+def get_job_testsuite_manifest(cookie):
+    """The files of the testsuite archive and their hashes
+    With ?format=plain each file is a line: <sha1> <type> <mode> <name>
+    """
+    if cookie not in jc.jobs:
+        bottle.abort(404, "Unknown job '%s'" % cookie)
+    manifest = jc.jobs[cookie].testsuite.manifest()
+    if bottle.request.query.format == "plain":
+        bottle.response.content_type = "text/plain; charset=utf8"
+        fields = [(e["sha1"] or "-", e["type"], e["mode"], e["name"])
+                  for e in manifest]
+        return "".join("%s %s %s %s\n" % f for f in fields)
+    return to_json(manifest)
+
+
+@app.route(common.routes.job_testsuite_bundle, method='POST')
+def get_job_testsuite_bundle(cookie):
+    """An archive of just the files posted, one name per line
+    """
+    if cookie not in jc.jobs:
+        bottle.abort(404, "Unknown job '%s'" % cookie)
+    names = set(n.strip() for n in
+                bottle.request.body.read(BOTTLE_MAX_READ_SIZE).splitlines())
+    fmt, level = requested_compression()
+    r = StringIO.StringIO()
+    jc.jobs[cookie].testsuite.write_archive(r, compression_format=fmt,
+                                            level=level,
+                                            selection=names - set([""]))
+    bottle.response.content_type = compression.mimetype(fmt)
     return r.getvalue()
 
 
+@app.route(common.routes.job_testsuite_file)
+def get_job_testsuite_file(cookie, name):
+    if cookie not in jc.jobs:
+        bottle.abort(404, "Unknown job '%s'" % cookie)
+    data = jc.jobs[cookie].testsuite.archive_member(name)
+    if data is None:
+        bottle.abort(404, "Unknown file '%s'" % name)
+    bottle.response.content_type = "application/octet-stream"
+    return data
+
+
 @app.route(common.routes.job_artifacts)
 def list_artifact(cookie):
     if cookie not in jc.jobs:
@@ -326,8 +551,9 @@ def get_artifacts_archive(cookie):
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     j = jc.jobs[cookie]
-    bottle.response.content_type = "application/x-bzip2"
-    return j.get_artifacts_archive().getvalue()
+    fmt, level = requested_compression()
+    bottle.response.content_type = compression.mimetype(fmt)
+    return j.get_artifacts_archive(fmt, level).getvalue()
 
 
 @app.route(common.routes.job_artifact, method='PUT')
@@ -395,97 +621,116 @@ def get_bootstrap_script(cookie):
     return r
 
 
+def flag_unhealthy_origins(k):
+    """Partial listings name the origins which did not answer in a header
+    """
+    health = inventory.health(k)
+    unhealthy = sorted(o for o in health if not health[o]["healthy"])
+    if unhealthy:
+        bottle.response.headers["X-Igor-Unhealthy-Origins"] = \
+            ", ".join(unhealthy)
+
+
 @app.route(common.routes.testsuites)
 def list_testsuites():
     testsuites = inventory.testsuites()
+    flag_unhealthy_origins("testsuites")
     return to_json(testsuites)
 
 
 @app.route(common.routes.testsuites_validate)
 def validate_testsuites():
-    testsuites = inventory.testsuites().items()
-    r = {}
-    for n, suite in testsuites:
-        r[n] = suite.validate()
-    return r
+    """The result of each testsuite: {"valid": <bool>, "errors": [...]}
+    """
+    return to_json(validator.validate(inventory.testsuites()))
 
 
 @app.route(common.routes.testsuite_summary)
 def get_testsuite_summary(name):
-    testsuites = inventory.testsuites()
-    if name not in testsuites:
+    testsuite = inventory.testsuites(name)
+    if testsuite is None:
         bottle.abort(404, "Unknown testsuite '%s'" % name)
-    return to_json(testsuites[name])
+    return to_json(testsuite)
 
 
 @app.route(common.routes.testsuite_archive)
 @app.route(common.routes.testsuite_archive + '/<tarball>')
 def get_testsuite_archive(name, tarball="testsuite.tar"):
-    testsuites = inventory.testsuites()
-    if name not in testsuites:
+    t = inventory.testsuites(name)
+    if t is None:
         bottle.abort(404, "Unknown testsuite '%s'" % name)
-    t = testsuites[name]
-    r = t.get_archive()
-    if not r:
-        bottle.abort(404, 'No testsuite for %s' % (name))
-    bottle.response.content_type = "application/x-tar; charset=binary"
-    return r.getvalue()
+    return send_testsuite_archive(t)
 
 
 @app.route(common.routes.testplans)
 def list_plans():
-    return to_json(inventory.plans())
+    plans = inventory.plans()
+    flag_unhealthy_origins("plans")
+    return to_json(plans)
 
 
 @app.route(common.routes.testplan)
 def plan_info(name):
-    if name not in inventory.plans():
+    plan = inventory.plans(name)
+    if plan is None:
         bottle.abort(404, "Unknown plan: %s" % name)
-    plan = inventory.plans()[name]
     return to_json(plan)
 
 
 @app.route(common.routes.testplan_start)
 def run_plans(name):
-    if name not in inventory.plans():
+    plan = inventory.plans(name)
+    if plan is None:
         bottle.abort(404, "Unknown plan: %s" % name)
-    plan = inventory.plans()[name]
-    plan.inventory = inventory      # FIXME not very nice
-    plan.variables.update({k: bottle.request.query[k]
-                           for k in bottle.request.query.keys()})
-    worker = jc.submit_plan(plan)
+    variables = {k: bottle.request.query[k]
+                 for k in bottle.request.query.keys()
+                 if k not in ["priority", "submitter"]}
+    worker = jc.submit_plan(plan, variables=variables, inventory=inventory,
+                            **queue_args())
     return to_json(worker.__to_dict__())
 
 
+def plan_run():
+    """The run of a plan requested with ?run=<run_id>, defaults to latest
+    """
+    return bottle.request.query.run or "latest"
+
+
 @app.route(common.routes.testplan)
 def testplan_summary(name):
-    if name not in inventory.plans():
+    plan = inventory.plans(name)
+    if plan is None:
         bottle.abort(404, "Unknown plan: %s" % name)
-    return to_json(inventory.plans()[name])
+    return to_json(plan)
 
 
 @app.route(common.routes.testplan_status)
 def status_plans(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
-    r = jc.status_plan(name)
+    wait_for_change(lambda: (jc.status_plan_version(name, plan_run()) or
+                             (None, 0))[1])
+    version = jc.status_plan_version(name, plan_run())
+    if version is not None:
+        check_etag("%s-%s-%s" % ((name,) + version))
+    r = jc.status_plan(name, plan_run())
     return to_json(r)
 
 
 @app.route(common.routes.testplan_report)
 def testplan_report(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
-    r = jc.status_plan(name)
+    r = jc.status_plan(name, plan_run())
     bottle.response.content_type = "text/plain; charset=utf8"
     return str(reports.testplan_status_to_report(r))
 
 
 @app.route(common.routes.testplan_report_junit)
 def testplan_junit_report(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
-    r = jc.status_plan(name)
+    r = jc.status_plan(name, plan_run())
     bottle.response.content_type = "application/xml; charset=utf8"
     xml = reports.testplan_status_to_junit_report(r)
     return reports.to_xml_str(xml)
@@ -493,28 +738,40 @@ def testplan_junit_report(name):
 
 @app.route(common.routes.testplan_abort)
 def abort_plans(name):
-    if name not in inventory.plans():
+    if inventory.plans(name) is None:
         bottle.abort(404, "Unknown plan: %s" % name)
-    r = jc.abort_plan(name)
+    r = jc.abort_plan(name, plan_run())
+    if r is None:
+        bottle.abort(404, "Plan is not running: %s" % name)
     return to_json(r.__to_dict__())
 
 
 @app.route(common.routes.profiles)
 def list_profiles():
-    return to_json(inventory.profiles())
+    profiles = inventory.profiles()
+    flag_unhealthy_origins("profiles")
+    return to_json(profiles)
 
 
 @app.route(common.routes.hosts)
 def list_hosts():
-    return to_json(inventory.hosts())
+    hosts = inventory.hosts()
+    flag_unhealthy_origins("hosts")
+    return to_json(hosts)
+
+
+@app.route(common.routes.host_pools)
+def list_host_pools():
+    pools = inventory.host_pools()
+    flag_unhealthy_origins("hosts")
+    return to_json(pools)
 
 
 @app.route(common.routes.testcase_source)
 def testcase_source(suitename, setname, casename):
-    testsuites = inventory.testsuites()
-    if suitename not in testsuites:
+    suite = inventory.testsuites(suitename)
+    if suite is None:
         bottle.abort(404, "Unknown testsuite '%s'" % suitename)
-    suite = testsuites[suitename]
     tset = None
     for _tset in suite.testsets:
         if _tset.name == setname:
@@ -567,10 +824,42 @@ def profile_from_vmlinuz_put(pname):
     _tmpdir.clean()
 
 
+def draft_origin():
+    origin = plan_origins.get("draft-files") or \
+        testsuite_origins.get("draft-files")
+    if origin is None:
+        bottle.abort(404, "No backend for drafts enabled")
+    return origin
+
+
+@app.route(common.routes.draft, method='PUT')
+def put_draft(dname):
+    """Upload a tar archive of plans/ and suites/, they are available as
+    <dname>:<name> until the draft expires
+    """
+    if ":" in dname:
+        bottle.abort(412, "No ':' allowed in draft names")
+    try:
+        draft_origin().create_item(dname, bottle.request.body)
+    except (RuntimeError, tarfile.TarError) as e:
+        bottle.abort(412, str(e))
+    return to_json(True)
+
+
+@app.route(common.routes.draft, method='DELETE')
+def delete_draft(dname):
+    try:
+        draft_origin().remove_item(dname)
+    except RuntimeError as e:
+        bottle.abort(404, str(e))
+    return to_json(True)
+
+
 @app.route(common.routes.profile_set_kernelargs, method='GET')
 @app.route(common.routes.profile_set_kernelargs, method='POST')
 def profile_kargs(pname):
-    if pname not in inventory.profiles():
+    profile = inventory.profiles(pname)
+    if profile is None:
         bottle.abort(404, "Unknown profile")
     kargs = bottle.request.forms.kargs
     n_kargs = "NO_KARGS_FOUND"
@@ -579,24 +868,85 @@ def profile_kargs(pname):
             bottle.abort(412, "{igor_cookie} not found in kargs, this is " +
                               "needed to initiate the callback to Igor, " +
                               "e.g. boot_trigger=igor/testjob/{igor_cookie}")
-        n_kargs = inventory.profiles()[pname].kargs(kargs)
+        n_kargs = profile.kargs(kargs)
     else:
 #        bottle.abort(412, "No kargs specified")
-        n_kargs = inventory.profiles()[pname].kargs()
+        n_kargs = profile.kargs()
     return n_kargs
 
 
 @app.route(common.routes.profile, method='DELETE')
 @app.route(common.routes.profile_delete)
 def delete_profile(pname):
-    if pname not in inventory.profiles():
+    profile = inventory.profiles(pname)
+    if profile is None:
         bottle.abort(404, "Unknown profile")
     try:
-        inventory.profiles()[pname].delete()
+        profile.delete()
     except Exception as e:
         # FIXME could be solved in the cobblre backend
         logger.warning("An error occurred while removing a " +
                        "profile: %s (%s)" % (e.message, e))
+    inventory.invalidate("profiles")
+
+
+@app.route(common.routes.events)
+def event_stream():
+    """The hook events (post-testcase, post-end, ...) as Server-Sent Events
+    A client reconnecting with the Last-Event-ID header gets the events it
+    missed first, the event "lost" tells that some of them are gone.
+    ?session=<cookie> limits the stream to the events of one job.
+    The stream ends after max_duration seconds, the client reconnects then.
+    """
+    last_id = bottle.request.headers.get("Last-Event-ID") or \
+        bottle.request.query.last_event_id or None
+    session = bottle.request.query.session or None
+
+    if max_event_streams == 0:
+        bottle.abort(503, "Event streams need the pooled server")
+    if not event_streams.acquire(False):
+        bottle.abort(503, "Too many event streams, try again later")
+    try:
+        subscription = event_bus.subscribe(last_id)
+    except ValueError as e:
+        event_streams.release()
+        bottle.abort(412, str(e))
+
+    def stream():
+        try:
+            yield "retry: 1000\n\n"
+            deadline = time.time() + event_config.get("max_duration", 300)
+            while time.time() < deadline:
+                event = subscription.get(timeout=event_config.get(
+                    "keepalive_interval", 15))
+                if subscription.dropped:
+                    # Too slow, it catches up when it reconnects
+                    break
+                if event is None:
+                    yield ": keepalive\n\n"
+                elif session in [None, event.get("session")] or \
+                        event["type"] == "lost":
+                    yield events.format_sse(event)
+        finally:
+            event_bus.unsubscribe(subscription)
+            event_streams.release()
+
+    bottle.response.content_type = "text/event-stream"
+    bottle.response.set_header("Cache-Control", "no-cache")
+    return stream()
+
+
+@app.route(common.routes.server_inventory_refresh)
+def refresh_inventory():
+    """Forget all cached items, e.g. after files were changed
+    """
+    inventory.invalidate()
+    return to_json(True)
+
+
+@app.route(common.routes.server_inventory_health)
+def inventory_health():
+    return to_json(inventory.health())
 
 
 @app.route(common.routes.server_log)
@@ -607,6 +957,6 @@ def get_log():
 if __name__ == "__main__":
     try:
     #    logger.info("Starting igord")
-        bottle.run(app, host='0.0.0.0', port=8080, reloader=False)
+        server.run(app, server_config)
     except KeyboardInterrupt:
         logger.debug("Ending igor")
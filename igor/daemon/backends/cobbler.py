@@ -51,7 +51,8 @@ def initialize_origins(category, CONFIG):
         # Just systems with igor- prefix
         __cb_kwargs = {"expression":
                        CONFIG["hosts"]["identification_expression"],
-                       "whitelist": CONFIG["hosts"]["whitelist"]}
+                       "whitelist": CONFIG["hosts"]["whitelist"],
+                       "pools": CONFIG["hosts"].get("pools", {})}
         origins += [("cobbler",
                      HostsOrigin(*__cobbler_origin_args, **__cb_kwargs))]
 
@@ -62,6 +63,7 @@ class ProfileOrigin(main.Origin):
     """This is the source where igor retrieves cobbler profiles
     """
     cobbler = None
+    cache_ttl = 60
 
     def __init__(self, server_url, user, pw, ssh_uri,
                  remote_path_prefix):
@@ -80,9 +82,20 @@ class ProfileOrigin(main.Origin):
                 items[c_pname] = i_profile
         return items
 
+    def lookup(self, name):
+        """Looks up one profile, without listing all profiles
+        """
+        with self.cobbler as remote:
+            if remote.find_profile(name) is None:
+                return None
+            profile = Profile(remote, name, self.remote_path_prefix)
+            profile.origin = self
+        return profile
+
     def create_item(self, pname, kernel_file, initrd_file, kargs_file):
         profile = Profile(self.cobbler, pname, self.remote_path_prefix)
         profile.populate_with(kernel_file, initrd_file, kargs_file)
+        self.changed()
 
 
 class HostsOrigin(main.Origin):
@@ -91,12 +104,15 @@ class HostsOrigin(main.Origin):
     cobbler = None
     expression = None
     whitelist = []
+    pools = None
+    cache_ttl = 60
 
     def __init__(self, server_url, user, pw, ssh_uri, expression="igor-",
-                 whitelist=[]):
+                 whitelist=[], pools=None):
         self.cobbler = Cobbler(server_url, (user, pw), ssh_uri)
         self.expression = expression
         self.whitelist = whitelist
+        self.pools = pools or {}
 
     def name(self):
         return "CobblerHostsOrigin(%s)" % self.cobbler.server_url
@@ -105,30 +121,47 @@ class HostsOrigin(main.Origin):
         items = {}
         with self.cobbler as remote:
             for sysname in remote.systems():
-                match = False
-                if self.expression in sysname:
-                    logger.debug("cobbler host '%s' matched expression" %
-                                 sysname)
-                    match = True
-                if sysname in self.__get_whitelist():
-                    logger.debug("cobbler host '%s' is in whitelist" % sysname)
-                    match = True
-                if not match:
+                if not self.__is_managed(sysname):
                     continue
-
-                host = Host()
-                host.remote = remote
-                host.name = sysname
-                host.origin = self
-                try:
-                    host.mac = remote.system(sysname)["mac_address_eth0"]
-                except:
-                    host.mac = ""
-                items[sysname] = host
+                items[sysname] = self.__host(remote, sysname)
 #        logger.debug("Number of cobbler hosts: %s" % len(items))
 #        logger.debug("Hosts: %s" % items)
         return items
 
+    def lookup(self, name):
+        """Looks up one system, without listing all systems
+        """
+        if not self.__is_managed(name):
+            return None
+        with self.cobbler as remote:
+            system = remote.find_system(name)
+            if system is None:
+                return None
+            return self.__host(remote, name, system)
+
+    def __is_managed(self, sysname):
+        match = False
+        if self.expression in sysname:
+            logger.debug("cobbler host '%s' matched expression" % sysname)
+            match = True
+        if sysname in self.__get_whitelist():
+            logger.debug("cobbler host '%s' is in whitelist" % sysname)
+            match = True
+        return match
+
+    def __host(self, remote, sysname, system=None):
+        host = Host()
+        host.remote = remote
+        host.name = sysname
+        host.origin = self
+        host.pools = main.pools_for(sysname, self.pools)
+        try:
+            system = system or remote.system(sysname)
+            host.mac = system["mac_address_eth0"]
+        except:
+            host.mac = ""
+        return host
+
     def __get_whitelist(self):
         w = self.whitelist
         if type(w) is str:
@@ -456,6 +489,19 @@ class Cobbler(object):
 #        return self.server.get_system_as_rendered(name)
 #        return self.server.get_blended_data("", name)
 
+    def find_system(self, name):
+        """The system with the name, or None if there is no such system
+        Cobbler returns "~" for unknown systems.
+        """
+        system = self.system(name)
+        return system if type(system) is dict else None
+
+    def find_profile(self, name):
+        """The profile with the name, or None if there is no such profile
+        """
+        profile = self.server.get_profile(name, True)
+        return profile if type(profile) is dict else None
+
     def power_system(self, name, power):
         assert power in ["on", "off", "status", "reboot"]
         logger.debug("Setting power '%s' on '%s'" % (power, name))
@@ -20,20 +20,43 @@
 
 from igor import log, utils
 from igor.daemon import main
+import copy
+import cPickle
 import glob
+import hashlib
 import os
+import shutil
 import tarfile
 import tempfile
+import threading
+import time
 import yaml
 
 
 logger = log.getLogger(__name__)
 
 
+# The drafts are shared by the categories and survive reloading the module
+try:
+    _draft_superorigin
+except NameError:
+    _draft_superorigin = None
+
+
+def draft_superorigin(CONFIG):
+    global _draft_superorigin
+    if _draft_superorigin is None:
+        drafts_config = CONFIG.get("drafts", {})
+        _draft_superorigin = TestDraftSuperOrigin(
+            drafts_config.get("path"),
+            ttl=drafts_config.get("ttl", 24 * 60 * 60))
+    return _draft_superorigin
+
+
 def initialize_origins(category, CONFIG):
     origins = []
 
-    superorigin = TestDraftSuperOrigin(tempfile.mkdtemp())
+    superorigin = draft_superorigin(CONFIG)
 
     if category == "testplan":
         origins += [("draft-files",
@@ -92,6 +115,7 @@ class Host(main.Host):
 
 class HostsOrigin(main.Origin):
     paths = None
+    cache_ttl = 5
 
     def __init__(self, paths):
         self.paths = paths
@@ -108,6 +132,7 @@ class HostsOrigin(main.Origin):
 
 class TestsuitesOrigin(main.Origin):
     paths = None
+    cache_ttl = 5
 
     def __init__(self, paths):
         if type(paths) is not list:
@@ -124,6 +149,7 @@ class TestsuitesOrigin(main.Origin):
 
 class TestplansOrigin(main.Origin):
     paths = None
+    cache_ttl = 5
 
     def __init__(self, paths):
         if type(paths) is not list:
@@ -139,56 +165,563 @@ class TestplansOrigin(main.Origin):
 
 
 class TestDraftSuperOrigin(object):
-    __temporary_path = None
+    """Keeps uploaded drafts of testplans and testsuites.
+    A draft is a tar archive with a plans/ and/or a suites/ dir (and the
+    sets, testcases and libs they reference). The files are stored by the
+    hash of their content, so uploading the same tree again does not store
+    or parse it a second time. The plans and suites of a draft are named
+    <draft>:<name>, layouts of a draft plan refer to the suites of the
+    same draft. Drafts expire ttl seconds after their upload.
+    All files a draft refers to must be in the draft. Trees left behind by
+    an earlier daemon are removed when the drafts are created.
+
+    >>> import shutil, StringIO
+    >>> def archive(files):
+    ...     buf = StringIO.StringIO()
+    ...     with tarfile.open(fileobj=buf, mode="w") as tar:
+    ...         for fn, data in files.items():
+    ...             info = tarfile.TarInfo(fn)
+    ...             info.size = len(data)
+    ...             tar.addfile(info, StringIO.StringIO(data))
+    ...     buf.seek(0)
+    ...     return buf
+    >>> files = {"suites/s.suite": "description: s\\n---\\n"
+    ...                            "sets: [../a.set]\\n",
+    ...          "a.set": "description: a\\n---\\nfilename: a.sh\\n",
+    ...          "a.sh": "",
+    ...          "plans/p.plan": "description: p\\n---\\ntestsuite: s\\n"
+    ...                          "profile: pr\\nhost: h\\n"}
+    >>> root = tempfile.mkdtemp()
+    >>> drafts = TestDraftSuperOrigin(root)
+    >>> plans = drafts.get_testplans_origin()
+    >>> suites = drafts.get_testsuites_origin()
+    >>> drafts.create_item("ci-1", archive(files))
+    >>> sorted(suites.items().keys())
+    ['ci-1:s']
+    >>> plans.items()["ci-1:p"].job_layouts[0]["testsuite"]
+    'ci-1:s'
+    >>> len(suites.items()["ci-1:s"].testcases())
+    1
+
+    Drafts are not parsed into the global parse cache, which is saved as
+    the index:
+
+    >>> [k for k in parse_cache._entries
+    ...  if k[1].startswith(os.path.realpath(root))]
+    []
+
+    The same content is stored and parsed once:
+
+    >>> drafts.create_item("ci-2", archive(files))
+    >>> sorted(suites.items().keys())
+    ['ci-1:s', 'ci-2:s']
+    >>> len(os.listdir(os.path.join(root, "trees")))
+    1
+
+    Paths leaving the draft are refused:
+
+    >>> drafts.create_item("bad", archive({"suites/../../x": ""}))
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Invalid path in draft archive: suites/../../x
+    >>> outside = dict(files, **{"a.set": "description: a\\n---\\n"
+    ...                                    "filename: /etc/hostname\\n"})
+    >>> drafts.create_item("bad", archive(outside)) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Path outside of the draft: .../etc/hostname
+    >>> len(os.listdir(os.path.join(root, "trees")))
+    1
+    >>> plans is drafts.get_testplans_origin()
+    True
+
+    Trees are removed with their last draft, drafts expire:
+
+    >>> drafts.remove_item("ci-1")
+    >>> drafts.remove_item("ci-2")
+    >>> os.listdir(os.path.join(root, "trees"))
+    []
+    >>> drafts.ttl = -1
+    >>> drafts.create_item("ci-3", archive(files))
+    >>> plans.items()
+    {}
+    >>> _ = os.makedirs(os.path.join(root, "trees", "stale"))
+    >>> _ = TestDraftSuperOrigin(root)
+    >>> os.listdir(os.path.join(root, "trees"))
+    []
+    >>> shutil.rmtree(root)
+    """
+    path = None
+    ttl = 24 * 60 * 60
+
+    # dname: (tree hash, expiry time)
+    _drafts = None
+    # tree hash: (plans, suites)
+    _trees = None
+    _lock = None
+
+    def __init__(self, path=None, ttl=24 * 60 * 60):
+        self.path = path or tempfile.mkdtemp()
+        self.ttl = ttl
+        self.suborigins = {}
+        self._drafts = {}
+        self._trees = {}
+        self._lock = threading.RLock()
+        self._remove_unknown_trees()
+
+    def _treedir(self, treehash):
+        return os.path.join(self.path, "trees", treehash)
+
+    def _remove_unknown_trees(self):
+        """Removes the trees no draft of this daemon refers to
+        """
+        treesdir = os.path.join(self.path, "trees")
+        if not os.path.isdir(treesdir):
+            return
+        for treehash in os.listdir(treesdir):
+            if treehash not in self._trees:
+                logger.info("Removing unknown draft tree %s" % treehash)
+                shutil.rmtree(os.path.join(treesdir, treehash),
+                              ignore_errors=True)
 
-    def __init__(self, temporary_path):
-        self.__temporary_path = tempfile.mkdtemp()
-        self.paths = []
+    @staticmethod
+    def _check_members(archive):
+        members = archive.getmembers()
+        for member in members:
+            parts = member.name.split("/")
+            if os.path.isabs(member.name) or ".." in parts or \
+                    not (member.isfile() or member.isdir()):
+                raise RuntimeError("Invalid path in draft archive: %s" %
+                                   member.name)
+        topdirs = set(m.name.split("/")[0] for m in members)
+        if not topdirs & set(["plans", "suites"]):
+            raise RuntimeError("A draft needs a plans or a suites dir")
+        return members
 
-    def create_item(self, dname, testplan_archive_file):
-        with tarfile.open(testplan_archive_file) as archive:
-            names = archive.getnames()
-            subdirs = set(n.split("/")[0] for n in names)
-            if subdirs != set("plans", "suites"):
-                raise RuntimeError("There must be two top-level dir")
+    @staticmethod
+    def _tree_hash(archive, members):
+        """The hash of the names and contents of all files
+        """
+        treehash = hashlib.sha1()
+        for member in sorted(members, key=lambda m: m.name):
+            if not member.isfile():
+                continue
+            content = hashlib.sha1()
+            src = archive.extractfile(member)
+            for chunk in iter(lambda: src.read(64 * 1024), ""):
+                content.update(chunk)
+            treehash.update("%s\0%s\n" % (member.name, content.hexdigest()))
+        return treehash.hexdigest()
+
+    def _store(self, archive, members, treehash):
+        """Extracts the tree once, concurrent uploads of the same tree are
+        resolved by the rename
+        """
+        dst = self._treedir(treehash)
+        if os.path.exists(dst):
+            return dst
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(dst))
+        archive.extractall(path=tmpdir, members=members)
+        try:
+            os.rename(tmpdir, dst)
+        except OSError:
+            shutil.rmtree(tmpdir)
+        return dst
+
+    def _parse(self, treehash):
+        """Parses the tree, which is refused if a set, testcase or lib is
+        outside of it
+        """
+        if treehash not in self._trees:
+            tdir = self._treedir(treehash)
+            plans, suites = {}, {}
+            # The tree is parsed once, a cache of it's own is dropped with it
+            cache = ParseCache()
+            try:
+                if os.path.isdir(os.path.join(tdir, "plans")):
+                    plans = Factory.testplans_from_paths(
+                        [os.path.join(tdir, "plans")], cache=cache)
+                if os.path.isdir(os.path.join(tdir, "suites")):
+                    suites = Factory.testsuites_from_paths(
+                        [os.path.join(tdir, "suites")], root=tdir,
+                        cache=cache)
+            except Exception as e:
+                shutil.rmtree(tdir, ignore_errors=True)
+                raise RuntimeError(str(e).replace(tdir, "the draft"))
+            self._trees[treehash] = (plans, suites)
+        return self._trees[treehash]
+
+    def create_item(self, dname, archive_file):
+        """Adds (or replaces) the draft dname, archive_file is a filename
+        or a file object of a tar archive
+        """
+        if hasattr(archive_file, "read"):
+            archive = tarfile.open(fileobj=archive_file)
+        else:
+            archive = tarfile.open(archive_file)
+        with archive:
+            members = self._check_members(archive)
+            treehash = self._tree_hash(archive, members)
+            with self._lock:
+                self._store(archive, members, treehash)
+                self._parse(treehash)
+                self._drafts[dname] = (treehash, time.time() + self.ttl)
+        logger.info("Draft %s is tree %s" % (dname, treehash))
+        self.prune()
+        self._changed()
+
+    def remove_item(self, dname):
+        with self._lock:
+            if dname not in self._drafts:
+                raise RuntimeError("Unknown draft: %s" % dname)
+            del self._drafts[dname]
+        self.prune()
+        self._changed()
+
+    def prune(self):
+        """Removes expired drafts and the trees no draft refers to
+        """
+        now = time.time()
+        with self._lock:
+            expired = [d for d, (_, expires) in self._drafts.items()
+                       if expires < now]
+            for dname in expired:
+                logger.info("Draft %s expired" % dname)
+                del self._drafts[dname]
+            used = set(treehash for treehash, _ in self._drafts.values())
+            for treehash in set(self._trees) - used:
+                del self._trees[treehash]
+                shutil.rmtree(self._treedir(treehash), ignore_errors=True)
+        if expired:
+            self._changed()
+
+    def _changed(self):
+        for origin in self.suborigins.values():
+            origin.changed()
+
+    def drafts(self):
+        self.prune()
+        with self._lock:
+            return dict((d, self._trees[treehash])
+                        for d, (treehash, _) in self._drafts.items())
+
+    def testplans(self):
+        plans = {}
+        for dname, (dplans, dsuites) in self.drafts().items():
+            for name, plan in dplans.items():
+                plan = copy.copy(plan)
+                plan.name = "%s:%s" % (dname, name)
+                plan.job_layouts = [self.__draft_layout(dname, dsuites, l)
+                                    for l in plan.job_layouts]
+                plans[plan.name] = plan
+        return plans
 
-            archive.extractall(path=self.__temporary_path)
+    @staticmethod
+    def __draft_layout(dname, dsuites, layout):
+        """Points the layout to the suite of the draft, if it has one
+        """
+        layout = dict(layout)
+        value = layout["testsuite"]
+        name = value[0] if type(value) is list else value
+        if name in dsuites:
+            name = "%s:%s" % (dname, name)
+            layout["testsuite"] = [name, value[1]] if type(value) is list \
+                else name
+        return layout
+
+    def testsuites(self):
+        suites = {}
+        for dname, (dplans, dsuites) in self.drafts().items():
+            for name, suite in dsuites.items():
+                suite = copy.copy(suite)
+                suite.name = "%s:%s" % (dname, name)
+                suites[suite.name] = suite
+        return suites
 
-            tdir = os.path.join(self.__temporary_path, dname)
-            self.paths.append(tdir)
+    def __suborigin(self, name, items_func):
+        """The origins are kept, the superorigin outlives reloads
+        """
+        with self._lock:
+            if name not in self.suborigins:
+                self.suborigins[name] = \
+                    TestDraftSuperOrigin.TestDraftSubOrigin(self, name,
+                                                            items_func)
+            return self.suborigins[name]
 
     def get_testplans_origin(self):
-        def draft_testplans():
-            paths = [os.path.join(self.__temporary_path, s, "plans")
-                     for s in os.listdir(self.__temporary_path)]
-            return Factory.testplans_from_paths(paths)
-
-        return TestDraftSuperOrigin.TestDraftSubOrigin(self,
-                                                       "DraftTestplans",
-                                                       draft_testplans)
+        return self.__suborigin("DraftTestplans", self.testplans)
 
     def get_testsuites_origin(self):
-        def draft_testsuites():
-            paths = [os.path.join(self.__temporary_path, s, "suites")
-                     for s in os.listdir(self.__temporary_path)]
-            return Factory.testsuites_from_paths(paths)
+        return self.__suborigin("DraftTestsuites", self.testsuites)
 
-        return TestDraftSuperOrigin.TestDraftSubOrigin(self,
-                                                       "DraftTestsuites",
-                                                       draft_testsuites)
+    class TestDraftSubOrigin(main.Origin):
+        # The drafts are in memory, expired drafts vanish within a minute
+        cache_ttl = 60
 
-    class TestDraftSubOrigin(TestplansOrigin):
         def __init__(self, superorigin, name, items_func):
             self.superorigin = superorigin
-            self.name = name
+            self.__name = name
             self.items_func = items_func
 
+        def name(self):
+            return "%s(%s)" % (self.__name, self.superorigin.path)
+
         def items(self):
             return self.items_func()
 
         def create_item(self, dname, archive):
             self.superorigin.create_item(dname, archive)
 
+        def remove_item(self, dname):
+            self.superorigin.remove_item(dname)
+
+
+class ParseCache(object):
+    """Caches objects parsed from files.
+    An object stays valid as long as the mtime and size of it's file and of
+    all files it depends on are unchanged. Objects parsed while parsing an
+    other object (e.g. the testsets of a testsuite) are dependencies of it.
+
+    >>> import shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> def write(fn, data):
+    ...     with open(os.path.join(tmpdir, fn), "w") as f:
+    ...         f.write(data)
+    >>> write("a.sh", "")
+    >>> write("a.set", "description: a\\n---\\nfilename: a.sh\\n")
+    >>> write("b.set", "description: b\\n---\\nfilename: a.sh\\n")
+    >>> write("s.suite", "description: s\\n---\\nsets: [a.set, b.set]\\n")
+    >>> suitefn = os.path.join(tmpdir, "s.suite")
+    >>> cache = ParseCache()
+    >>> parse = lambda: Factory.testsuite_from_file(suitefn, cache=cache)
+    >>> suite = parse()
+    >>> cache.misses, cache.hits
+    (3, 0)
+    >>> parse() is not suite
+    True
+    >>> cache.misses, cache.hits
+    (3, 1)
+
+    Changing a testset just parses the set and the suite again:
+
+    >>> write("a.set", "description: a\\n---\\nfilename: a.sh\\n---\\n"
+    ...                "filename: a.sh\\n")
+    >>> len(parse().testcases())
+    3
+    >>> cache.misses, cache.hits
+    (5, 2)
+
+    The cache can be saved as an index, together with the hashes of all
+    files. A file which was just touched is then still valid:
+
+    >>> index = os.path.join(tmpdir, "index")
+    >>> cache.save(index)
+    >>> loaded = ParseCache()
+    >>> loaded.load(index)
+    True
+    >>> os.utime(os.path.join(tmpdir, "b.set"), (0, 0))
+    >>> loaded.revalidate()
+    0
+    >>> len(Factory.testsuite_from_file(suitefn, cache=loaded).testcases())
+    3
+    >>> loaded.misses, loaded.hits
+    (0, 1)
+    >>> os.unlink(index)
+
+    So does removing a testcase file:
+
+    >>> os.unlink(os.path.join(tmpdir, "a.sh"))
+    >>> _ = parse()
+    >>> cache.misses
+    8
+    >>> shutil.rmtree(tmpdir)
+    """
+    hits = 0
+    misses = 0
+
+    _entries = None
+    _hashes = None
+    _lock = None
+    _recorders = None
+
+    def __init__(self):
+        self._entries = {}
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._recorders = threading.local()
+
+    @staticmethod
+    def stamp(filename):
+        """The (mtime, size) of a file, None if it does not exist
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    @staticmethod
+    def file_hash(filename):
+        try:
+            with open(filename, "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            return None
+
+    def _stack(self):
+        if not hasattr(self._recorders, "stack"):
+            self._recorders.stack = []
+        return self._recorders.stack
+
+    def depends_on(self, filename):
+        """Add a file to the dependencies of the object parsed right now
+        """
+        stack = self._stack()
+        if stack:
+            stack[-1][os.path.realpath(filename)] = self.stamp(filename)
+
+    def _revalidate(self, stamps):
+        """The current stamps of the files, or None if one changed
+        A file with a new stamp is unchanged if it's hash is the one of the
+        loaded index.
+        """
+        current = {}
+        for fn, stamp in stamps.items():
+            current[fn] = self.stamp(fn)
+            if current[fn] == stamp:
+                continue
+            known = self._hashes.get(fn)
+            if current[fn] is None or known is None or \
+                    self.file_hash(fn) != known:
+                return None
+        return current
+
+    def get(self, kind, filename, parse):
+        """The object of a kind parsed from filename, parse is called if
+        there is no valid cached object
+        """
+        key = (kind, os.path.realpath(filename))
+        with self._lock:
+            entry = self._entries.get(key)
+        stamps = self._revalidate(entry[0]) if entry is not None else None
+        if stamps is not None:
+            value = entry[1]
+            with self._lock:
+                self.hits += 1
+                if stamps != entry[0]:
+                    self._entries[key] = (stamps, value)
+        else:
+            stack = self._stack()
+            stamps = {}
+            stack.append(stamps)
+            try:
+                self.depends_on(filename)
+                value = parse()
+            finally:
+                stack.pop()
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = (stamps, value)
+
+        # The dependencies are also dependencies of the object being parsed
+        stack = self._stack()
+        if stack:
+            stack[-1].update(stamps)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._hashes = {}
+
+    def revalidate(self):
+        """Drops all entries whose files changed, returns their number
+        """
+        with self._lock:
+            entries = self._entries.items()
+        dropped = 0
+        for key, entry in entries:
+            stamps = self._revalidate(entry[0])
+            with self._lock:
+                if self._entries.get(key) is not entry:
+                    continue
+                if stamps is None:
+                    del self._entries[key]
+                    dropped += 1
+                else:
+                    self._entries[key] = (stamps, entry[1])
+        logger.debug("Revalidated parse cache, dropped %d entries" % dropped)
+        return dropped
+
+    def save(self, filename):
+        """Writes all entries and the hashes of their files to an index
+        The objects reference the files relative to the current working
+        directory, so the index can only be used from the same directory.
+        """
+        with self._lock:
+            entries = dict(self._entries)
+        filenames = set(fn for stamps, _ in entries.values() for fn in stamps)
+        data = {"cwd": os.getcwd(),
+                "entries": entries,
+                "hashes": {fn: self.file_hash(fn) for fn in filenames}}
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, "wb") as f:
+            cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, filename)
+
+    def load(self, filename):
+        """Adds the entries of an index, returns False if it can't be used
+        """
+        with open(filename, "rb") as f:
+            data = cPickle.load(f)
+        if data["cwd"] != os.getcwd():
+            logger.warning("Ignoring index %s, it was compiled in %s" %
+                           (filename, data["cwd"]))
+            return False
+        with self._lock:
+            self._entries.update(data["entries"])
+            self._hashes.update(data["hashes"])
+        logger.debug("Loaded %d entries from index %s" %
+                     (len(data["entries"]), filename))
+        return True
+
+
+parse_cache = ParseCache()
+
+
+def compile_index(CONFIG):
+    """Parses all testsuites, testplans and hosts into the index file
+    """
+    Factory.testsuites_from_paths(CONFIG["testcases"]["paths"])
+    Factory.testplans_from_paths(CONFIG["testplans"]["paths"])
+    Factory.hosts_from_paths(CONFIG["hosts"]["paths"])
+    parse_cache.save(CONFIG["index"])
+    logger.info("Compiled index %s" % CONFIG["index"])
+
+
+def load_index(CONFIG):
+    """Loads the index file, if there is one, and drops the entries whose
+    files changed in the background
+    """
+    filename = CONFIG.get("index")
+    if not filename or not os.path.exists(filename):
+        return
+    try:
+        if not parse_cache.load(filename):
+            return
+    except Exception as e:
+        logger.warning("Failed to load index %s: %s" % (filename, e))
+        return
+    thread = threading.Thread(target=parse_cache.revalidate,
+                              name="revalidate-index")
+    thread.daemon = True
+    thread.start()
+
 
 class Factory(utils.Factory):
     """A factory to build testing objects from different structures.
@@ -197,8 +730,26 @@ class Factory(utils.Factory):
     """
 
     @staticmethod
-    def testplan_from_file(filename, suffix=".plan"):
+    def check_within(filename, root):
+        """Raises if root is given and filename (resolved) is not below it
+
+        >>> Factory.check_within("/tmp/a/b", "/tmp/a")
+        >>> Factory.check_within("/tmp/a/../b", "/tmp/a")
+        Traceback (most recent call last):
+        ...
+        RuntimeError: Path outside of /tmp/a: /tmp/a/../b
+        """
+        if root is None:
+            return
+        real = os.path.realpath(filename)
+        if not real.startswith(os.path.realpath(root) + os.sep):
+            raise RuntimeError("Path outside of %s: %s" % (root, filename))
+
+    @staticmethod
+    def testplan_from_file(filename, suffix=".plan", cache=None):
         """Builds a Testplan from a testplan file.
+        Parsed plans are cached, each call returns a copy.
+
         The *.plan files are yaml encoded files containing the fields
         (testsuite, profile, host) for each job to be run in the plan.
 
@@ -213,7 +764,18 @@ class Factory(utils.Factory):
             host: 'default-libvirt'
             additional_kargs: 'foo'
             ---
+
+        Layouts can have an id and a list of ids of layouts to run after.
+        max_parallel in the plan properties sets how many layouts can run at
+        the same time.
         """
+        plan = (cache or parse_cache).get(
+            "testplan", filename,
+            lambda: Factory._parse_testplan_file(filename, suffix))
+        return copy.copy(plan)
+
+    @staticmethod
+    def _parse_testplan_file(filename, suffix):
         documents = Factory.__read_yaml(filename)
         layout_fields = ["testsuite", "profile", "host"]  # kargs
 
@@ -229,7 +791,7 @@ class Factory(utils.Factory):
         return plan
 
     @staticmethod
-    def testplans_from_paths(paths, suffix=".plan"):
+    def testplans_from_paths(paths, suffix=".plan", cache=None):
         """Builds a dict of testplans from *.plans files in a path.
         A filesystem layout could look like:
             suites/basic.plan
@@ -256,13 +818,13 @@ class Factory(utils.Factory):
             pat = os.path.join(path, "*%s" % suffix)
 #            logger.debug("Loading plan from %s" % pat)
             for f in glob.glob(pat):
-                plan = Factory.testplan_from_file(f)
+                plan = Factory.testplan_from_file(f, cache=cache)
                 assert plan.name not in plans, "Only unique plan names allowed"
                 plans[plan.name] = plan
         return plans
 
     @staticmethod
-    def testsuites_from_path(path, suffix=".suite"):
+    def testsuites_from_path(path, suffix=".suite", root=None, cache=None):
         """Builds a dict of testsuites from *.suite files in a path.
         A filesystem layout could look like:
             suites/basic.suite
@@ -280,16 +842,18 @@ class Factory(utils.Factory):
         suites = {}
         pat = os.path.join(path, "*%s" % suffix)
         for f in glob.glob(pat):
-            suite = Factory.testsuite_from_file(f)
+            suite = Factory.testsuite_from_file(f, cache=cache, root=root)
             suites[suite.name] = suite
         return suites
 
     @staticmethod
-    def testsuites_from_paths(paths, suffix=".suite"):
+    def testsuites_from_paths(paths, suffix=".suite", root=None,
+                              cache=None):
         """Builds a dict of testsuites from *.suite files in a list of paths.
         If more testsuites with the same name exist, the suite in the latest
         path is winning.
         Take a look at Factory.testsuites_from_path for more details.
+        If root is given, all files of the suites must be below root.
 
         >>> suites = Factory.testsuites_from_paths(["testcases/suites/"])
         >>> "examplesuite" in suites
@@ -299,12 +863,15 @@ class Factory(utils.Factory):
         suites = {}
         paths = [str.strip(p) for p in paths]
         for path in paths:
-            suites.update(Factory.testsuites_from_path(path, suffix))
+            suites.update(Factory.testsuites_from_path(path, suffix, root,
+                                                       cache))
         return suites
 
     @staticmethod
-    def testsuite_from_file(filename, suffix=".suite"):
+    def testsuite_from_file(filename, suffix=".suite", cache=None,
+                            root=None):
         """Builds a Testsuite from a testsuite file.
+        Parsed suites are cached, each call returns a copy.
         The *.suite files are expected to contain one testset file per line.
         The testset files path is relative to the testsuite file.
         Testsets can appear more than once.
@@ -320,7 +887,15 @@ class Factory(utils.Factory):
               - 'example.set'
               - 'selinux.set'
         """
+        cache = cache or parse_cache
+        suite = cache.get(
+            "testsuite", filename,
+            lambda: Factory._parse_testsuite_file(filename, suffix, cache,
+                                                  root))
+        return copy.copy(suite)
 
+    @staticmethod
+    def _parse_testsuite_file(filename, suffix, cache, root=None):
         documents = Factory.__read_yaml(filename)
 #        set_fields = ["sets"]  # searchpath
 
@@ -336,7 +911,9 @@ class Factory(utils.Factory):
             for tset in block["sets"]:
                 tsetfn = os.path.join(testsuitedir, searchpath, tset)
                 tsetfn = os.path.relpath(os.path.realpath(tsetfn))
-                testset = Factory.testset_from_file(tsetfn)
+                Factory.check_within(tsetfn, root)
+                testset = Factory.testset_from_file(tsetfn, cache=cache,
+                                                    root=root)
                 sets.append(testset)
 
         name = os.path.basename(filename).replace(suffix, "")
@@ -346,8 +923,9 @@ class Factory(utils.Factory):
         return suite
 
     @staticmethod
-    def testset_from_file(filename, suffix=".set"):
+    def testset_from_file(filename, suffix=".set", cache=None, root=None):
         """Builds a Testset from a testset file.
+        Parsed sets are cached and shared by the suites.
         The *.set files are expected to contain one testcase file and
         optionally some arguments per line.
         The testcase files path is relative to the testset file.
@@ -364,6 +942,14 @@ class Factory(utils.Factory):
             ---
 
         """
+        cache = cache or parse_cache
+        return cache.get(
+            "testset", filename,
+            lambda: Factory._parse_testset_file(filename, suffix, cache,
+                                                root))
+
+    @staticmethod
+    def _parse_testset_file(filename, suffix, cache, root=None):
         testsetdir = os.path.dirname(filename)
         documents = Factory.__read_yaml(filename)
 
@@ -378,11 +964,16 @@ class Factory(utils.Factory):
         if "libs" in properties:
             libs = properties["libs"]
             libs = [os.path.relpath(os.path.join(testsetdir, l)) for l in libs]
+            for lib in libs:
+                Factory.check_within(lib, root)
 
         cases = []
         for l in layouts:
             tcasefn = os.path.join(testsetdir, searchpath, l["filename"])
             tcasefn = os.path.relpath(os.path.realpath(tcasefn))
+            Factory.check_within(tcasefn, root)
+            Factory.check_within(tcasefn + ".d", root)
+            cache.depends_on(tcasefn)
             testcase = main.Testcase(filename=tcasefn)
             del l["filename"]
             testcase.__dict__.update(l)
@@ -392,18 +983,34 @@ class Factory(utils.Factory):
         return main.Testset(name=name, testcases=cases, libs=libs)
 
     @staticmethod
-    def hosts_from_file(filename, suffix=".hosts"):
+    def hosts_from_file(filename, suffix=".hosts", cache=None):
         """Reads hosts from a cfg file.
+        Parsed hosts are cached, each call returns copies.
 
         >>> hosts = Factory.hosts_from_file("data/example.hosts")
         >>> hosts["ahost"].mac == "aa:bb:cc:dd:ee"
         True
+
+        Hosts can be grouped in pools, the pools are also inherited from the
+        default host:
+
+        >>> hosts["ahost"].pools
+        ['example-farm']
+        >>> hosts["bhost"].pools
+        ['example-farm', 'special']
         """
+        hosts = (cache or parse_cache).get(
+            "hosts", filename,
+            lambda: Factory._parse_hosts_file(filename, suffix))
+        return {name: copy.copy(host) for name, host in hosts.items()}
 
+    @staticmethod
+    def _parse_hosts_file(filename, suffix):
         if not os.path.isfile(filename):
             raise Exception("Hosts filename does not exist: %s" % filename)
 
         host_fields = ["name", "mac", "poweron_script", "poweroff_script"]
+        optional_fields = ["pools"]
         default_key = "DEFAULT"
 
         data = open(filename).read()
@@ -420,6 +1027,9 @@ class Factory(utils.Factory):
             default_host = hosts[default_key]
             for host in hosts.values():
                 missing_fields = set(host_fields) - set(host.__dict__.keys())
+                missing_fields |= set(f for f in optional_fields
+                                      if f in default_host.__dict__ and
+                                      f not in host.__dict__)
                 defaults = {k: default_host.__dict__[k]
                             for k in missing_fields}
                 host.__dict__.update(defaults)
@@ -427,6 +1037,10 @@ class Factory(utils.Factory):
             # Remove default host from list
             del hosts[default_key]
 
+        for host in hosts.values():
+            if isinstance(host.pools, basestring):
+                host.pools = [host.pools]
+
         return hosts
 
     @staticmethod
@@ -44,7 +44,9 @@ def initialize_origins(category, CONFIG):
         origins += [("libvirt-create",
                      CreateDomainHostOrigin(*__con_args)),
                     ("libvirt-existing",
-                     ExistingDomainHostOrigin(*__con_args))]
+                     ExistingDomainHostOrigin(
+                         *__con_args,
+                         host_pools=CONFIG.get("host_pools", {})))]
 
     if category == "profile":
         origins += [("libvirt",
@@ -414,11 +416,14 @@ class CommonLibvirtOrigin(main.Origin):
     connection_uri = None
     storage_pool = None
     network_configuration = None
+    host_pools = None
 
-    def __init__(self, connection_uri, storage_pool, network_configuration):
+    def __init__(self, connection_uri, storage_pool, network_configuration,
+                 host_pools=None):
         self.connection_uri = connection_uri
         self.storage_pool = storage_pool
         self.network_configuration = network_configuration
+        self.host_pools = host_pools or {}
 
     def __set_host_props(self, host):
         host.connection_uri = self.connection_uri
@@ -442,6 +447,7 @@ class CommonLibvirtOrigin(main.Origin):
         """
         host = VMHost(name=name, connection_uri=self.connection_uri)
         self.__set_host_props(host)
+        host.pools = main.pools_for(name, self.host_pools)
         return host
 
     def items(self):
@@ -449,6 +455,9 @@ class CommonLibvirtOrigin(main.Origin):
 
 
 class CreateDomainHostOrigin(CommonLibvirtOrigin):
+    # A new domain is created for each job, so the host can't be cached
+    cache_ttl = 0
+
     def name(self):
         return "VMAlwaysCreateHostOrigin(%s)" % str(self.__dict__)
 
@@ -462,6 +471,7 @@ class CreateDomainHostOrigin(CommonLibvirtOrigin):
 class ExistingDomainHostOrigin(CommonLibvirtOrigin):
     """Provides access to all existing g    uests
     """
+    cache_ttl = 30
 
     def name(self):
         return "VMExistingHostOrigin(%s)" % str(self.__dict__)
@@ -487,6 +497,19 @@ class ExistingDomainHostOrigin(CommonLibvirtOrigin):
             hosts[key].origin = self
         return hosts
 
+    def lookup(self, name):
+        """Looks up one domain, without listing all domains
+        """
+        if not re.match("^[\w-]+$", name):
+            return None
+        cmd = "domstate '%s' 2>/dev/null" % name
+        state = str(LibvirtConnection._virsh(cmd, self.connection_uri))
+        if state not in ["running", "shut off"]:
+            return None
+        host = self._use_existing_host(name)
+        host.origin = self
+        return host
+
 
 class LibvirtProfile(main.Profile):
     """A kernel, initrd + kargs
@@ -648,6 +671,8 @@ class LibvirtProfile(main.Profile):
 class ProfileOrigin(CommonLibvirtOrigin):
     """Origin for libvirt profiles
     """
+    # The profiles only live in this origin, it reports all changes
+    cache_ttl = None
 
     __profiles = None
 
@@ -673,4 +698,5 @@ class ProfileOrigin(CommonLibvirtOrigin):
         profile = LibvirtProfile(pname)
         profile.populate_with(kernel_file, initrd_file, kargs_file)
         self.__profiles.append(profile)
+        self.changed()
         logger.debug("Created libvirt profile: %s" % profile)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Compression of archives, in one stream or in parallel chunks.
+
+Parallel compression compresses chunks of the data independently and
+concatenates the compressed streams. This is done for gz and xz only:
+gzip (also Python's gzip and tarfile) and xz read concatenated streams,
+but Python 2's bz2 module stops after the first stream, so bz2 archives
+are always a single stream.
+"""
+
+from igor import log
+import bz2
+import multiprocessing
+import subprocess
+import zlib
+
+
+logger = log.getLogger(__name__)
+
+
+# format: (file suffix, mimetype, default level, (lowest, highest level))
+FORMATS = {"tar": ("", "application/x-tar", None, None),
+           "gz": (".gz", "application/gzip", 6, (0, 9)),
+           "bz2": (".bz2", "application/x-bzip2", 9, (1, 9)),
+           "xz": (".xz", "application/x-xz", 6, (0, 9))}
+
+# Formats which can be compressed in parallel chunks
+PARALLEL_FORMATS = ["gz", "xz"]
+
+DEFAULT_FORMAT = "bz2"
+
+MIMETYPES = {"application/x-tar": "tar",
+             "application/gzip": "gz",
+             "application/x-gzip": "gz",
+             "application/x-bzip2": "bz2",
+             "application/x-xz": "xz"}
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# The process pool to compress chunks, see start_pool
+_pool = None
+_pool_workers = 1
+
+
+def suffix(fmt):
+    return FORMATS[fmt][0]
+
+
+def mimetype(fmt):
+    return FORMATS[fmt][1]
+
+
+def check_level(fmt, level):
+    """Raises if the level is not one of the format, tar has none
+
+    >>> check_level("gz", 0), check_level("tar", 5)
+    (0, None)
+    >>> check_level("bz2", 0)
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Invalid compression level for bz2: 0 (expected 1 to 9)
+    """
+    levels = FORMATS[fmt][3]
+    if level is None or levels is None:
+        return None
+    if not levels[0] <= level <= levels[1]:
+        raise RuntimeError("Invalid compression level for %s: %s "
+                           "(expected %d to %d)" % ((fmt, level) + levels))
+    return level
+
+
+def start_pool(workers):
+    """Starts the pool of processes used to compress chunks, at startup,
+    as it forks the daemon
+    """
+    global _pool, _pool_workers
+    if workers > 1 and _pool is None:
+        _pool = multiprocessing.Pool(workers)
+        _pool_workers = workers
+    return _pool
+
+
+def negotiate(fmt=None, accept=None):
+    """The format requested by name, or by the Accept header
+
+    >>> negotiate()
+    'bz2'
+    >>> negotiate("gz")
+    'gz'
+    >>> negotiate(accept="application/x-xz;q=0.5, application/gzip")
+    'gz'
+    >>> negotiate(accept="*/*")
+    'bz2'
+    >>> negotiate("zip")
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Unknown compression format: zip
+    """
+    if fmt:
+        if fmt not in FORMATS:
+            raise RuntimeError("Unknown compression format: %s" % fmt)
+        return fmt
+    candidates = []
+    for entry in (accept or "").split(","):
+        params = [p.strip() for p in entry.split(";")]
+        q = 1.0
+        for param in params[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        if params[0] in MIMETYPES and q > 0:
+            candidates.append((-q, len(candidates), MIMETYPES[params[0]]))
+    return min(candidates)[2] if candidates else DEFAULT_FORMAT
+
+
+def _compress_chunk(args):
+    """Compresses data into one complete stream of the format
+    """
+    fmt, level, data = args
+    if fmt == "gz":
+        c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+    if fmt == "bz2":
+        return bz2.compress(data, level)
+    if fmt == "xz":
+        proc = subprocess.Popen(["xz", "--stdout", "-%d" % level],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out = proc.communicate(data)[0]
+        if proc.returncode != 0:
+            raise RuntimeError("xz failed with %s" % proc.returncode)
+        return out
+    return data
+
+
+class CompressingWriter(object):
+    """A write-only file object which compresses all data written to it
+    into fileobj.
+    gz and xz chunks are compressed in parallel if the pool was started
+    (see start_pool), unless parallel is False.
+
+    >>> import io, tarfile
+    >>> data = "".join(str(i) for i in range(100000))
+    >>> _ = start_pool(2)
+    >>> for fmt in ["tar", "gz", "bz2"]:
+    ...     for p in [False, True]:
+    ...         dst = io.BytesIO()
+    ...         with CompressingWriter(dst, fmt, parallel=p,
+    ...                                chunk_size=1024) as w:
+    ...             with tarfile.open(fileobj=w, mode="w|") as tar:
+    ...                 info = tarfile.TarInfo("data")
+    ...                 info.size = len(data)
+    ...                 tar.addfile(info, io.BytesIO(data))
+    ...         _ = dst.seek(0)
+    ...         mode = "r:" + fmt if fmt != "tar" else "r"
+    ...         with tarfile.open(fileobj=dst, mode=mode) as tar:
+    ...             assert tar.extractfile("data").read() == data, (fmt, p)
+    """
+
+    fileobj = None
+    fmt = None
+    level = None
+    parallel = False
+    chunk_size = CHUNK_SIZE
+
+    _buffer = None
+    _buffered = 0
+    _compressor = None
+
+    def __init__(self, fileobj, fmt=DEFAULT_FORMAT, level=None, parallel=True,
+                 chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.fmt = fmt
+        self.level = check_level(fmt, level)
+        if self.level is None:
+            self.level = FORMATS[fmt][2]
+        self.parallel = parallel and _pool is not None and \
+            fmt in PARALLEL_FORMATS
+        self.chunk_size = chunk_size
+        self._buffer = []
+        if not self.parallel:
+            if fmt == "gz":
+                self._compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                                    16 + zlib.MAX_WBITS)
+            elif fmt == "bz2":
+                self._compressor = bz2.BZ2Compressor(self.level)
+
+    def write(self, data):
+        if self.fmt == "tar":
+            self.fileobj.write(data)
+        elif self._compressor is not None:
+            self.fileobj.write(self._compressor.compress(data))
+        else:
+            self._buffer.append(data)
+            self._buffered += len(data)
+            batch = _pool_workers if self.parallel else 1
+            if self._buffered >= self.chunk_size * batch:
+                self._flush_chunks()
+
+    def _flush_chunks(self):
+        data = "".join(self._buffer)
+        self._buffer, self._buffered = [], 0
+        chunks = [(self.fmt, self.level, data[i:i + self.chunk_size])
+                  for i in range(0, len(data), self.chunk_size)]
+        if self.parallel and len(chunks) > 1:
+            compressed = _pool.map(_compress_chunk, chunks)
+        else:
+            compressed = map(_compress_chunk, chunks)
+        for c in compressed:
+            self.fileobj.write(c)
+
+    def close(self):
+        if self._compressor is not None:
+            self.fileobj.write(self._compressor.flush())
+            self._compressor = None
+        elif self._buffer:
+            self._flush_chunks()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self.close()
+
+
+def decompress(fmt, data):
+    """Decompresses data, which can consist of many concatenated streams
+    """
+    if fmt == "gz":
+        out = []
+        while data:
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out.append(d.decompress(data))
+            data = d.unused_data
+        return "".join(out)
+    if fmt == "bz2":
+        out = []
+        while data:
+            d = bz2.BZ2Decompressor()
+            out.append(d.decompress(data))
+            data = d.unused_data
+        return "".join(out)
+    if fmt == "xz":
+        proc = subprocess.Popen(["xz", "--decompress", "--stdout"],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return proc.communicate(data)[0]
+    return data
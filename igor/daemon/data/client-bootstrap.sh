@@ -12,6 +12,8 @@ CURRENT_STEP=${igor_current_step}
 TESTSUITE=${igor_testsuite}
 TMPDIR=$(mktemp -d /tmp/oat.XXXXXX)
 LOGFILE=${TMPDIR}/testsuite.log
+# Testsuite files are kept here across reboots, named by their sha1
+CACHEDIR=/var/cache/igor/testsuite
 
 # 
 # Functions
@@ -49,6 +51,51 @@ request.get_method = lambda: 'PUT'
 resp = opener.open(request)
 EOP
 }
+fetch_testsuite_files()
+{
+  # Fetch just the files which changed or are not in the cache yet
+  local MANIFEST=$TMPDIR/manifest.txt
+  local MISSING=$TMPDIR/missing.txt
+  local BUNDLE=$TMPDIR/bundle.tar.gz
+  api_call "jobs/$SESSION/testsuite/manifest?format=plain" > $MANIFEST
+  grep -q "^[0-9a-f-]* \(file\|dir\|link\) " $MANIFEST || return 1
+  mkdir -p $CACHEDIR || return 1
+  :> $MISSING
+  while read SHA1 TYPE MODE NAME
+  do
+    case $TYPE in
+      dir) mkdir -p "$NAME" ;;
+      link) echo "$NAME" >> $MISSING ;;
+      file) [[ -e $CACHEDIR/$SHA1 ]] || echo "$NAME" >> $MISSING ;;
+    esac
+  done < $MANIFEST
+  debug "Fetching $(wc -l < $MISSING) of $(wc -l < $MANIFEST) files"
+  if [[ -s $MISSING ]]
+  then
+    curl --silent --fail --data-binary @$MISSING -o $BUNDLE \
+      "$(api_url "jobs/$SESSION/testsuite/bundle")?compression=gz" || return 1
+    tar ixzf $BUNDLE || return 1
+  fi
+  while read SHA1 TYPE MODE NAME
+  do
+    [[ $TYPE == file ]] || continue
+    if [[ -e $CACHEDIR/$SHA1 ]]
+    then
+      cp "$CACHEDIR/$SHA1" "$NAME" && chmod $MODE "$NAME" || return 1
+    else
+      [[ $(sha1sum < "$NAME" | cut -d" " -f1) == $SHA1 ]] || return 1
+      cp "$NAME" "$CACHEDIR/$SHA1"
+    fi
+  done < $MANIFEST
+}
+fetch_testsuite()
+{
+  fetch_testsuite_files && return 0
+  debug "Fetching the whole testsuite"
+  rm -rf testcases
+  api_call "jobs/$SESSION/testsuite" > testcases.tar.bz2
+  tar imxf testcases.tar.bz2
+}
 testcase_x_succeeded_last_time() {
   # Go backwards and return 0 in the case that the
   # last run of X was successfull
@@ -81,8 +128,7 @@ testcase_x_succeeded_last_time() {
   cd $TMPDIR
 
   debug "Fetching testsuite '$TESTSUITE' for session '$SESSION'"
-  api_call "jobs/$SESSION/testsuite" > testcases.tar.bz2
-  tar imxf testcases.tar.bz2
+  fetch_testsuite
 
   debug "Running testcases"
   cd testcases
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+The events of the daemon (post-testcase, post-end, ...), numbered and
+kept for a while, so a client can catch up on the events it missed.
+Event ids are <epoch>-<number>, the epoch changes with each start of the
+daemon, so ids of an earlier daemon are not mistaken for current ones.
+"""
+
+from igor import log
+import Queue
+import collections
+import json
+import threading
+import time
+
+
+logger = log.getLogger(__name__)
+
+
+class Subscription(object):
+    """The events for one subscriber, the missed events first
+    A subscriber which does not keep up with the events is dropped when
+    max_pending events are waiting, it can subscribe again from the last
+    event it got.
+    """
+
+    # Events of the history the subscriber missed, after a "lost" event
+    # if it missed more events than the history keeps
+    backlog = None
+    lost = False
+    dropped = False
+
+    _pending = None
+
+    def __init__(self, backlog, lost, max_pending):
+        self.backlog = collections.deque(backlog)
+        self.lost = lost
+        self._pending = Queue.Queue(max_pending)
+
+    def _offer(self, event):
+        """Returns False if the subscriber is too slow
+        """
+        try:
+            self._pending.put_nowait(event)
+        except Queue.Full:
+            self.dropped = True
+            self._pending = Queue.Queue()
+            self._pending.put(None)
+            return False
+        return True
+
+    def get(self, timeout=None):
+        """The next event, None after timeout seconds or if the subscriber
+        was dropped
+        """
+        if self.backlog:
+            return self.backlog.popleft()
+        try:
+            return self._pending.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+
+class EventBus(object):
+    """Keeps the latest max_events events, subscribers get the events after
+    the id of the last event they saw, and all events to come.
+
+    >>> bus = EventBus(max_events=3, max_pending=2, epoch="e")
+    >>> for n in range(4):
+    ...     _ = bus.publish("post-testcase", session="s%d" % n)
+    >>> sub = bus.subscribe(last_id="e-2")
+    >>> sub.lost, [e["id"] for e in sub.backlog]
+    (False, ['e-3', 'e-4'])
+    >>> _ = bus.publish("post-end", session="s4")
+    >>> [(e["id"], e["session"]) for e in [sub.get(), sub.get(), sub.get()]]
+    [('e-3', 's2'), ('e-4', 's3'), ('e-5', 's4')]
+    >>> sub.get(timeout=0.01) is None
+    True
+
+    Events older than the history are lost, as are the events of an
+    earlier daemon. The "lost" event has the id of the last lost event, so
+    a subscriber reconnecting with it is not told again:
+
+    >>> lost = bus.subscribe(last_id="e-0")
+    >>> [(e["type"], e["id"]) for e in lost.backlog]
+    [('lost', 'e-2'), ('post-testcase', 'e-3'), ('post-testcase', 'e-4'), \
+('post-end', 'e-5')]
+    >>> bus.subscribe(last_id="e-2").lost
+    False
+    >>> [e["id"] for e in bus.subscribe(last_id="old-42").backlog]
+    ['e-2', 'e-3', 'e-4', 'e-5']
+    >>> bus.subscribe(last_id="42")
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid event id: 42
+
+    A subscriber which does not keep up is dropped, without blocking the
+    publisher:
+
+    >>> for n in range(3):
+    ...     _ = bus.publish("post-annotate", session="s")
+    >>> sub.dropped, sub in bus.subscribers()
+    (True, False)
+    >>> format_sse(bus.history()[-1]).splitlines()[:2]
+    ['id: e-8', 'event: post-annotate']
+    """
+
+    max_events = 1000
+    max_pending = 100
+    epoch = None
+
+    # (number, event)
+    _events = None
+    _subscribers = None
+    _lock = None
+    _last_number = 0
+
+    def __init__(self, max_events=1000, max_pending=100, epoch=None):
+        self.max_events = max_events
+        self.max_pending = max_pending
+        self.epoch = epoch or "%x" % int(time.time() * 1000)
+        self._events = collections.deque(maxlen=max_events)
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def _id(self, number):
+        return "%s-%d" % (self.epoch, number)
+
+    def publish(self, event_type, **kwargs):
+        """Record an event and pass it to all subscribers
+        """
+        with self._lock:
+            self._last_number += 1
+            event = dict(kwargs, id=self._id(self._last_number),
+                         type=event_type, created_at=time.time())
+            self._events.append((self._last_number, event))
+            for sub in list(self._subscribers):
+                if not sub._offer(event):
+                    logger.debug("Dropping a slow subscriber at event %s" %
+                                 event["id"])
+                    self._subscribers.remove(sub)
+        return event
+
+    def subscribe(self, last_id=None):
+        """Subscribe to the events after the event id last_id, or just to
+        new events
+        """
+        last_number = None
+        if last_id is not None:
+            epoch, _, number = last_id.rpartition("-")
+            if not epoch or not number.isdigit():
+                raise ValueError("Invalid event id: %s" % last_id)
+            # All events of this daemon are new to a subscriber of an
+            # earlier one, but it missed the end of the earlier one
+            last_number = int(number) if epoch == self.epoch else -1
+        with self._lock:
+            backlog, lost = [], False
+            if last_number is not None:
+                backlog = [e for n, e in self._events if n > last_number]
+                if last_number > self._last_number:
+                    lost, lost_number = True, self._last_number
+                else:
+                    lost_number = self._events[0][0] - 1 if self._events \
+                        else last_number
+                    lost = lost_number > last_number
+                if lost:
+                    backlog.insert(0, {"id": self._id(lost_number),
+                                       "type": "lost",
+                                       "created_at": time.time()})
+            sub = Subscription(backlog, lost, self.max_pending)
+            self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    def subscribers(self):
+        with self._lock:
+            return list(self._subscribers)
+
+    def history(self):
+        with self._lock:
+            return [e for _, e in self._events]
+
+
+def format_sse(event):
+    """An event as a message of a text/event-stream
+    """
+    return "id: %s\nevent: %s\ndata: %s\n\n" % (
+        event["id"], event["type"], json.dumps(event, sort_keys=True))
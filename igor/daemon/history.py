@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+The runtime history of testcases, used for adaptive timeouts and ETAs.
+"""
+
+from igor import log
+import json
+import math
+import os
+import tempfile
+import threading
+
+
+logger = log.getLogger(__name__)
+
+
+def host_type(host):
+    """The type of a host, hosts of the same type have similar runtimes.
+    A host can set host_type, the class name is used otherwise.
+    """
+    return getattr(host, "host_type", None) or host.__class__.__name__
+
+
+class RuntimeHistory(object):
+    """Records the runtimes of testcases, keyed by the name of the testcase,
+    the profile and the type of the host.
+
+    Lookups fall back to the runtimes of the testcase on any profile, and
+    then on any host, if there are not enough samples for the exact key.
+
+    >>> h = RuntimeHistory(min_samples=3)
+    >>> for runtime in [10, 12, 11, 50]:
+    ...     h.record("tc.sh", "f20", "VMHost", runtime)
+    >>> h.percentile(50, "tc.sh", "f20", "VMHost")
+    11
+    >>> h.percentile(99, "tc.sh", "f20", "VMHost")
+    50
+    >>> h.percentile(50, "tc.sh", "f21", "VMHost")
+    11
+    >>> h.percentile(50, "other.sh") is None
+    True
+
+    The adaptive timeout is the 99th percentile times a margin, but never
+    more than the declared timeout, and not less than min_timeout:
+
+    >>> h.timeout_for("tc.sh", 600, "f20", "VMHost")
+    75.0
+    >>> h.timeout_for("tc.sh", 60, "f20", "VMHost")
+    60
+    >>> h.timeout_for("other.sh", 60)
+    60
+    >>> h.min_timeout = 120
+    >>> h.timeout_for("tc.sh", 600, "f20", "VMHost")
+    120
+    >>> h.expected_runtime("tc.sh", 60, "f20", "VMHost")
+    11
+    >>> h.expected_runtime("other.sh", 60)
+    60
+
+    The history can be persisted:
+
+    >>> fn = tempfile.mktemp()
+    >>> h.filename = fn
+    >>> h.save()
+    >>> RuntimeHistory(fn, min_samples=3).percentile(50, "tc.sh", "f20",
+    ...                                           "VMHost")
+    11
+    >>> os.unlink(fn)
+    """
+
+    filename = None
+    max_samples = 100
+    min_samples = 5
+    percentile_for_timeout = 99
+    margin = 1.5
+    min_timeout = 10
+
+    _samples = None
+    _lock = None
+    _is_dirty = False
+
+    def __init__(self, filename=None, max_samples=100, min_samples=5,
+                 percentile_for_timeout=99, margin=1.5, min_timeout=10):
+        self.filename = filename
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.percentile_for_timeout = percentile_for_timeout
+        self.margin = margin
+        self.min_timeout = min_timeout
+        self._samples = {}
+        self._lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            self.load()
+
+    def _keys(self, testcase, profile=None, host_type=None):
+        """The keys to lookup, from the most to the least specific one
+        """
+        return ["%s|%s|%s" % (testcase, profile, host_type),
+                "%s|*|%s" % (testcase, host_type),
+                "%s|*|*" % testcase]
+
+    def record(self, testcase, profile, host_type, runtime):
+        with self._lock:
+            for key in self._keys(testcase, profile, host_type):
+                samples = self._samples.setdefault(key, [])
+                samples.append(runtime)
+                del samples[:-self.max_samples]
+            self._is_dirty = True
+
+    def samples(self, testcase, profile=None, host_type=None):
+        """The runtimes of the most specific key with enough samples
+        """
+        with self._lock:
+            for key in self._keys(testcase, profile, host_type):
+                samples = self._samples.get(key, [])
+                if len(samples) >= self.min_samples:
+                    return list(samples)
+        return []
+
+    def percentile(self, p, testcase, profile=None, host_type=None):
+        """The p-th percentile (nearest rank) of the runtimes, or None
+        """
+        samples = sorted(self.samples(testcase, profile, host_type))
+        if not samples:
+            return None
+        rank = int(math.ceil(p / 100.0 * len(samples)))
+        return samples[max(0, rank - 1)]
+
+    def timeout_for(self, testcase, timeout, profile=None, host_type=None):
+        """The adaptive timeout of a testcase, the declared timeout is the
+        upper bound
+        """
+        p = self.percentile(self.percentile_for_timeout, testcase, profile,
+                            host_type)
+        if p is None:
+            return timeout
+        return min(timeout, max(self.min_timeout, p * self.margin))
+
+    def expected_runtime(self, testcase, timeout, profile=None,
+                         host_type=None):
+        """The median runtime, or the declared timeout without history
+        """
+        p = self.percentile(50, testcase, profile, host_type)
+        return timeout if p is None else p
+
+    def load(self):
+        with open(self.filename) as f:
+            samples = json.load(f)
+        with self._lock:
+            self._samples = samples
+        logger.debug("Loaded runtime history of %d keys from %s" %
+                     (len(samples), self.filename))
+
+    def save(self):
+        """Write the history, if it changed
+        The file is replaced atomically, so a crash does not corrupt it.
+        """
+        if not self.filename:
+            return
+        with self._lock:
+            if not self._is_dirty:
+                return
+            data = json.dumps(self._samples)
+            self._is_dirty = False
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.rename(tmpname, self.filename)
@@ -19,7 +19,12 @@
 # -*- coding: utf-8 -*-
 
 from igor import log, utils
+from events import EventBus
+from history import host_type
 import main
+import collections
+import copy
+import itertools
 import os
 import threading
 import time
@@ -39,8 +44,7 @@ s_passed = utils.State("passed")
 endstates = [s_aborted, s_failed, s_timedout, s_passed]
 
 
-_high_state_change_lock = threading.RLock()
-_state_change_lock = threading.RLock()
+# Just guards the maps and queues of the JobCenter, keep it short
 _jobcenter_lock = threading.RLock()
 
 
@@ -50,6 +54,9 @@ class Job(object):
     start()
     finish_step(..), [...] | abort()
     end()
+
+    Each job has it's own lock, so a long running setup of one job does not
+    block any other job.
     """
     job_center = None
     session_path = None
@@ -58,27 +65,45 @@ class Job(object):
     session = None
 
     host = None
+    host_pool = None
     profile = None
     testsuite = None
     additional_kargs = None
 
+    priority = None
+    submitter = None
+
+    # The ShardedJob this job runs a shard of
+    shard_of = None
+
     current_step = 0
     results = None
     _artifacts = None
 
+    # Increases whenever the state, the results or the artifacts change
+    version = 0
+
     _state = None
     _state_history = None
     state_changed = None
+    # Serializes the high level transitions (setup, start, step, end, ...)
+    _lock = None
+    # Just guards the state and it's history
+    _state_lock = None
     _created_at = None
     _ended = False
     _ended_at = None
 
-    _watchdog = None
+    # Handle of the scheduled timeout
+    _deadline = None
 
-    def __init__(self, job_center, cookie, jobspec, session_path="/tmp"):
+    def __init__(self, job_center, cookie, jobspec, session_path="/tmp",
+                 priority=None, submitter=None):
         """Create a new job to run the testsuite on host prepared with profile
         """
         self.job_center = job_center
+        self.priority = priority or PendingJobQueue.default_priority
+        self.submitter = submitter
         self.session_path = session_path
 
         assert cookie is not None, "Cookie can not be None"
@@ -92,8 +117,11 @@ class Job(object):
 
         assert host is not None, "host can not be None"
         assert profile is not None, "profile can not be None"
-        self.host = host
-        self.host.session = self.session
+        if isinstance(host, main.HostPool):
+            # The host is picked when the job gets started
+            self.host_pool = host
+        else:
+            self.bind_host(host)
         self.profile = profile
 
         self.testsuite = testsuite
@@ -103,39 +131,61 @@ class Job(object):
         self.results = []
         self._artifacts = []
 
+        self._lock = threading.RLock()
+        self._state_lock = threading.RLock()
         self._state_history = []
         self.state_changed = threading.Event()
         self.state(s_open)
 
-        self.watchdog = self.__init_watchdog()
-
         self._created_at = time.time()
 
-    def __init_watchdog(self):
-        class JobTimeoutWatchdog(utils.PollingWorkerDaemon):
-            job = None
-
-            def __init__(self, job):
-                self.job = job
-                utils.PollingWorkerDaemon.__init__(self)
-
-            def work(self):
-                logger.debug("Watching current step: %s" %
-                             self.job.current_step)
-                logger.debug("%ss of %ss (timeout) passed" % (
-                             self.job.runtime(),
-                             self.job.allowed_time_up_to_current_testcase()))
-                if self.job.is_timedout():
-                    with _high_state_change_lock:
-                        logger.debug("Watchdog for job %s: timed out." %
-                                     self.job.cookie)
-                        self.job.state(s_timedout)
-                    self.stop()
-
-        watchdog = JobTimeoutWatchdog(self)
-        return watchdog
-
-    @utils.synchronized(_high_state_change_lock)
+    def bind_host(self, host):
+        """Set the host this job is run on
+        """
+        assert self.host is None, "Job %s is already bound to host %s" % \
+            (self.cookie, self.host.get_name())
+        self.host = host
+        self.host.session = self.session
+        self._changed()
+
+    def _changed(self):
+        self.version = self.job_center._next_version()
+
+    def _started_at(self):
+        """When the job started running (after the host was prepared)
+        """
+        return [s for s in self._state_history
+                if s["state"] == s_running][0]["created_at"]
+
+    def _arm_deadline(self):
+        """(Re-)Schedule the timeout for the current testcase
+        The deadline is the start of the job plus the sum of the timeouts of
+        all testcases up to the current one.
+        """
+        self._disarm_deadline()
+        deadline = self._started_at() + \
+            self.allowed_time_up_to_current_testcase()
+        logger.debug("Job %s times out at %s, if step %s does not finish" %
+                     (self.cookie, time.ctime(deadline), self.current_step))
+        self._deadline = self.job_center._deadlines.schedule(
+            deadline, self._deadline_reached)
+
+    def _disarm_deadline(self):
+        self.job_center._deadlines.cancel(self._deadline)
+        self._deadline = None
+
+    @utils.synchronized_method("_lock")
+    def _deadline_reached(self):
+        if self.state() != s_running:
+            return
+        if self.is_timedout():
+            logger.debug("Job %s timed out at step %s" % (self.cookie,
+                                                          self.current_step))
+            self.state(s_timedout)
+        else:
+            self._arm_deadline()
+
+    @utils.synchronized_method("_lock")
     def setup(self):
         """Prepare a host to get started
         """
@@ -152,7 +202,7 @@ class Job(object):
         self.state(s_prepared)
         self.job_center._run_hook("post-setup", self.cookie)
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized_method("_lock")
     def start(self):
         """Start the actual test
         We expecte the testsuite to be gathered by the host, thus the host
@@ -164,10 +214,10 @@ class Job(object):
         logger.debug("Starting job %s" % (self.cookie))
         self.state(s_running)
         self.host.start()
-        self.watchdog.start()
+        self._arm_deadline()
         self.job_center._run_hook("post-start", self.cookie)
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized_method("_lock")
     def finish_step(self, n, is_success, note=None, is_abort=False,
                     is_skipped=False):
         """Finish one test step
@@ -182,7 +232,8 @@ class Job(object):
         if self.current_step != n:
             raise Exception("Expected a different step to finish.")
 
-        last_timestamp = self.created_at
+        # The first step starts with the job, not with the submission
+        last_timestamp = self._started_at()
         if len(self.results) > 0:
             last_timestamp = self.results[n - 1]["created_at"]
 
@@ -202,6 +253,12 @@ class Job(object):
         except Exception as e:
             logger.debug("No annotation or error: %s" % e.message)
 
+        runtime = time.time() - last_timestamp
+        if self.job_center.history and not (is_abort or is_skipped):
+            self.job_center.history.record(current_testcase.name,
+                                           self.profile.get_name(),
+                                           host_type(self.host), runtime)
+
         self.results.append({"created_at": time.time(),
                              "testcase": current_testcase.__to_dict__(),
                              "is_success": is_success,
@@ -209,7 +266,7 @@ class Job(object):
                              "is_abort": is_abort,
                              "is_skipped": is_skipped,
                              "note": note,
-                             "runtime": time.time() - last_timestamp,
+                             "runtime": runtime,
                              "log": log,
                              "annotations": annotations})
 
@@ -234,16 +291,19 @@ class Job(object):
         if len(self.testcases()) == len(self.results) and is_passed:
             self.state(s_passed)
 
+        self.job_center._run_hook("post-testcase", self.cookie)
+
+        self.current_step += 1
+        self._changed()
+
         if self.state() in endstates:
             logger.debug("Finished job %s: %s" % (self.cookie, self.state()))
-            self.watchdog.stop()
+            self._disarm_deadline()
         else:
             logger.debug("Awaiting results for step %s: %s" %
                          (n + 1, self.testsuite.testcases()[n + 1]))
+            self._arm_deadline()
 
-        self.job_center._run_hook("post-testcase", self.cookie)
-
-        self.current_step += 1
         return self.current_step
 
     def annotate(self, note, step="current", is_append=True):
@@ -288,6 +348,7 @@ class Job(object):
         if name not in self._artifacts:
             self._artifacts.append(name)
         self.session.add_artifact(name, data)
+        self._changed()
 
     def get_artifact(self, name):
         return self.session.get_artifact(name)
@@ -295,9 +356,10 @@ class Job(object):
     def list_artifacts(self):
         return self._artifacts
 
-    def get_artifacts_archive(self):
+    def get_artifacts_archive(self, compression_format="bz2", level=None):
         logger.debug("Creating artifacts archive for: %s" % self._artifacts)
-        return self.session.get_artifacts_archive(self._artifacts)
+        return self.session.get_artifacts_archive(self._artifacts,
+                                                  compression_format, level)
 
     def abort(self):
         """Abort the test
@@ -311,7 +373,7 @@ class Job(object):
         self.finish_step(self.current_step, is_success=False, note="aborted",
                          is_abort=True)
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized_method("_lock")
     def end(self):
         """Tear down this test, might clean up the host
         """
@@ -329,7 +391,7 @@ class Job(object):
     def ended_within(self, span):
         return (time.time() - self._ended_at) < span
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized_method("_lock")
     def clean(self):
         assert self._ended is True
         self.session.remove()
@@ -338,7 +400,7 @@ class Job(object):
         assert self._ended is True
         return time.time() - self._ended_at
 
-    @utils.synchronized(_state_change_lock)
+    @utils.synchronized_method("_state_lock")
     def state(self, new_state=None):
         if new_state is not None:
             self._state_history.append({
@@ -346,8 +408,10 @@ class Job(object):
                 "state": new_state
             })
             self._state = new_state
+            self._changed()
             self.state_changed.set()
             self.state_changed.clear()
+            self.job_center._job_state_changed(self)
         return self._state
 
     def result(self):
@@ -367,7 +431,9 @@ class Job(object):
             msg = "timedout"
 
         elif self.state() == s_failed:
-            assert not all([r["is_passed"] for r in self.results])
+            # A job without results failed during the setup
+            assert not self.results or \
+                not all([r["is_passed"] for r in self.results])
             msg = "failed"
 
         elif self.state() == s_running:
@@ -421,7 +487,7 @@ class Job(object):
         is_timeout = False
 
         timeout = self.allowed_time_up_to_current_testcase()
-        if self.runtime() > timeout:
+        if self.runtime() >= timeout:
             is_timeout = True
 
         return is_timeout
@@ -431,10 +497,43 @@ class Job(object):
         allowed until the current step
         """
         return Job._calculate_timeout_for_tcs(self.testsuite.testcases(),
-                                              self.current_step)
+                                              self.current_step,
+                                              self.testcase_timeout)
+
+    def testcase_timeout(self, testcase):
+        """The timeout of a testcase, adapted to it's runtime history
+        """
+        if self.job_center.history is None:
+            return testcase.timeout
+        return self.job_center.history.timeout_for(
+            testcase.name, testcase.timeout, self.profile.get_name(),
+            host_type(self.host) if self.host else None)
+
+    def expected_runtime(self, testcase):
+        """The expected runtime of a testcase, the timeout if unknown
+        """
+        if self.job_center.history is None:
+            return testcase.timeout
+        return self.job_center.history.expected_runtime(
+            testcase.name, testcase.timeout, self.profile.get_name(),
+            host_type(self.host) if self.host else None)
+
+    def eta(self):
+        """The expected time until this job ends
+        """
+        if self.state() in endstates:
+            return 0
+        remaining = self.testcases()[self.current_step:]
+        eta = sum(self.expected_runtime(tc) for tc in remaining)
+        if self.state() == s_running and remaining:
+            last_timestamp = self.results[-1]["created_at"] if self.results \
+                else self._started_at()
+            elapsed = time.time() - last_timestamp
+            eta -= min(elapsed, self.expected_runtime(remaining[0]))
+        return eta
 
     @staticmethod
-    def _calculate_timeout_for_tcs(all_tcs, cur):
+    def _calculate_timeout_for_tcs(all_tcs, cur, timeout=None):
         """Calculcate the the timeout including the current testcase.
 
         >>> Job._calculate_timeout_for_tcs([], 0)
@@ -458,12 +557,14 @@ class Job(object):
         Args:
             all_tcs: All testcases
             cur: The current testcase idx
+            timeout: A function returning the timeout of a testcase
         Returns:
             The timeout in seconds
         """
+        timeout = timeout or (lambda t: t.timeout)
         # +1 because we want the timeouts, including the current one
         tcs_up_to_now = all_tcs[:cur + 1]
-        return sum([t.timeout for t in tcs_up_to_now])
+        return sum([timeout(t) for t in tcs_up_to_now])
 
     def reached_endstate(self):
         """If this testsuite has reached any end state
@@ -480,52 +581,651 @@ class Job(object):
         while not self.reached_endstate():
             self.state_changed.wait()
 
+    def queue_position(self):
+        """The position in the queue of pending jobs, None if not queued
+        """
+        return self.job_center.queue_position(self.cookie)
+
     def __str__(self):
         return ("ID: %s\nState: %s\nStep: %d\nTestsuite:\n%s" %
                 (self.cookie, self.state(), self.current_step, self.testsuite))
 
-    def __to_dict__(self):
+    def __to_dict__(self, queue_positions=None):
+        """queue_positions (see PendingJobQueue.positions) spares looking
+        up the position of each of many jobs
+        """
+        if queue_positions is None:
+            queue_position = self.queue_position()
+        else:
+            queue_position = queue_positions.get(self.cookie)
         return {"id": self.cookie,
                 "profile": self.profile.get_name(),
-                "host": self.host.get_name(),
+                "host": self.host.get_name() if self.host
+                else self.host_pool.get_name(),
+                "host_pool": self.host_pool.get_name() if self.host_pool
+                else None,
                 "testsuite": self.testsuite.__to_dict__(),
                 "state": self.state(),
                 "is_endstate": self.state() in endstates,
                 "current_step": self.current_step,
                 "results": self.results,
+                "version": self.version,
                 "timeout": self.timeout(),
                 "runtime": self.runtime(),
+                "eta": self.eta(),
                 "created_at": self._created_at,
                 "artifacts": self._artifacts,
-                "additional_kargs": self.additional_kargs}
+                "additional_kargs": self.additional_kargs,
+                "priority": self.priority,
+                "submitter": self.submitter,
+                "queue_position": queue_position,
+                "shard_of": self.shard_of.cookie if self.shard_of
+                else None}
+
+
+class ShardedJob(object):
+    """A testsuite which is run in shards, by a job for each shard.
+    The shards are reported as one job, the results are merged in the order
+    of the testcases of the testsuite.
+    """
+    cookie = None
+    testsuite = None
+    jobs = None
+
+    def __init__(self, cookie, testsuite, jobs):
+        self.cookie = cookie
+        self.testsuite = testsuite
+        self.jobs = jobs
+        for job in jobs:
+            job.shard_of = self
+
+    def state(self):
+        """Passed if all shards passed, the state of the first shard which
+        did not pass otherwise.
+        """
+        states = [job.state() for job in self.jobs]
+        if not all(state in endstates for state in states):
+            if s_running in states:
+                return s_running
+            return [s for s in states if s not in endstates][0]
+        return ([s for s in states if s != s_passed] or [s_passed])[0]
+
+    def reached_endstate(self):
+        return self.state() in endstates
+
+    @property
+    def version(self):
+        return max(job.version for job in self.jobs)
+
+    def results(self):
+        results = []
+        for job in self.jobs:
+            results += job.results
+        return results
+
+    def result(self):
+        return self.jobs[0].result() if len(self.jobs) == 1 else \
+            ([job.result() for job in self.jobs
+              if job.result() != "passed"] or ["passed"])[0]
+
+    def __to_dict__(self, queue_positions=None):
+        dicts = [job.__to_dict__(queue_positions) for job in self.jobs]
+        return {"id": self.cookie,
+                "profile": dicts[0]["profile"],
+                "host": ", ".join(d["host"] for d in dicts),
+                "host_pool": dicts[0]["host_pool"],
+                "testsuite": self.testsuite.__to_dict__(),
+                "state": self.state(),
+                "is_endstate": self.reached_endstate(),
+                "current_step": sum(d["current_step"] for d in dicts),
+                "results": self.results(),
+                "version": max(d["version"] for d in dicts),
+                "timeout": max(d["timeout"] for d in dicts),
+                "runtime": max(d["runtime"] for d in dicts),
+                "eta": max(d["eta"] for d in dicts),
+                "created_at": min(d["created_at"] for d in dicts),
+                "artifacts": [],
+                "additional_kargs": dicts[0]["additional_kargs"],
+                "priority": dicts[0]["priority"],
+                "submitter": dicts[0]["submitter"],
+                "queue_position": None,
+                "shards": [d["id"] for d in dicts]}
+
+
+class PendingJobQueue(object):
+    """The queue of jobs waiting to be started.
+
+    Jobs are ordered by:
+    1. Their priority class. A waiting job is promoted by one class each
+       aging_interval seconds, so low priority jobs are not starved.
+    2. Their submitter. Within a class the submitters are served round robin.
+    3. The order of their submission (FIFO).
+
+    >>> q = PendingJobQueue(aging_interval=60)
+    >>> q.put("n0", "nightly", "cron", now=0)
+    >>> q.put("a0", "default", "alice", now=1)
+    >>> q.put("a1", "default", "alice", now=2)
+    >>> q.put("b0", "default", "bob", now=3)
+    >>> q.put("g0", "gating", "ci", now=4)
+    >>> q.ordered(now=5)
+    ['g0', 'a0', 'b0', 'a1', 'n0']
+    >>> q.position("b0", now=5)
+    2
+    >>> q.positions(now=5)["b0"]
+    2
+
+    After waiting for two aging intervals all jobs got promoted to the
+    highest class, now the long waiting nightly job goes first:
+
+    >>> q.ordered(now=125)
+    ['n0', 'a0', 'b0', 'g0', 'a1']
+
+    >>> q.remove("n0")
+    >>> len(q), "n0" in q, q.position("n0")
+    (4, False, None)
+    >>> q.put("x", "urgent")
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Unknown priority 'urgent', expected one of: \
+gating, default, nightly
+    """
+    # From the highest to the lowest priority class
+    priorities = ["gating", "default", "nightly"]
+    default_priority = "default"
+
+    aging_interval = None
+
+    _entries = None
+    _counter = None
+
+    def __init__(self, aging_interval=30 * 60):
+        self.aging_interval = aging_interval
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def put(self, cookie, priority=None, submitter=None, now=None):
+        priority = priority or self.default_priority
+        if priority not in self.priorities:
+            raise RuntimeError("Unknown priority '%s', expected one of: %s" %
+                               (priority, ", ".join(self.priorities)))
+        self._entries[cookie] = {"rank": self.priorities.index(priority),
+                                 "submitter": submitter,
+                                 "enqueued_at": time.time() if now is None
+                                 else now,
+                                 "seq": next(self._counter)}
+
+    def remove(self, cookie):
+        del self._entries[cookie]
+
+    def ordered(self, now=None):
+        """The cookies of all queued jobs, the next job to start first
+        """
+        now = time.time() if now is None else now
+        keys = {}
+        nth_of_submitter = {}
+        for cookie, entry in sorted(self._entries.items(),
+                                    key=lambda i: i[1]["seq"]):
+            waited = now - entry["enqueued_at"]
+            rank = max(0, entry["rank"] - int(waited / self.aging_interval))
+            nth = nth_of_submitter.get((rank, entry["submitter"]), 0)
+            nth_of_submitter[(rank, entry["submitter"])] = nth + 1
+            keys[cookie] = (rank, nth, entry["seq"])
+        return sorted(keys, key=keys.get)
+
+    def position(self, cookie, now=None):
+        """The position of a job in the queue, None if it is not queued
+        """
+        if cookie not in self._entries:
+            return None
+        return self.ordered(now).index(cookie)
+
+    def positions(self, now=None):
+        """The positions of all queued jobs
+        """
+        return dict((cookie, n) for n, cookie in enumerate(self.ordered(now)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, cookie):
+        return cookie in self._entries
 
 
 class JobCenter(object):
     """Manage jobs
+
+    The JobWorker is woken up whenever a job is queued or changes it's state,
+    so jobs are started and ended without waiting for the next poll.
+
+    >>> import tempfile
+    >>> class Host(main.Host):
+    ...     name = None
+    ...     def get_name(self):
+    ...         return self.name or "host-%x" % id(self)
+    ...     def prepare(self):
+    ...         pass
+    ...     def start(self):
+    ...         pass
+    ...     def purge(self):
+    ...         pass
+    >>> class Profile(main.Profile):
+    ...     def get_name(self):
+    ...         return "profile"
+    ...     def assign_to(self, host, additional_kargs=""):
+    ...         pass
+    ...     def revoke_from(self, host):
+    ...         pass
+    >>> def wait_for(predicate):
+    ...     for _ in range(200):
+    ...         if predicate():
+    ...             return True
+    ...         time.sleep(0.01)
+    ...     return False
+    >>> suite = main.Testsuite("suite", [main.Testset("set", ["tc.sh"])])
+    >>> spec = main.JobSpec(testsuite=suite, profile=Profile(), host=Host(),
+    ...                     additional_kargs="")
+    >>> jc = JobCenter(tempfile.mkdtemp(), hooks_path="/nonexistent")
+    >>> job = jc.submit(spec)["job"]
+    >>> _ = jc.start_job(job.cookie)
+    >>> wait_for(lambda: job.state() == s_running)
+    True
+    >>> _ = jc.finish_test_step(job.cookie, 0, True)
+    >>> wait_for(lambda: job._ended)
+    True
+    >>> job.host in jc._pool_of_hosts_in_use
+    False
+    >>> jc.queue_status()["pending"]
+    0
+
+    The hook events are published on the event bus:
+
+    >>> def job_events():
+    ...     return [e["type"] for e in jc.events.history()
+    ...             if e["session"] == job.cookie]
+    >>> wait_for(lambda: "post-end" in job_events())
+    True
+    >>> job_events()
+    ['pre-job', 'post-setup', 'post-start', 'post-testcase', 'post-job', \
+'post-end']
+
+    A slow setup of one job does neither block the setup of other jobs,
+    nor the steps reported by the hosts of running jobs:
+
+    >>> import threading
+    >>> class SlowHost(Host):
+    ...     prepared = threading.Event()
+    ...     def prepare(self):
+    ...         self.prepared.wait()
+    >>> slowspec = main.JobSpec(testsuite=suite, profile=Profile(),
+    ...                         host=SlowHost(), additional_kargs="")
+    >>> slowjob = jc.submit(slowspec)["job"]
+    >>> _ = jc.start_job(slowjob.cookie)
+    >>> wait_for(lambda: slowjob.state() == s_preparing)
+    True
+
+    >>> longsuite = main.Testsuite("long", [main.Testset("set",
+    ...                                                  ["tc.sh"] * 50)])
+    >>> jobs = [jc.submit(main.JobSpec(testsuite=longsuite,
+    ...                                profile=Profile(), host=Host(),
+    ...                                additional_kargs=""))["job"]
+    ...         for _ in range(8)]
+    >>> for j in jobs:
+    ...     _ = jc.start_job(j.cookie)
+    >>> wait_for(lambda: all(j.state() == s_running for j in jobs))
+    True
+
+    >>> def finish_all_steps(j):
+    ...     for n in range(50):
+    ...         _ = jc.finish_test_step(j.cookie, n, True)
+    >>> reporters = [threading.Thread(target=finish_all_steps, args=(j,))
+    ...              for j in jobs]
+    >>> for reporter in reporters:
+    ...     reporter.start()
+    >>> for reporter in reporters:
+    ...     reporter.join(10)
+    >>> all(j.state() == s_passed for j in jobs)
+    True
+    >>> slowjob.state() == s_preparing
+    True
+    >>> SlowHost.prepared.set()
+    >>> wait_for(lambda: slowjob.state() == s_running)
+    True
+
+    Jobs time out right at the deadline of the current testcase, the
+    deadline moves with each finished step:
+
+    >>> tc = main.Testcase(name="tc.sh")
+    >>> tc.timeout = 0.5
+    >>> shortsuite = main.Testsuite("short", [main.Testset("set",
+    ...                                                    [tc, tc])])
+    >>> job = jc.submit(main.JobSpec(testsuite=shortsuite, profile=Profile(),
+    ...                              host=Host(), additional_kargs=""))["job"]
+    >>> _ = jc.start_job(job.cookie)
+    >>> wait_for(lambda: job.state() == s_running)
+    True
+    >>> _ = jc.finish_test_step(job.cookie, 0, True)
+    >>> wait_for(lambda: job.state() == s_timedout)
+    True
+    >>> 1.0 <= job.runtime() < 1.2
+    True
+    >>> job.result()
+    'timedout'
+
+    A job submitted against a pool of hosts is bound to the first free host
+    of the pool, when it is started:
+
+    >>> farm = dict((n, Host(name=n, pools=["farm"]))
+    ...             for n in ["farm-0", "farm-1"])
+    >>> poolspec = main.JobSpec(testsuite=suite, profile=Profile(),
+    ...                         host=main.HostPool("farm", lambda: farm),
+    ...                         additional_kargs="")
+    >>> pooljobs = [jc.submit(poolspec)["job"] for _ in range(3)]
+    >>> for j in pooljobs:
+    ...     _ = jc.start_job(j.cookie)
+    >>> wait_for(lambda: [j.state() for j in pooljobs].count(s_running) == 2)
+    True
+    >>> sorted(j.host.get_name() for j in pooljobs if j.host)
+    ['farm-0', 'farm-1']
+    >>> waiting = [j for j in pooljobs if j.host is None][0]
+    >>> waiting.__to_dict__()["host"], waiting.queue_position()
+    ('farm', 0)
+    >>> jc.get_jobs()["all"][waiting.cookie]["queue_position"]
+    0
+    >>> running = pooljobs[0]
+    >>> _ = jc.finish_test_step(running.cookie, 0, True)
+    >>> wait_for(lambda: waiting.state() == s_running)
+    True
+    >>> waiting.host is running.host
+    True
+
+    Hosts are reserved by name, also if a pool and a job refer to the same
+    host by different objects. A pool which can not be looked up does not
+    keep other jobs from being started:
+
+    >>> twin = jc.submit(main.JobSpec(testsuite=suite, profile=Profile(),
+    ...                               host=Host(name=waiting.host.name),
+    ...                               additional_kargs=""))["job"]
+    >>> broken_hosts = {}
+    >>> def broken_pool():
+    ...     if not broken_hosts:
+    ...         raise RuntimeError("unreachable")
+    ...     return broken_hosts
+    >>> broken = jc.submit(main.JobSpec(
+    ...     testsuite=suite, profile=Profile(),
+    ...     host=main.HostPool("broken", broken_pool),
+    ...     additional_kargs=""))["job"]
+    >>> other = jc.submit(main.JobSpec(testsuite=suite, profile=Profile(),
+    ...                                host=Host(name="other"),
+    ...                                additional_kargs=""))["job"]
+    >>> for j in [twin, broken, other]:
+    ...     _ = jc.start_job(j.cookie)
+    >>> wait_for(lambda: other.state() == s_running)
+    True
+    >>> twin.state() == s_running, broken.host
+    (False, None)
+    >>> for j in [pooljobs[1], waiting, other]:
+    ...     _ = jc.finish_test_step(j.cookie, 0, True)
+    >>> wait_for(lambda: twin.state() == s_running)
+    True
+    >>> broken_hosts["b"] = Host(name="b", pools=["broken"])
+    >>> jc._worker.wakeup()
+    >>> wait_for(lambda: broken.state() == s_running)
+    True
+    >>> for j in [twin, broken]:
+    ...     _ = jc.finish_test_step(j.cookie, 0, True)
+
+    Plans run their layouts in parallel, as far as the dependencies of the
+    layouts and max_parallel allow:
+
+    >>> def origin(items):
+    ...     o = main.Origin()
+    ...     o.items = lambda: items
+    ...     return o
+    >>> hosts = dict((n, Host(name=n)) for n in ["h-a", "h-b", "h-c"])
+    >>> inventory = main.Inventory(
+    ...     testsuites={"o": origin({"suite": suite})},
+    ...     profiles={"o": origin({"profile": Profile()})},
+    ...     hosts={"o": origin(hosts)})
+    >>> def layout(host, **kwargs):
+    ...     kwargs.update({"testsuite": "suite", "profile": "profile",
+    ...                    "host": host, "additional_kargs": ""})
+    ...     return kwargs
+    >>> plan = main.Testplan("plan", [layout("h-a", id="a"),
+    ...                               layout("h-b", id="b"),
+    ...                               layout("h-c", after=["a", "b"])])
+    >>> plan.inventory = inventory
+    >>> plan.max_parallel = 2
+    >>> worker = jc.submit_plan(plan)
+    >>> wait_for(lambda: len(worker.jobs) == 2 and
+    ...          all(j.state() == s_running for j in worker.jobs))
+    True
+    >>> sorted(j.host.get_name() for j in worker.jobs)
+    ['h-a', 'h-b']
+    >>> len(worker.__to_dict__()["current_job_cookies"])
+    2
+    >>> _ = jc.finish_test_step(worker.jobs[0].cookie, 0, True)
+    >>> time.sleep(0.1)
+    >>> len(worker.jobs)
+    2
+    >>> _ = jc.finish_test_step(worker.jobs[1].cookie, 0, True)
+    >>> wait_for(lambda: len(worker.jobs) == 3 and
+    ...          worker.jobs[2].state() == s_running)
+    True
+    >>> worker.jobs[2].host.get_name()
+    'h-c'
+    >>> _ = jc.finish_test_step(worker.jobs[2].cookie, 0, True)
+    >>> worker.join(2)
+    >>> worker.passed, worker.status
+    (True, 'stopped')
+
+    Each submission of a plan is a run of it's own, so a plan can be run
+    multiple times at once with different variables:
+
+    >>> plan = main.Testplan("vplan", [layout("{host}")])
+    >>> plan.inventory = inventory
+    >>> runs = [jc.submit_plan(plan, variables={"host": h})
+    ...         for h in ["h-a", "h-b"]]
+    >>> wait_for(lambda: all(len(r.jobs) == 1 and
+    ...                      r.jobs[0].state() == s_running for r in runs))
+    True
+    >>> [r.jobs[0].host.get_name() for r in runs]
+    ['h-a', 'h-b']
+    >>> runs[0].plan.run_id != runs[1].plan.run_id
+    True
+    >>> jc.status_plan("vplan")["run_id"] == runs[1].plan.run_id
+    True
+    >>> version = jc.status_plan_version("vplan", runs[0].plan.run_id)[1]
+    >>> _ = jc.finish_test_step(runs[0].jobs[0].cookie, 0, False)
+    >>> runs[0].join(2)
+    >>> jc.status_plan("vplan", runs[0].plan.run_id)["passed"]
+    False
+
+    Each change of a job or a run gives it a higher version:
+
+    >>> jc.status_plan_version("vplan", runs[0].plan.run_id)[1] > version
+    True
+    >>> version = runs[1].jobs[0].version
+    >>> runs[1].jobs[0].add_artifact("a", "data")
+    >>> runs[1].jobs[0].version > version
+    True
+
+    Clients can wait for the next change:
+
+    >>> version = runs[1].version
+    >>> jc.wait_for_change(lambda: runs[1].version, version, 0.1) == version
+    True
+    >>> adder = threading.Timer(0.1, runs[1].jobs[0].add_artifact,
+    ...                         ["b", "data"])
+    >>> adder.start()
+    >>> jc.wait_for_change(lambda: runs[1].version, version, 5) > version
+    True
+    >>> jc.status_plan("vplan", runs[1].plan.run_id)["status"]
+    'running'
+    >>> _ = jc.abort_plan("vplan")
+    >>> runs[1].join(2)
+    >>> jc.status_plan("vplan")["status"], len(jc._plan_results["vplan"])
+    ('stopped', 2)
+    >>> plan.variables, plan.job_layouts[0]["host"]
+    ({}, '{host}')
+
+    A layout which can not be started stops the run and it's running jobs:
+
+    >>> plan = main.Testplan("bplan", [layout("h-a"), layout("no-such-host")])
+    >>> plan.inventory = inventory
+    >>> plan.max_parallel = 2
+    >>> worker = jc.submit_plan(plan)
+    >>> worker.join(2)
+    >>> worker.passed, worker.status, len(jc._plan_results["bplan"])
+    (False, 'stopped', 1)
+    >>> [str(j.state()) for j in worker.jobs]
+    ['aborted']
+
+    A testsuite can be split into shards, which run as sibling jobs and are
+    reported as one job:
+
+    >>> shardhosts = dict((n, Host(name=n, pools=["shards"]))
+    ...                   for n in ["shard-0", "shard-1"])
+    >>> foursuite = main.Testsuite("four", [main.Testset("set",
+    ...                                                  ["tc.sh"] * 4)])
+    >>> shardspec = main.JobSpec(testsuite=foursuite, profile=Profile(),
+    ...                          host=main.HostPool("shards",
+    ...                                             lambda: shardhosts),
+    ...                          additional_kargs="")
+    >>> sharded = jc.submit_sharded(shardspec, 2)["job"]
+    >>> jc.lookup(sharded.cookie) is sharded
+    True
+    >>> [len(j.testcases()) for j in sharded.jobs]
+    [2, 2]
+    >>> _ = jc.start_job(sharded.cookie)
+    >>> wait_for(lambda: sharded.state() == s_running and
+    ...          all(j.state() == s_running for j in sharded.jobs))
+    True
+    >>> sorted(j.host.get_name() for j in sharded.jobs)
+    ['shard-0', 'shard-1']
+    >>> first, second = sharded.jobs
+    >>> for n in range(2):
+    ...     _ = jc.finish_test_step(second.cookie, n, n == 0)
+    >>> sharded.state() == s_running
+    True
+    >>> for n in range(2):
+    ...     _ = jc.finish_test_step(first.cookie, n, True)
+    >>> sharded.state() == s_failed, sharded.result()
+    (True, 'failed')
+    >>> [r["is_passed"] for r in sharded.__to_dict__()["results"]]
+    [True, True, True, False]
+
+    The shards of a job on a single host each have the session of their own
+    job:
+
+    >>> solospec = main.JobSpec(testsuite=foursuite, profile=Profile(),
+    ...                         host=Host(name="solo"), additional_kargs="")
+    >>> solo = jc.submit_sharded(solospec, 2)["job"]
+    >>> [j.host.session.cookie == j.cookie for j in solo.jobs]
+    [True, True]
+
+    With a runtime history, the timeout of a testcase adapts to the past
+    runtimes of the testcase, and the ETA of the job is based on them:
+
+    >>> from history import RuntimeHistory
+    >>> jc.history = RuntimeHistory(min_samples=3, margin=2, min_timeout=0)
+    >>> for runtime in [0.1, 0.2, 0.2]:
+    ...     jc.history.record("fast.sh", "profile", "Host", runtime)
+    >>> fastsuite = main.Testsuite("fast", [main.Testset("set",
+    ...                                                  ["fast.sh"] * 2)])
+    >>> job = jc.submit(main.JobSpec(testsuite=fastsuite, profile=Profile(),
+    ...                              host=Host(), additional_kargs=""))["job"]
+    >>> job.eta()
+    0.4
+
+    The runtime of the first testcase does not include the time the job
+    waited to be started:
+
+    >>> time.sleep(0.2)
+    >>> _ = jc.start_job(job.cookie)
+    >>> wait_for(lambda: job.state() == s_running)
+    True
+    >>> _ = jc.finish_test_step(job.cookie, 0, True)
+    >>> 0 < job.eta() <= 0.2
+    True
+    >>> wait_for(lambda: job.state() == s_timedout)
+    True
+    >>> job.runtime() < 1.0
+    True
+    >>> jc.history.samples("fast.sh", "profile", "Host")[-1] < 0.1
+    True
+    >>> jc.history = None
+    >>> jc.shutdown()
     """
     session_path = None
     hooks_path = None
 
-    jobs = {}
-    closed_jobs = []
+    jobs = None
+    closed_jobs = None
+    sharded_jobs = None
 
-    _queue_of_pending_jobs = []
-    _queue_of_ended_jobs = []
-    _pool_of_hosts_in_use = set([])
+    # The RuntimeHistory of the testcases, None to use the static timeouts
+    history = None
 
-    _running_plans = {}
-    _plan_results = {}
+    # The version of the latest change of a job or plan
+    version = 0
 
-    _cookie_lock = threading.Lock()
+    # The EventBus the hook events are published on
+    events = None
 
-    _worker = None
+    # Cookies of jobs waiting for their host to get free
+    _queue_of_pending_jobs = None
+    # Jobs which reached an endstate and need to be ended
+    _queue_of_finished_jobs = None
+    # Jobs which were ended and can be cleaned
+    _queue_of_ended_jobs = None
+    _pool_of_hosts_in_use = None
+
+    _running_plans = None
+    _plan_results = None
+
+    _cookie_lock = None
+    _versions = None
+    _version_lock = None
+    # Notified with each new version
+    _version_changed = None
 
-    def __init__(self, session_path, hooks_path=None):
+    _worker = None
+    # Runs the setup and teardown of jobs
+    _provisioning_pool = None
+    # Fires the timeouts of all jobs
+    _deadlines = None
+
+    def __init__(self, session_path, hooks_path=None, max_workers=4,
+                 aging_interval=30 * 60, plan_history=10, history=None,
+                 events=None):
         self.session_path = session_path
         self.hooks_path = hooks_path
+        self.history = history
+        self.events = events or EventBus()
         if not os.path.exists(self.session_path):
             os.makedirs(self.session_path)
 
+        self.jobs = {}
+        self.closed_jobs = []
+        self.sharded_jobs = {}
+        self._queue_of_pending_jobs = PendingJobQueue(aging_interval)
+        self._queue_of_finished_jobs = []
+        self._queue_of_ended_jobs = []
+        self._pool_of_hosts_in_use = set([])
+        self._running_plans = {}
+        self._plan_results = {}
+        self._plan_history = plan_history
+        self._plan_run_ids = itertools.count()
+        self._cookie_lock = threading.Lock()
+        self._versions = itertools.count(1)
+        self._version_lock = threading.Lock()
+        self._version_changed = threading.Condition(self._version_lock)
+
+        self._provisioning_pool = utils.WorkerPool(max_workers,
+                                                   "JobProvisioning")
+        self._deadlines = utils.DeadlineScheduler()
+        self._deadlines.start()
+
         logger.debug("JobCenter opened in %s" % self.session_path)
 
         self._worker = JobCenter.JobWorker(jc=self, cleanup_age=5 * 60)
@@ -535,34 +1235,111 @@ class JobCenter(object):
         self._worker.stop()
         logger.debug("JobCenter is gone.")
 
-    @utils.synchronized(_jobcenter_lock)
+    def shutdown(self):
+        """Stop all workers and wait for them to end
+        """
+        self._worker.stop()
+        self._worker.join()
+        self._provisioning_pool.stop()
+        self._deadlines.stop()
+        self._deadlines.join()
+
+    def _next_version(self):
+        """A new version of the jobs, it is higher than all before
+        Jobs and plans remember the version of their last change.
+        """
+        with self._version_changed:
+            self.version = next(self._versions)
+            self._version_changed.notify_all()
+            return self.version
+
+    def wait_for_change(self, version_of, since, timeout):
+        """Blocks until version_of() is higher than since, or for timeout
+        seconds. Returns the version of the item.
+
+        Args:
+            version_of: Returns the version of a job, plan run, ...
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self._version_changed:
+                seen = self.version
+            version = version_of()
+            remaining = deadline - time.time()
+            if version > since or remaining <= 0:
+                return version
+            with self._version_changed:
+                # Versions taken since are checked right away
+                if self.version == seen:
+                    self._version_changed.wait(remaining)
+
     def get_jobs(self):
-        return {"all": self.jobs,
-                "closed": self.closed_jobs}
+        """All jobs as dicts, the queue is ordered once for all of them
+        """
+        with _jobcenter_lock:
+            jobs = dict(self.jobs)
+            sharded_jobs = dict(self.sharded_jobs)
+            closed_jobs = list(self.closed_jobs)
+            positions = self._queue_of_pending_jobs.positions()
+            queue_status = self.queue_status()
+        # The jobs are locked while their dicts are built, so this is done
+        # outside of the lock of the job center
+        return {"all": dict((cookie, job.__to_dict__(positions))
+                            for cookie, job in jobs.items()),
+                "sharded": dict((cookie, job.__to_dict__(positions))
+                                for cookie, job in sharded_jobs.items()),
+                "closed": [job.__to_dict__(positions)
+                           for job in closed_jobs],
+                "queue": queue_status}
+
+    @utils.synchronized(_jobcenter_lock)
+    def queue_position(self, cookie):
+        """The position of the job in the queue of pending jobs
+        """
+        return self._queue_of_pending_jobs.position(cookie)
+
+    def queue_status(self):
+        """Jobs waiting for a host and the load of the provisioning pool
+        """
+        return {"pending": len(self._queue_of_pending_jobs),
+                "hosts_in_use": len(self._pool_of_hosts_in_use),
+                "workers": self._provisioning_pool.size,
+                "queued": self._provisioning_pool.queued(),
+                "in_flight": self._provisioning_pool.in_flight()}
 
     def _generate_cookie(self, cookie_req=None):
         cookie = cookie_req
-        self._cookie_lock.acquire()
         while cookie is None or cookie in self.jobs.keys():
             cookie = "%s-%d" % (time.strftime("%Y%m%d-%H%M%S"),
                                 len(self.jobs.items()))
             cookie = "i" + utils.surl(cookie.replace("-", ""))
-        self._cookie_lock.release()
         assert cookie is not None, ("Cookie creation failed: %s -> %s" %
                                     (cookie_req, cookie))
         return cookie
 
-    @utils.synchronized(_jobcenter_lock)
-    def submit(self, jobspec, cookie_req=None):
+    def submit(self, jobspec, cookie_req=None, priority=None, submitter=None):
         """Enqueue a jobspec to be run against a specififc build on
         given host
+
+        Args:
+            priority: The priority class used when the job is queued, one of
+                      PendingJobQueue.priorities
+            submitter: Who submitted the job, used to serve submitters fair
         """
-        cookie = self._generate_cookie(cookie_req)
+        if priority and priority not in PendingJobQueue.priorities:
+            raise RuntimeError("Unknown priority '%s', expected one of: %s" %
+                               (priority,
+                                ", ".join(PendingJobQueue.priorities)))
+
+        with self._cookie_lock:
+            cookie = self._generate_cookie(cookie_req)
 
-        j = Job(self, cookie, jobspec, session_path=self.session_path)
-        j.created_at = time.time()
+            j = Job(self, cookie, jobspec, session_path=self.session_path,
+                    priority=priority, submitter=submitter)
+            j.created_at = time.time()
 
-        self.jobs[cookie] = j
+            with _jobcenter_lock:
+                self.jobs[cookie] = j
 
         logger.debug("Created job %s with cookie %s" % (repr(j), cookie))
 
@@ -570,92 +1347,267 @@ class JobCenter(object):
 
         return {"cookie": cookie, "job": j}
 
+    def submit_sharded(self, jobspec, shards, priority=None, submitter=None):
+        """Split the testsuite into shards, each shard is run by a job of
+        it's own. The shards run in parallel if the spec uses a host pool.
+        Returns the ShardedJob, which is started and reported as one job.
+
+        Args:
+            shards: The maximum number of shards
+        """
+        profile = jobspec.profile.get_name()
+        htype = None if isinstance(jobspec.host, main.HostPool) \
+            else host_type(jobspec.host)
+
+        def weight(testcase):
+            return self.expected_runtime(testcase, profile, htype)
+
+        jobs = []
+        for suite in jobspec.testsuite.shard(shards, weight):
+            spec = copy.copy(jobspec)
+            spec.testsuite = suite
+            if not isinstance(jobspec.host, main.HostPool):
+                # A host is bound to the session of one job, the shards
+                # run one after the other on their own copies of it
+                spec.host = copy.copy(jobspec.host)
+            jobs.append(self.submit(spec, priority=priority,
+                                    submitter=submitter)["job"])
+        sharded_job = ShardedJob(jobs[0].cookie + "-sharded",
+                                 jobspec.testsuite, jobs)
+        with _jobcenter_lock:
+            self.sharded_jobs[sharded_job.cookie] = sharded_job
+        self._next_version()
+        logger.info("Job %s got submitted in %d shards." %
+                    (sharded_job.cookie, len(jobs)))
+        return {"cookie": sharded_job.cookie, "job": sharded_job}
+
+    def expected_runtime(self, item, profile=None, host_type=None):
+        """The expected runtime of a testcase or testsuite
+        """
+        if isinstance(item, main.Testsuite):
+            return sum(self.expected_runtime(tc, profile, host_type)
+                       for tc in item.testcases())
+        if self.history is None:
+            return item.timeout
+        return self.history.expected_runtime(item.name, item.timeout,
+                                             profile, host_type)
+
+    @utils.synchronized(_jobcenter_lock)
+    def lookup(self, cookie):
+        """A job or a sharded job, None if there is no job with the cookie
+        """
+        return self.jobs.get(cookie, self.sharded_jobs.get(cookie))
+
     @utils.synchronized(_jobcenter_lock)
     def start_job(self, cookie):
-        self._queue_of_pending_jobs.append(cookie)
+        if cookie in self.sharded_jobs:
+            for job in self.sharded_jobs[cookie].jobs:
+                self.start_job(job.cookie)
+            return "Started job %s. %d in queue" % \
+                (cookie, len(self._queue_of_pending_jobs))
+        job = self.jobs[cookie]
+        self._queue_of_pending_jobs.put(cookie, job.priority, job.submitter)
+        self._worker.wakeup()
         return "Started job %s. %d in queue" % \
             (cookie, len(self._queue_of_pending_jobs))
 
+    @utils.synchronized(_jobcenter_lock)
+    def _job_state_changed(self, job):
+        """Called by a job whenever it's state changed
+        Jobs reaching an endstate are queued to be ended by the worker.
+        """
+        if job.reached_endstate() and not job._ended and \
+           job not in self._queue_of_finished_jobs:
+            self._queue_of_finished_jobs.append(job)
+        if self._worker:
+            self._worker.wakeup()
+        for plan in self._running_plans.values():
+            plan.wakeup()
+
     def _start_job(self, cookie):
-        job = self.jobs[cookie]
-        if job.host in self._pool_of_hosts_in_use:
-            raise Exception("The host is already in use: %s" % job.cookie)
-        self._pool_of_hosts_in_use.add(job.host)
+        """Setup and start a job, the host must already be reserved
+        This is run by the provisioning pool.
+        """
+        job = self._lookup_job(cookie)
+        assert job.host in self._pool_of_hosts_in_use, \
+            "The host was not reserved: %s" % job.cookie
 
+        self._run_hook("pre-job", cookie)
         logger.info("Job %s is beeing started." % cookie)
-        job.setup()
-        job.start()
+        try:
+            job.setup()
+            job.start()
+        except:
+            logger.exception("Job %s could not be started." % cookie)
+            job.state(s_failed)
+            raise
         logger.info("Job %s got started." % cookie)
 
         return "Started job %s (%s)." % (cookie, repr(job))
 
     @utils.synchronized(_jobcenter_lock)
+    def _lookup_job(self, cookie):
+        return self.jobs[cookie]
+
     def finish_test_step(self, cookie, step, is_success, note=None):
-        j = self.jobs[cookie]
+        j = self._lookup_job(cookie)
         j.finish_step(step, is_success, note)
         logger.info("Job %s finished step %s" % (cookie, step))
         return j
 
-    @utils.synchronized(_jobcenter_lock)
     def skip_step(self, cookie, step, note=None):
-        j = self.jobs[cookie]
+        j = self._lookup_job(cookie)
         j.finish_step(step, False, note, is_skipped=True)
         logger.info("Job %s skipped step %s" % (cookie, step))
         return j
 
-    @utils.synchronized(_jobcenter_lock)
     def test_step_result(self, cookie, step):
-        j = self.jobs[cookie]
+        j = self._lookup_job(cookie)
         return j.results[step]
 
-    @utils.synchronized(_jobcenter_lock)
     def abort_job(self, cookie):
         logger.debug("Aborting %s" % cookie)
-        j = self.jobs[cookie]
+        with _jobcenter_lock:
+            sharded_job = self.sharded_jobs.get(cookie)
+        if sharded_job:
+            for job in sharded_job.jobs:
+                if job.state() == s_running:
+                    job.abort()
+            logger.info("Job %s aborted." % (cookie))
+            return sharded_job
+        j = self._lookup_job(cookie)
         j.abort()
         logger.info("Job %s aborted." % (cookie))
         return j
 
     def _end_job(self, cookie):
-        job = self.jobs[cookie]
-        job.end()
-        if job.host not in self._pool_of_hosts_in_use:
-            logger.warning("The host was not in use: %s" % job.cookie)
-        self._pool_of_hosts_in_use.discard(job.host)
-        self.closed_jobs.append(job)
+        """Tear down a job and release it's host
+        This is run by the provisioning pool.
+        """
+        job = self._lookup_job(cookie)
+        self._run_hook("post-job", cookie)
+        try:
+            job.end()
+        except:
+            self._release_host(job)
+            raise
+        self._release_host(job, ended=True)
+        if self.history:
+            self.history.save()
         #del self.jobs[job]
         # cant poll the status if we remove the job from jobs
         logger.info("Job %s ended." % cookie)
         return "Ended job %s." % cookie
 
-    def submit_plan(self, plan):
-        if plan.name in self._running_plans:
-            raise Exception("Plan with same name already running: %s" %
-                            plan.name)
-        running_plan = JobCenter.PlanWorker(self, plan)
+    @utils.synchronized(_jobcenter_lock)
+    def _release_host(self, job, ended=False):
+        if job.host not in self._pool_of_hosts_in_use:
+            logger.warning("The host was not in use: %s" % job.cookie)
+        self._pool_of_hosts_in_use.discard(job.host)
+        if ended:
+            self.closed_jobs.append(job)
+            self._queue_of_ended_jobs.append(job)
+            self._next_version()
+        self._worker.wakeup()
+
+    def submit_plan(self, plan, variables=None, inventory=None,
+                    priority=None, submitter=None):
+        """Start a new run of a plan
+        Each run gets it's own copy of the plan, so the same plan can be
+        run multiple times at once, with different variables.
+
+        Args:
+            variables: The variables of this run
+            inventory: The inventory to lookup the items of the plan
+        """
+        # Fail early on invalid dependencies
+        plan.layout_dependencies()
+        with _jobcenter_lock:
+            run_id = "r" + utils.surl("%s%d" % (time.strftime("%Y%m%d%H%M%S"),
+                                                next(self._plan_run_ids)))
+            run = plan.new_run(run_id, variables, inventory)
+            running_plan = JobCenter.PlanWorker(self, run, priority,
+                                                submitter)
+            self._running_plans[run_id] = running_plan
         running_plan.start()
-        self._running_plans[plan.name] = running_plan
         return running_plan
 
-    def status_plan(self, name):
-        results = None
-        if name in self._running_plans:
-            results = self._running_plans[name].__to_dict__()
-        elif name in self._plan_results:
-            results = self._plan_results[name]
-        return results
+    def _plan_ended(self, running_plan):
+        # The dict takes the locks of the jobs, so build it before taking
+        # the lock of the jobcenter
+        self.__store_plan_result(running_plan.plan,
+                                 running_plan.__to_dict__())
+
+    @utils.synchronized(_jobcenter_lock)
+    def __store_plan_result(self, run, result):
+        if run.name not in self._plan_results:
+            self._plan_results[run.name] = collections.deque(
+                maxlen=self._plan_history)
+        self._plan_results[run.name].append(result)
+        del self._running_plans[run.run_id]
+
+    @utils.synchronized(_jobcenter_lock)
+    def _running_plan(self, name, run="latest"):
+        """The worker of a running plan run, or None
+        """
+        runs = sorted([p for p in self._running_plans.values()
+                       if p.plan.name == name],
+                      key=lambda p: p.created_at)
+        if run != "latest":
+            runs = [p for p in runs if p.plan.run_id == run]
+        return runs[-1] if runs else None
+
+    def _plan_run(self, name, run="latest"):
+        """The worker of a running run, or the status of an ended run
+        """
+        with _jobcenter_lock:
+            runs = [p for p in self._running_plans.values()
+                    if p.plan.name == name]
+            runs += list(self._plan_results.get(name, []))
+
+        def field(r, k):
+            return r[k] if type(r) is dict else getattr(r, k)
+        if run != "latest":
+            runs = [r for r in runs if field(r, "run_id") == run]
+        if not runs:
+            return None
+        return max(runs, key=lambda r: field(r, "created_at"))
 
-    def abort_plan(self, name):
-        if name not in self._running_plans:
+    def status_plan(self, name, run="latest"):
+        """The status of a run of a plan
+
+        Args:
+            run: The id of the run, or latest for the most recent run
+        """
+        run = self._plan_run(name, run)
+        # The jobs are locked when rendering, so do it outside the lock
+        return run if run is None or type(run) is dict else run.__to_dict__()
+
+    def status_plan_version(self, name, run="latest"):
+        """The run id and version of the status of a run, None if there
+        is no such run
+        """
+        run = self._plan_run(name, run)
+        if run is None:
+            return None
+        if type(run) is dict:
+            return (run["run_id"], run["version"])
+        return (run.run_id, run.version)
+
+    def abort_plan(self, name, run="latest"):
+        running_plan = self._running_plan(name, run)
+        if running_plan is None:
             #raise Exception("Plan is not running: %s" % name)
             return None
-        return self._running_plans[name].stop()
+        return running_plan.stop()
 
     def _run_hook(self, hook, cookie):
         allowed_hooks = ["pre-job", "post-job", "post-testcase",
                          "post-setup", "post-start", "post-annotate",
                          "post-end"]
         cmd_tpl = "{script} {hook} {cookie}"
+        if hook in allowed_hooks:
+            self.events.publish(hook, session=cookie)
         if hook in allowed_hooks and os.path.isdir(self.hooks_path):
             for scriptfile in os.listdir(self.hooks_path):
                 script = os.path.join(self.hooks_path, scriptfile)
@@ -667,6 +1619,10 @@ class JobCenter(object):
             logger.warning("Unknown hook: %s" % hook)
 
     class PlanWorker(threading.Thread):
+        """Runs the layouts of a plan
+        Up to max_parallel layouts of the plan are run at the same time, a
+        layout is started once all layouts it runs after have ended.
+        """
         jc = None
         plan = None
 
@@ -674,69 +1630,190 @@ class JobCenter(object):
 
         passed = False
         current_job = None
+        current_jobs = None
+        pending_layouts = None
         jobs = None
 
         status = None
 
+        priority = None
+        submitter = None
+
+        _version = 0
         _do_end = False
+        _wakeup = None
 
-        def __init__(self, jc, plan):
+        def __init__(self, jc, plan, priority=None, submitter=None):
             threading.Thread.__init__(self)
             self.daemon = True
 
             self.jc = jc
             self.plan = plan
+            self.priority = priority
+            self.submitter = submitter
             self.created_at = time.time()
             self.jobs = []
+            self.current_jobs = {}
+            self.pending_layouts = []
+            self._wakeup = threading.Event()
+
+        @property
+        def run_id(self):
+            return self.plan.run_id
+
+        @property
+        def version(self):
+            """The version of the last change of the run or of it's jobs
+            """
+            return max([self._version] + [j.version for j in self.jobs])
+
+        def _changed(self):
+            self._version = self.jc._next_version()
 
         def run(self):
             logger.debug("Starting plan %s" % self.plan.name)
             self.status = "running"
+            self._changed()
 
-            for jobspec in self.plan.job_specs():
-                resp = self.jc.submit(jobspec)
-                cookie, self.current_job = (resp["cookie"], resp["job"])
-                self.jc.start_job(cookie)
-                self.jobs.append(self.current_job)
-                self.current_job.wait()
+            failed = False
+            try:
+                self.__run_layouts()
+            except Exception:
+                logger.exception("Plan %s failed" % self.plan.name)
+                failed = True
+                self.stop()
+                self.__wait_for_current_jobs()
+            finally:
+                self.passed = not failed and not self.pending_layouts and \
+                    all([r.state() == s_passed for r in self.jobs])
+                self.status = "stopped"
+                self._changed()
+
+                self.jc._plan_ended(self)
+            logger.debug("Plan ended: %s" % self.plan.name)
 
-                if self._do_end:
-                    logger.debug("Plan stopped: %s" % self.plan.name)
-                    self.passed = False
-                    break
+        def __run_layouts(self):
+            self.plan.variables["planid"] = self.plan.id
+            layouts = self.plan.job_layouts
+            dependencies = self.plan.layout_dependencies()
+            max_parallel = max(1, int(self.plan.max_parallel))
+            self.pending_layouts = range(len(layouts))
+            pending = self.pending_layouts
+            ended = set()
 
-            self.passed = all([r.state() == s_passed
-                               for r in self.jobs])
-#            self.jobs.reverse()
-            self.status = "stopped"
+            while pending or self.current_jobs:
+                self._wakeup.clear()
 
-            self.jc._plan_results[self.plan.name] = self.__to_dict__()
-            del self.jc._running_plans[self.plan.name]
-            logger.debug("Plan ended: %s" % self.plan.name)
+                ended |= self.__reap_current_jobs()
+
+                if self._do_end:
+                    if not self.current_jobs:
+                        logger.debug("Plan stopped: %s" % self.plan.name)
+                        break
+                else:
+                    for idx in [i for i in pending
+                                if dependencies[i] <= ended]:
+                        if len(self.current_jobs) >= max_parallel:
+                            break
+                        pending.remove(idx)
+                        self.__start_layout(idx, layouts[idx])
+
+                if pending or self.current_jobs:
+                    self._wakeup.wait()
+
+        def __wait_for_current_jobs(self):
+            while self.current_jobs:
+                self._wakeup.clear()
+                self.__reap_current_jobs()
+                if self.current_jobs:
+                    self._wakeup.wait()
+
+        def __reap_current_jobs(self):
+            """Forget the current jobs which ended, the layout indices of them
+            are returned.
+            Once the run is stopped, jobs which were still queued when it got
+            stopped are aborted as soon as they are running.
+            """
+            ended = set()
+            for idx, job in self.current_jobs.items():
+                if job.reached_endstate():
+                    del self.current_jobs[idx]
+                    ended.add(idx)
+                elif self._do_end and job.state() == s_running:
+                    self.__abort(job)
+            return ended
+
+        def __abort(self, job):
+            try:
+                self.jc.abort_job(job.cookie)
+            except Exception as e:
+                logger.warning("Could not abort job %s of plan %s: %s" %
+                               (job.cookie, self.plan.name, e))
+
+        def __start_layout(self, idx, layout):
+            jobspec = self.plan.spec_from_layout(layout)
+            resp = self.jc.submit(jobspec, priority=self.priority,
+                                  submitter=self.submitter)
+            cookie, self.current_job = (resp["cookie"], resp["job"])
+            self.jobs.append(self.current_job)
+            self.jc.start_job(cookie)
+            self.current_jobs[idx] = self.current_job
+            self._changed()
+
+        def wakeup(self):
+            """Called whenever a job changed it's state
+            """
+            self._wakeup.set()
 
         def stop(self):
             logger.debug("Request to stop plan %s" % self.plan.name)
             self._do_end = True
-            if self.current_job:
-                self.jc.abort_job(self.current_job.cookie)
+            for job in self.current_jobs.values():
+                if job.state() == s_running:
+                    self.__abort(job)
+            self.wakeup()
             return self
 
         def runtime(self):
             return time.time() - self.created_at
 
+        def eta(self):
+            """The expected time until the plan ends
+            The pending layouts are assumed to run max_parallel at a time.
+            """
+            if self.status == "stopped":
+                return 0
+            pending = 0
+            for idx in list(self.pending_layouts):
+                suite = self.plan.layout_testsuite(self.plan.job_layouts[idx])
+                if suite:
+                    pending += self.jc.expected_runtime(suite)
+            running = [j.eta() for j in self.current_jobs.values()]
+            return max(running or [0]) + \
+                pending / max(1, int(self.plan.max_parallel))
+
         def __to_dict__(self):
             return {
                 "plan": self.plan.__to_dict__(),
+                "run_id": self.plan.run_id,
                 "jobs": [r.__to_dict__() for r in self.jobs],
                 "current_job_cookie": self.current_job.cookie
                 if self.current_job else "",
+                "current_job_cookies": [j.cookie for j
+                                        in self.current_jobs.values()],
                 "passed": self.passed,
+                "version": self.version,
                 "runtime": self.runtime(),
+                "eta": self.eta(),
                 "created_at": self.created_at,
                 "status": self.status
             }
 
     class JobWorker(utils.PollingWorkerDaemon):
+        """Starts pending and ends finished jobs
+        The worker is woken up by the JobCenter on relevant events, the
+        interval is just a fallback for the cleanup of old jobs.
+        """
         jc = None
         cleanup_age = None
         max_cleaned_jobs = 10
@@ -747,38 +1824,96 @@ class JobCenter(object):
             utils.PollingWorkerDaemon.__init__(self)
 
         def work(self):
-            if len(self.jc._queue_of_pending_jobs) == 0:
-                # No item
-                pass
-            else:
-                # FIXME this doesn't respect the order
-                for cookie in self.jc._queue_of_pending_jobs:
-                    candidate = self.jc.jobs[cookie]
-                    logger.debug("Checking if host is in use: %s" %
-                                 candidate.host)
-                    if candidate.host in self.jc._pool_of_hosts_in_use:
+            # Setup and teardown can take long, so they are run by the
+            # provisioning pool. A host stays reserved until the teardown
+            # of it's job is done.
+            for job in self._pop_finished_jobs():
+                self._debug("Unwinding job %s" % job.cookie)
+                self.jc._provisioning_pool.submit(self.jc._end_job,
+                                                  job.cookie)
+
+            for cookie in self._startable_jobs():
+                self._debug("Starting job %s" % cookie)
+                self.jc._provisioning_pool.submit(self.jc._start_job,
+                                                  cookie)
+
+            oldest_job = self._pop_oldest_job()
+            while oldest_job is not None:
+                self._debug("Cleaning job %s" % oldest_job.cookie)
+                oldest_job.clean()
+                logger.info("Job %s cleaned and removed." % oldest_job.cookie)
+                oldest_job = self._pop_oldest_job()
+
+        @utils.synchronized(_jobcenter_lock)
+        def _pop_finished_jobs(self):
+            jobs = self.jc._queue_of_finished_jobs
+            self.jc._queue_of_finished_jobs = []
+            return jobs
+
+        def _startable_jobs(self):
+            """Removes and returns the pending jobs whose host is free
+            The hosts of the returned jobs are reserved, jobs submitted
+            against a host pool get bound to a free host of the pool.
+            The order of the queue is respected.
+            """
+            with _jobcenter_lock:
+                candidates = [self.jc.jobs[cookie] for cookie
+                              in self.jc._queue_of_pending_jobs.ordered()]
+
+            # The hosts of a pool come from the index of the inventory, a
+            # pool which can not be looked up just does not start jobs
+            pools = {}
+            for candidate in candidates:
+                if candidate.host is None:
+                    pool = candidate.host_pool
+                    if pool.get_name() in pools:
+                        continue
+                    try:
+                        pools[pool.get_name()] = pool.candidates()
+                    except Exception as e:
+                        logger.warning("Failed to look up the hosts of " +
+                                       "pool %s: %s" % (pool.get_name(), e))
+                        pools[pool.get_name()] = []
+
+            cookies = []
+            with _jobcenter_lock:
+                # Origins can return new objects for the same host on each
+                # lookup, so the hosts are compared by name
+                names_in_use = set(h.get_name()
+                                   for h in self.jc._pool_of_hosts_in_use)
+                for candidate in candidates:
+                    host = candidate.host
+                    if host is None:
+                        host = self.__first_free_host(
+                            pools[candidate.host_pool.get_name()],
+                            names_in_use)
+                    if host is None or host.get_name() in names_in_use:
                         self._debug("Host of candidate %s is still in use" %
-                                    cookie)
-                    else:
-                        self._debug("Starting job %s" % cookie)
-                        self.jc._run_hook("pre-job", cookie)
-                        self.jc._start_job(cookie)
-                        self.jc._queue_of_pending_jobs.remove(cookie)
-
-            # Look for ended jobs
-            for cookie, j in self.jc.jobs.items():
-                if j.reached_endstate():
-                    if not j._ended:
-                        self._debug("Unwinding job %s" % cookie)
-                        self.jc._run_hook("post-job", cookie)
-                        self.jc._end_job(j.cookie)
-                        self.jc._queue_of_ended_jobs.append(j)
-
-            while len(self.jc._queue_of_ended_jobs) > self.max_cleaned_jobs:
-                self._remove_oldest_job()
-
-        def _remove_oldest_job(self):
+                                    candidate.cookie)
+                        continue
+                    if candidate.host is None:
+                        candidate.bind_host(host)
+                    self.jc._pool_of_hosts_in_use.add(host)
+                    names_in_use.add(host.get_name())
+                    cookies.append(candidate.cookie)
+                    self.jc._queue_of_pending_jobs.remove(candidate.cookie)
+            return cookies
+
+        @staticmethod
+        def __first_free_host(hosts, names_in_use):
+            for host in hosts:
+                if host.get_name() not in names_in_use:
+                    return host
+            return None
+
+        @utils.synchronized(_jobcenter_lock)
+        def _pop_oldest_job(self):
+            """Removes and returns the oldest ended job, if there are too
+            many ended jobs
+            """
             oldest_job = None
+            if len(self.jc._queue_of_ended_jobs) <= self.max_cleaned_jobs:
+                return oldest_job
 
             for job in self.jc._queue_of_ended_jobs:
                 if oldest_job is None \
@@ -787,8 +1922,10 @@ class JobCenter(object):
                     oldest_job = job
 
             if oldest_job is not None:
-                self._debug("Cleaning job %s" % oldest_job.cookie)
-                oldest_job.clean()
                 self.jc._queue_of_ended_jobs.remove(oldest_job)
                 del self.jc.jobs[oldest_job.cookie]
-                logger.info("Job %s cleaned and removed." % oldest_job.cookie)
+                sharded_job = oldest_job.shard_of
+                if sharded_job and not any(j.cookie in self.jc.jobs
+                                           for j in sharded_job.jobs):
+                    del self.jc.sharded_jobs[sharded_job.cookie]
+            return oldest_job
@@ -23,12 +23,18 @@ The main module of igor, specifying the model.
 """
 
 from igor import log
+from igor.daemon import compression
 from igor.utils import run, update_properties_only
+import copy
+import hashlib
 import io
+import multiprocessing.pool
 import os
 import random
+import re
 import tarfile
 import tempfile
+import threading
 import time
 
 
@@ -55,6 +61,8 @@ class Host(UpdateableObject):
     """
     session = None
     origin = None
+    # Names of the host pools this host belongs to
+    pools = []
 
     def prepare(self):
         """Prepare a host until the point where a testsuite can be submitted.
@@ -89,7 +97,63 @@ class Host(UpdateableObject):
 
     def __to_dict__(self):
         return {"name": self.get_name(),
-                "origin": self.origin}
+                "origin": self.origin,
+                "pools": self.pools}
+
+
+class HostPool(object):
+    """A named group of equivalent hosts.
+    Jobs can be submitted against a pool, a job is bound to the first free
+    host of the pool when it is started.
+    """
+    name = None
+    _hosts = None
+
+    def __init__(self, name, hosts):
+        """
+        Args:
+            name: The name of the pool
+            hosts: A callback returning a dict (name, host) of all hosts
+        """
+        self.name = name
+        self._hosts = hosts
+
+    def get_name(self):
+        return self.name
+
+    def candidates(self):
+        """All hosts in this pool, ordered by their name
+
+        >>> class NamedHost(Host):
+        ...     def get_name(self):
+        ...         return self.name
+        >>> hosts = {"b": NamedHost(name="b", pools=["x86"]),
+        ...          "a": NamedHost(name="a", pools=["x86", "big"]),
+        ...          "c": NamedHost(name="c")}
+        >>> [h.get_name() for h in HostPool("x86", lambda: hosts).candidates()]
+        ['a', 'b']
+        """
+        return sorted([host for host in self._hosts().values()
+                       if self.name in host.pools],
+                      key=lambda host: host.get_name())
+
+    def __to_dict__(self):
+        return {"name": self.name,
+                "hosts": [host.get_name() for host in self.candidates()]}
+
+
+def pools_for(name, pool_patterns):
+    """The pools a host belongs to, according to a mapping of pool names to
+    host name patterns
+
+    >>> patterns = {"x86": ["igor-x86-.*"], "any": [".*"]}
+    >>> pools_for("igor-x86-01", patterns)
+    ['any', 'x86']
+    >>> pools_for("igor-arm-01", patterns)
+    ['any']
+    """
+    return sorted(pool for pool, patterns in (pool_patterns or {}).items()
+                  if any(re.match("^%s$" % p, name) for p in patterns))
 
 
 class Profile(UpdateableObject):
@@ -127,6 +191,15 @@ class Profile(UpdateableObject):
 
 
 class Origin(object):
+    """A source of items, like hosts or profiles
+    The inventory caches the items of an origin for cache_ttl seconds, 0
+    disables the caching and None caches the items until the origin
+    reports a change with changed().
+    """
+    cache_ttl = 0
+
+    _change_listeners = None
+
     def name(self):
         raise Exception("Not implemented.")
 
@@ -149,6 +222,17 @@ class Origin(object):
         """
         raise Exception("Not implemented.")
 
+    def add_change_listener(self, cb):
+        """cb(origin) is called when the items of this origin changed
+        """
+        if self._change_listeners is None:
+            self._change_listeners = []
+        self._change_listeners.append(cb)
+
+    def changed(self):
+        for cb in self._change_listeners or []:
+            cb(self)
+
     def __to_dict__(self):
         return {"name": self.name()}
 
@@ -157,9 +241,28 @@ class Inventory(object):
     """Is a central repository for Igor related items.
     This inventory can be used to lookup *existsing* items.
     Use a factory to create the objects, or pass a Factory as a callback.
+
+    The items of all origins are kept in an index by name, an origin is
+    only asked again when it's items expired (see Origin.cache_ttl), when
+    it reported a change, or when the index was invalidated.
+    Unknown names are remembered for negative_ttl seconds.
+
+    The origins are asked concurrently, an origin which does not answer
+    within origin_timeout seconds is marked unhealthy and it's previous
+    items are used. health() reports the state of each origin.
     """
 
+    negative_ttl = 5
+    origin_timeout = 30
+
     _origins = None
+    _index = None
+    _fetched = None
+    _unknown = None
+    _found = None
+    _health = None
+    _refreshing = None
+    _lock = None
 
     def __init__(self, plans={}, testsuites={}, profiles={}, hosts={}):
         """Each parameter is a list of callbacks to list all items of that
@@ -186,6 +289,73 @@ class Inventory(object):
         >>> i = Inventory(testsuites={"fs": f})
         >>> "examplesuite" in i.testsuites()
         True
+
+        Origins with a cache_ttl are only asked once for their items:
+        >>> calls = []
+        >>> def items():
+        ...     calls.append(1)
+        ...     return {"item-a": "a"}
+        >>> f = Origin()
+        >>> f.items = items
+        >>> f.cache_ttl = 60
+        >>> i = Inventory(plans={"a": f})
+        >>> i.plans("item-a"), i.plans("item-a"), i.plans("item-x"), len(calls)
+        ('a', 'a', None, 1)
+
+        Until they report a change, or the inventory is invalidated:
+        >>> f.changed()
+        >>> i.plans("item-a"), len(calls)
+        ('a', 2)
+        >>> i.invalidate("plans")
+        >>> i.plans(), len(calls)
+        ({'item-a': 'a'}, 3)
+
+        Origins which implement lookup() are asked for single items, as
+        long as their items were not listed:
+        >>> class LookupOrigin(Origin):
+        ...     cache_ttl = 60
+        ...     def lookup(self, name):
+        ...         calls.append(name)
+        ...         return name.upper() if name.startswith("item") else None
+        >>> i = Inventory(plans={"l": LookupOrigin()})
+        >>> calls = []
+        >>> i.plans("item-a"), i.plans("item-a"), i.plans("x"), calls
+        ('ITEM-A', 'ITEM-A', None, ['item-a', 'x'])
+
+        Items created after their origin was listed are looked up:
+        >>> class ListingOrigin(LookupOrigin):
+        ...     def items(self):
+        ...         return {"item-a": "A"}
+        >>> i = Inventory(hosts={"l": ListingOrigin()})
+        >>> sorted(i.hosts()), i.hosts("item-new")
+        (['item-a'], 'ITEM-NEW')
+
+        A slow or failing origin does not block the other origins:
+        >>> import threading
+        >>> slow, broken = Origin(), Origin()
+        >>> answer = threading.Event()
+        >>> def slow_items():
+        ...     answer.wait()
+        ...     return {"item-s": "s"}
+        >>> def broken_items():
+        ...     raise RuntimeError("unreachable")
+        >>> slow.items, broken.items = slow_items, broken_items
+        >>> i = Inventory(hosts={"a": f, "slow": slow, "broken": broken})
+        >>> i.origin_timeout = 0.1
+        >>> i.hosts()
+        {'item-a': 'a'}
+        >>> health = i.health("hosts")
+        >>> [(n, health[n]["healthy"], health[n]["error"])
+        ...  for n in sorted(health)]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [('a', True, None), ('broken', False, 'unreachable'),
+         ('slow', False, 'Timed out after 0.1s')]
+        >>> answer.set()
+        >>> i.origin_timeout = 30
+        >>> sorted(i.hosts())
+        ['item-a', 'item-s']
+        >>> i.health("hosts")["slow"]["healthy"]
+        True
         """
         self._origins = {
             "plans": {},
@@ -193,6 +363,13 @@ class Inventory(object):
             "profiles": {},
             "hosts": {}
         }
+        self._index = dict((k, {}) for k in self._origins)
+        self._fetched = dict((k, {}) for k in self._origins)
+        self._unknown = dict((k, {}) for k in self._origins)
+        self._found = dict((k, {}) for k in self._origins)
+        self._health = dict((k, {}) for k in self._origins)
+        self._refreshing = {}
+        self._lock = threading.RLock()
         key_to_origin = [("plans", plans), ("testsuites", testsuites),
                          ("profiles", profiles), ("hosts", hosts)]
         for (k, origins) in key_to_origin:
@@ -205,32 +382,173 @@ class Inventory(object):
 #                raise Exception(("Invalid %s origin '%s': '%s'") % (k, \
 #                                                               name, origin))
             self._origins[k][name] = origin
+            if hasattr(origin, "add_change_listener"):
+                origin.add_change_listener(self._origin_changed)
+
+    def _origin_changed(self, origin):
+        for k, origins in self._origins.items():
+            for name, o in origins.items():
+                if o is origin:
+                    self.invalidate(k, name)
+
+    def invalidate(self, k=None, oname=None):
+        """Forget the items of all origins, of all origins of a category or
+        just of one origin
+        """
+        logger.debug("Invalidating inventory: %s %s" % (k, oname))
+        with self._lock:
+            for key in [k] if k else self._origins.keys():
+                for name in self._fetched[key].keys():
+                    if oname in [None, name]:
+                        del self._fetched[key][name]
+                for q, found in self._found[key].items():
+                    if oname in [None, found[0]]:
+                        del self._found[key][q]
+                self._unknown[key] = {}
+
+    def _is_fresh(self, k, oname, now):
+        fetched_at = self._fetched[k].get(oname)
+        if fetched_at is None:
+            return False
+        ttl = getattr(self._origins[k][oname], "cache_ttl", 0)
+        return ttl is None or now - fetched_at < ttl
+
+    def _set_health(self, k, oname, error=None):
+        with self._lock:
+            self._health[k][oname] = {"healthy": error is None,
+                                      "error": error,
+                                      "updated_at": time.time()}
+
+    def health(self, k=None):
+        """The health of the origins of a category, or of all categories
+        """
+        with self._lock:
+            if k is not None:
+                return copy.deepcopy(self._health[k])
+            return copy.deepcopy(self._health)
 
-    def _items(self, k):
-        """Retrieves all items from all origins
+    def _refresh(self, k, oname):
+        """Retrieves all items of an origin and puts them into the index
         """
-        all_items = {}
-        for name, origin in self._origins[k].items():
-            items = origin.items()
-            for item in items:
-                if item in all_items:
-                    raise Exception(("Item name is not unique over all %s " +
-                                     "origins: %s") % (k, item))
+        try:
+            items = self._origins[k][oname].items()
             if type(items) is not dict:
                 raise Exception("%s did not return a dict." % k)
-            all_items.update(items)
-        return all_items
+            with self._lock:
+                index = self._index[k]
+                for item in items:
+                    if item in index and index[item][0] != oname:
+                        raise Exception(("Item name is not unique over all " +
+                                         "%s origins: %s") % (k, item))
+                for item, (o, _) in index.items():
+                    if o == oname:
+                        del index[item]
+                index.update((item, (oname, obj))
+                             for item, obj in items.items())
+                for q, found in self._found[k].items():
+                    if found[0] == oname:
+                        del self._found[k][q]
+                self._fetched[k][oname] = time.time()
+                self._unknown[k] = {}
+            self._set_health(k, oname)
+        except Exception as e:
+            logger.warning("Failed to retrieve the %s of origin %s: %s" %
+                           (k, oname, e))
+            self._set_health(k, oname, str(e))
+        finally:
+            with self._lock:
+                del self._refreshing[(k, oname)]
+
+    def _refresh_stale(self, k, onames, wait=True):
+        """Refreshes the stale origins concurrently, waits at most
+        origin_timeout seconds for them (if wait is True)
+        """
+        now = time.time()
+        threads = []
+        with self._lock:
+            for oname in onames:
+                if self._is_fresh(k, oname, now):
+                    continue
+                thread = self._refreshing.get((k, oname))
+                if thread is None:
+                    thread = threading.Thread(target=self._refresh,
+                                              args=(k, oname),
+                                              name="refresh-%s-%s" %
+                                                   (k, oname))
+                    thread.daemon = True
+                    self._refreshing[(k, oname)] = thread
+                    thread.start()
+                threads.append((oname, thread))
+        if not wait:
+            return
+        deadline = now + self.origin_timeout
+        for oname, thread in threads:
+            thread.join(max(0, deadline - time.time()))
+            if thread.is_alive():
+                logger.warning("Origin %s of %s timed out" % (oname, k))
+                self._set_health(k, oname, "Timed out after %ss" %
+                                 self.origin_timeout)
+
+    def _items(self, k, wait=True):
+        """Retrieves all items from all origins, without wait the items
+        indexed so far, stale origins are refreshed in the background
+        """
+        self._refresh_stale(k, self._origins[k].keys(), wait)
+        with self._lock:
+            return {item: copy.copy(obj)
+                    for item, (_, obj) in self._index[k].items()}
 
     def _lookup(self, k, q=None):
         logger.debug("Looking up %s: %s" % (k, q))
         if q is None:
             return self._items(k)
-        item = None
-        for name, origin in self._origins[k].items():
-            item = origin.lookup(q)
-            if item is not None:
-                break
-        return item
+        now = time.time()
+        with self._lock:
+            unknown_since = self._unknown[k].get(q)
+        if unknown_since is not None and now - unknown_since < \
+                self.negative_ttl:
+            return None
+        for oname, origin in sorted(self._origins[k].items()):
+            ttl = getattr(origin, "cache_ttl", 0)
+            if ttl == 0:
+                item = origin.lookup(q)
+                if item is not None:
+                    return item
+                continue
+            if not self._is_fresh(k, oname, now) and \
+                    self._has_own_lookup(origin):
+                with self._lock:
+                    found = self._found[k].get(q)
+                if found is None or found[0] != oname or \
+                        (ttl is not None and now - found[2] >= ttl):
+                    item = origin.lookup(q)
+                    if item is None:
+                        continue
+                    found = (oname, item, now)
+                    with self._lock:
+                        self._found[k][q] = found
+                return copy.copy(found[1])
+            self._refresh_stale(k, [oname])
+            with self._lock:
+                entry = self._index[k].get(q)
+            if entry is not None and entry[0] == oname:
+                return copy.copy(entry[1])
+            if self._has_own_lookup(origin):
+                # Items created after the listing are not indexed yet
+                item = origin.lookup(q)
+                if item is not None:
+                    return item
+        with self._lock:
+            self._unknown[k][q] = now
+        return None
+
+    @staticmethod
+    def _has_own_lookup(origin):
+        """Whether the origin can look up a single item without listing all
+        it's items
+        """
+        lookup = getattr(type(origin), "lookup", None)
+        return getattr(lookup, "im_func", None) is not Origin.lookup.im_func
 
     def plans(self, q=None):
         return self._lookup("plans", q)
@@ -244,6 +562,41 @@ class Inventory(object):
     def hosts(self, q=None):
         return self._lookup("hosts", q)
 
+    def indexed_hosts(self):
+        """The hosts indexed so far, without waiting for any origin
+        """
+        return self._items("hosts", wait=False)
+
+    def host_pools(self, q=None):
+        """The pools formed by the pools property of all hosts
+        The hosts of a pool are taken from the index, so the scheduler does
+        not wait for the origins.
+
+        >>> class NamedHost(Host):
+        ...     def get_name(self):
+        ...         return "h"
+        >>> class Slow(Origin):
+        ...     cache_ttl = 0.1
+        ...     def items(self):
+        ...         time.sleep(0.5)
+        ...         return {"h": NamedHost(pools=["p"])}
+        >>> i = Inventory(hosts={"slow": Slow()})
+        >>> pool = i.host_pools("p")
+        >>> time.sleep(0.2)
+        >>> begin = time.time()
+        >>> len(pool.candidates()), time.time() - begin < 0.2
+        (1, True)
+        """
+        names = set(pool for host in self.hosts().values()
+                    for pool in host.pools)
+        pools = {name: HostPool(name, self.indexed_hosts) for name in names}
+        return pools if q is None else pools.get(q)
+
+    def host_or_pool(self, q):
+        """Lookup a host, or a host pool if no host has the name q
+        """
+        return self.hosts(q) or self.host_pools(q)
+
     def check(self):
         logger.debug("Self checking invetory …")
         ps = self.plans()
@@ -291,26 +644,53 @@ class Testplan(object):
     ----------
     job_layouts : List of tuples
         A list of (testsuite, profile, host, kargs) tuples to be run.
+        A layout can have an id, and list the ids of the layouts it needs
+        to run after in after.
+
+    max_parallel : int
+        The maximum number of layouts run at the same time
 
     variables : A dict of (string, string)
         A dict to be used with format on the layout values
 
     inventory : An Inventory
         A pointer to an inventory to lookup the objects
+
+    run_id : string
+        The id of a run of this plan, see new_run
     """
     name = None
     description = None
     job_layouts = None
     variables = None
     inventory = None
+    max_parallel = 1
+    run_id = None
 
     def __init__(self, name, job_layouts, inventory=None):
         self.name = name
         self.job_layouts = job_layouts
-        self.inventory = None
+        self.inventory = inventory
         self.variables = {}
         self.id = random.randrange(10**2, 10**4)  # FIXME make jobs!
 
+    def new_run(self, run_id, variables=None, inventory=None):
+        """A copy of this plan, to be run with it's own variables
+        The run id is also used as the planid variable.
+
+        >>> p = Testplan("p", [{"host": "{h}"}])
+        >>> r = p.new_run("r1", {"h": "a"})
+        >>> r.run_id, r.id, r.variables, p.variables
+        ('r1', 'r1', {'h': 'a'}, {})
+        """
+        run = copy.copy(self)
+        run.run_id = run.id = run_id
+        run.variables = dict(variables or {})
+        run.job_layouts = copy.deepcopy(self.job_layouts)
+        if inventory is not None:
+            run.inventory = inventory
+        return run
+
     def timeout(self):
         timeout = None
         if self.inventory:
@@ -337,19 +717,69 @@ class Testplan(object):
             """
             yield self.spec_from_layout(layout)
 
+    def layout_dependencies(self):
+        """The indices of the layouts each layout needs to run after
+
+        >>> p = Testplan("p", [{"id": "a"}, {"after": "a"},
+        ...                    {"after": ["a", "d"]}, {"id": "d"}])
+        >>> p.layout_dependencies()
+        [set([]), set([0]), set([0, 3]), set([])]
+
+        >>> Testplan("p", [{"after": "x"}]).layout_dependencies()
+        Traceback (most recent call last):
+        ...
+        RuntimeError: Layout #0 of plan p runs after unknown layout 'x'
+
+        >>> p = Testplan("p", [{"id": "a", "after": "b"},
+        ...                    {"id": "b", "after": "a"}])
+        >>> p.layout_dependencies()
+        Traceback (most recent call last):
+        ...
+        RuntimeError: The layouts of plan p have cyclic dependencies
+        """
+        ids = {}
+        for idx, layout in enumerate(self.job_layouts):
+            if "id" in layout:
+                if layout["id"] in ids:
+                    raise RuntimeError(("Layout id '%s' is not unique in " +
+                                        "plan %s") % (layout["id"], self.name))
+                ids[layout["id"]] = idx
+
+        dependencies = []
+        for idx, layout in enumerate(self.job_layouts):
+            after = layout.get("after", [])
+            if type(after) is not list:
+                after = [after]
+            for dep in after:
+                if dep not in ids:
+                    raise RuntimeError(("Layout #%d of plan %s runs after " +
+                                        "unknown layout '%s'") %
+                                       (idx, self.name, dep))
+            dependencies.append(set(ids[dep] for dep in after))
+
+        resolved = set()
+        while len(resolved) < len(dependencies):
+            ready = set(idx for idx, deps in enumerate(dependencies)
+                        if deps <= resolved) - resolved
+            if not ready:
+                raise RuntimeError(("The layouts of plan %s have cyclic " +
+                                    "dependencies") % self.name)
+            resolved |= ready
+
+        return dependencies
+
     def spec_from_layout(self, layout):
+        """Creates a spec for a layout, the layout is not modified
+        """
         spec = JobSpec()
         logger.debug("Creating spec for job layout '%s'" % layout)
         for k, func in [("testsuite", self.inventory.testsuites),
                         ("profile", self.inventory.profiles),
-                        ("host", self.inventory.hosts),
+                        ("host", self.inventory.host_or_pool),
                         ("additional_kargs", lambda x: x)]:
-            kwargs = {}
+            v, kwargs = "", {}
             if k in layout and layout[k] is not None:
                 v, kwargs = self._parse_toplevel_field_value(k, layout[k])
-                layout[k] = v
-            else:
-                layout[k] = ""
 
             logger.debug("Handling top-level item '%s', with kwargs '%s'" %
                          (k, kwargs))
@@ -364,6 +794,17 @@ class Testplan(object):
             spec.update_props(props)
         return spec
 
+    def layout_testsuite(self, layout):
+        """The testsuite of a layout, None if it can not be looked up yet
+        """
+        try:
+            name, _ = self._parse_toplevel_field_value("testsuite",
+                                                       layout["testsuite"])
+            return self.inventory.testsuites(name)
+        except Exception as e:
+            logger.debug("No testsuite for layout %s: %s" % (layout, e))
+        return None
+
     def _parse_toplevel_field_value(self, key, value):
         """Parses the value of a top-level testplan value
 
@@ -403,6 +844,8 @@ class Testplan(object):
         return {"name": self.name,
                 "description": self.description,
                 "job_layouts": self.job_layouts,
+                "max_parallel": self.max_parallel,
+                "run_id": self.run_id,
                 "timeout": self.timeout()
                 }
 
@@ -448,6 +891,63 @@ class Testsuite(object):
         """
         return sum([int(c.timeout) for c in self.testcases()])
 
+    def shard(self, n, weight=None):
+        """Splits this suite into up to n suites of consecutive testcases.
+        The shards are balanced by the weight of their testcases, which
+        defaults to the timeout of a testcase. The order of the testcases is
+        kept, so the steps of each shard start at 0.
+
+        >>> suite = Testsuite("s", [Testset("a", ["1", "2"]),
+        ...                         Testset("b", ["3", "4", "5"])])
+        >>> for tc, t in zip(suite.testcases(), [10, 10, 30, 5, 5]):
+        ...     tc.timeout = t
+        >>> shards = suite.shard(2)
+        >>> [[tc.name for tc in s.testcases()] for s in shards]
+        [['1', '2'], ['3', '4', '5']]
+        >>> [(s.name, s.timeout()) for s in shards]
+        [('s-shard0', 20), ('s-shard1', 40)]
+        >>> [[tc.name for tc in s.testcases()] for s in suite.shard(3)]
+        [['1', '2'], ['3'], ['4', '5']]
+        >>> [t.name for t in suite.shard(3)[0].testsets]
+        ['a']
+        >>> len(suite.shard(10))
+        5
+
+        The archive of a shard just contains it's own testcases:
+
+        >>> from igor.daemon.backends import files
+        >>> suites = files.Factory.testsuites_from_path("testcases/suites/")
+        >>> shard = suites["examplesuite"].shard(2)[1]
+        >>> archive = io.BytesIO(shard.get_archive().getvalue())
+        >>> names = tarfile.open(fileobj=archive, mode="r").getnames()
+        >>> deps = set(n for n in names if n.endswith(".deps"))
+        >>> deps == set("testcases/%d-%s.deps" % (step, tc.name)
+        ...             for step, tc in enumerate(shard.testcases()))
+        True
+        """
+        weight = weight or (lambda testcase: float(testcase.timeout))
+        pieces = []
+        for tset in self.testsets:
+            pieces += [(tset, tc) for tc in tset.testcases()]
+
+        shards = []
+        start = 0
+        for length in _balanced_split([weight(tc) for _, tc in pieces], n):
+            testsets = []
+            for tset, tc in pieces[start:start + length]:
+                if not testsets or testsets[-1][0] is not tset:
+                    testsets.append((tset, []))
+                testsets[-1][1].append(tc)
+            start += length
+
+            shard = Testsuite("%s-shard%d" % (self.name, len(shards)),
+                              [Testset(tset.name, tcs, dict(tset.libs()))
+                               for tset, tcs in testsets])
+            shard.origin = self.origin
+            shard.description = self.description
+            shards.append(shard)
+        return shards
+
     def __str__(self):
         testsets_str = "\n".join([str(ts) for ts in self.testsets])
         return "Suite: %s\nTestsets:\n%s" % (self.name, testsets_str)
@@ -462,7 +962,9 @@ class Testsuite(object):
                 "description": self.description
                 }
 
-    def get_archive(self, subdir="testcases"):
+    def get_archive(self, subdir="testcases",
+                    compression_format=compression.DEFAULT_FORMAT,
+                    level=None):
         """Creates an archive containing all testcases and optional testcase
         connected dirs.
         Each testcase is prefixed with the step it has in the testsuite, this
@@ -494,17 +996,43 @@ class Testsuite(object):
         True
         >>> any([re.match("testcases/lib/", n) for n in tarball.getnames()])
         True
+        >>> names = [e[0] for e in suite.archive_entries()]
+        >>> names == tarball.getnames()
+        True
+
+        The archive can also be compressed differently:
+        >>> archive = io.BytesIO(suite.get_archive(compression_format="gz",
+        ...                                        level=1).getvalue())
+        >>> tarfile.open(fileobj=archive, mode="r:gz").getnames() == names
+        True
         """
         r = io.BytesIO()
-        logger.debug("Preparing archive for testsuite %s" % self.name)
-        with tarfile.open(fileobj=r, mode="w:bz2") as archive:
-            self.__add_testcases_to_archive(archive, subdir)
-            self.__add_libs_to_archive(archive, os.path.join(subdir, "lib"))
+        self.write_archive(r, subdir, compression_format, level)
         r.flush()
         return r
 
-    def __add_testcases_to_archive(self, archive, subdir):
-        """Add many testcases to the archive
+    def write_archive(self, fileobj, subdir="testcases",
+                      compression_format=compression.DEFAULT_FORMAT,
+                      level=None, selection=None):
+        """Writes the archive (see get_archive) to a file object
+        A selection of member names limits the archive to those members.
+        """
+        logger.debug("Preparing archive for testsuite %s" % self.name)
+        with compression.CompressingWriter(fileobj, compression_format,
+                                           level) as writer:
+            with tarfile.open(fileobj=writer, mode="w|") as archive:
+                for arcname, filename, data in self.archive_entries(subdir):
+                    if selection is not None and arcname not in selection:
+                        continue
+                    if filename is None:
+                        self.__add_data_to_archive(archive, arcname, data)
+                    else:
+                        archive.add(filename, arcname=arcname,
+                                    recursive=False)
+
+    def archive_entries(self, subdir="testcases"):
+        """Yields the (arcname, filename, data) of each archive member, a
+        member has either the filename of it's source or it's data
         """
         stepn = 0
         for testcase in self.testcases():
@@ -517,29 +1045,40 @@ class Testsuite(object):
             arcname = os.path.join(subdir, "%d-%s" %
                                    (stepn,
                                    os.path.basename(testcase.filename)))
-            self.__add_testcase_to_archive(archive, arcname, testcase)
+            for entry in self.__testcase_entries(arcname, testcase):
+                yield entry
             stepn += 1
 
-    def __add_testcase_to_archive(self, archive, arcname, testcase):
-        """Add a single testcase to the archive
-        And testcase specififc metadata files
+        for entry in self.__lib_entries(os.path.join(subdir, "lib")):
+            yield entry
+
+    def __testcase_entries(self, arcname, testcase):
+        """The testcase itself and testcase specififc metadata files
         """
-        # Add the testcase itself
-        self.__add_data_to_archive(archive, arcname, testcase.source())
+        yield (arcname, None, testcase.source())
 
-        # Add a file with testcase dependencies
+        # A file with testcase dependencies
         arcdepsname = arcname + ".deps"
         dependencies = "\n".join(testcase.dependencies)
-        self.__add_data_to_archive(archive, arcdepsname,
-                                   "\n".join(dependencies))
+        yield (arcdepsname, None, "\n".join(dependencies))
 
-        # Add a testcase extra dir
+        # A testcase extra dir
         testcaseextradir = testcase.filename + ".d"
         if os.path.exists(testcaseextradir):
             logger.debug("Adding extra dir: %s" % testcaseextradir)
-            arcname += ".d"
-            archive.add(testcaseextradir, arcname=arcname,
-                        recursive=True)
+            for entry in self.__tree_entries(testcaseextradir,
+                                             arcname + ".d"):
+                yield entry
+
+    def __tree_entries(self, path, arcname):
+        """A path and - if it is a dir - everything below it
+        """
+        yield (arcname, path, None)
+        if os.path.isdir(path) and not os.path.islink(path):
+            for name in sorted(os.listdir(path)):
+                for entry in self.__tree_entries(os.path.join(path, name),
+                                                 os.path.join(arcname, name)):
+                    yield entry
 
     def __add_data_to_archive(self, archive, arcname, data):
         """Adds data as a file to an archive
@@ -550,8 +1089,9 @@ class Testsuite(object):
         info.mtime = time.time()
         archive.addfile(tarinfo=info, fileobj=srcobj)
 
-    def __add_libs_to_archive(self, archive, subdir):
-        for libname, libpath in self.libs().items():
+    def __lib_entries(self, subdir):
+        arcnames = set()
+        for libname, libpath in sorted(self.libs().items()):
             if not os.path.exists(libpath):
                 msg = ("Adding lib '%s' / '%s' failed because path does " +
                        "not exist.") % (libname, libpath)
@@ -559,23 +1099,353 @@ class Testsuite(object):
                 continue
 
             arcname = os.path.join(subdir, libname)
-            if arcname in archive.getnames():
+            if arcname in arcnames:
                 logger.warning("Adding lib failed because arcname " +
                                "with name '%s' already exists" % libname)
                 continue
+            arcnames.add(arcname)
 
             logger.debug("Adding library '%s' from '%s'" % (libname, libpath))
-            archive.add(libpath, arcname=arcname, recursive=True)
+            for entry in self.__tree_entries(libpath, arcname):
+                yield entry
+
+    def manifest(self, subdir="testcases"):
+        """The members of the archive, with their type (file, dir or link),
+        mode, size and the hash of their contents.
+        A client can use it to just fetch the files it does not have yet.
+
+        >>> from igor.daemon.backends import files
+        >>> suite = files.Factory.testsuites_from_path("testcases/suites/")[
+        ...     "examplesuite"]
+        >>> manifest = suite.manifest()
+        >>> [e["name"] for e in manifest] == [e[0] for e in
+        ...                                   suite.archive_entries()]
+        True
+        >>> entry = manifest[0]
+        >>> entry["type"], entry["mode"], entry["size"] == len(
+        ...     suite.archive_member(entry["name"]))
+        ('file', '644', True)
+        >>> import hashlib
+        >>> hashlib.sha1(suite.archive_member(entry["name"])).hexdigest() \\
+        ...     == entry["sha1"]
+        True
+        >>> suite.archive_member("testcases/lib") is None
+        True
+        """
+        manifest = []
+        for arcname, filename, data in self.archive_entries(subdir):
+            entry = {"name": arcname, "type": "file", "mode": "644",
+                     "sha1": None, "size": None}
+            h = hashlib.sha1()
+            if filename is None:
+                data = data or ""
+                h.update(data)
+                entry["size"] = len(data)
+            else:
+                st = os.lstat(filename)
+                entry["mode"] = "%o" % (st.st_mode & 07777)
+                if os.path.islink(filename):
+                    entry["type"] = "link"
+                    target = os.readlink(filename)
+                    h.update(target)
+                    entry["size"] = len(target)
+                elif os.path.isdir(filename):
+                    entry["type"] = "dir"
+                    h = None
+                else:
+                    with open(filename, "rb") as f:
+                        for chunk in iter(lambda: f.read(1024 * 1024), ""):
+                            h.update(chunk)
+                    entry["size"] = st.st_size
+            if h is not None:
+                entry["sha1"] = h.hexdigest()
+            manifest.append(entry)
+        return manifest
+
+    def archive_member(self, name, subdir="testcases"):
+        """The contents of a file in the archive, None if there is no such
+        file
+        """
+        for arcname, filename, data in self.archive_entries(subdir):
+            if arcname != name:
+                continue
+            if filename is None:
+                return data or ""
+            if os.path.isfile(filename) and not os.path.islink(filename):
+                with open(filename, "rb") as f:
+                    return f.read()
+            return None
+        return None
+
+    def content_hash(self, subdir="testcases"):
+        """A hash of the archive contents: the names, modes and contents of
+        all members. It changes whenever the archive would change.
+
+        >>> from igor.daemon.backends import files
+        >>> suite = files.Factory.testsuites_from_path("testcases/suites/")[
+        ...     "examplesuite"]
+        >>> suite.content_hash() == suite.content_hash()
+        True
+        >>> suite.content_hash() == suite.shard(2)[0].content_hash()
+        False
+        """
+        h = hashlib.sha1()
+        for entry in self.manifest(subdir):
+            h.update("%(name)s\0%(type)s\0%(mode)s\0%(sha1)s\0" % entry)
+        return h.hexdigest()
 
     def validate(self):
         """Validate that all paths and check testcases can be gathered
         """
-        valid = True
+        return not self.check()
+
+    def check(self):
+        """The problems which would keep the archive from being created,
+        like missing or unreadable files. Nothing is compressed.
+
+        >>> from igor.daemon.backends import files
+        >>> suite = files.Factory.testsuites_from_path("testcases/suites/")[
+        ...     "examplesuite"]
+        >>> suite.check()
+        []
+        >>> broken = Testsuite("broken", [Testset("s", ["missing.sh"],
+        ...                                        {"l": "missing-lib"})])
+        >>> broken.testcases()[0].filename = "missing.sh"
+        >>> broken.check()
+        ['Not readable: missing.sh', "Lib 'l' does not exist: missing-lib"]
+        >>> broken.validate()
+        False
+        """
+        errors = []
+        for testcase in self.testcases():
+            if testcase.filename is None:
+                errors.append("Empty testcase: %s" % testcase.name)
+                continue
+            errors += self.__tree_errors(testcase.filename)
+            testcaseextradir = testcase.filename + ".d"
+            if os.path.exists(testcaseextradir):
+                errors += self.__tree_errors(testcaseextradir)
+        for libname, libpath in sorted(self.libs().items()):
+            if not os.path.exists(libpath):
+                errors.append("Lib '%s' does not exist: %s" %
+                              (libname, libpath))
+                continue
+            errors += self.__tree_errors(libpath)
+        return errors
+
+    def __tree_errors(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            if not os.access(path, os.R_OK | os.X_OK):
+                return ["Not readable: %s" % path]
+            errors = []
+            for name in sorted(os.listdir(path)):
+                errors += self.__tree_errors(os.path.join(path, name))
+            return errors
+        if not os.path.islink(path) and not os.access(path, os.R_OK):
+            return ["Not readable: %s" % path]
+        return []
+
+
+class TestsuiteValidator(object):
+    """Checks many testsuites concurrently, by a pool of threads.
+    The results are not cached: a check stats each file once, which is as
+    much as computing a key of the files would cost.
+
+    >>> from igor.daemon.backends import files
+    >>> suites = files.Factory.testsuites_from_path("testcases/suites/")
+    >>> validator = TestsuiteValidator(workers=2)
+    >>> results = validator.validate(suites)
+    >>> results["examplesuite"]
+    {'valid': True, 'errors': []}
+    >>> results == validator.validate(suites)
+    True
+    """
+
+    workers = 4
+
+    _pool = None
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._pool = multiprocessing.pool.ThreadPool(max(1, workers))
+
+    @staticmethod
+    def _check(testsuite):
         try:
-            self.get_archive()
+            errors = testsuite.check()
+        except Exception as e:
+            errors = ["Check failed: %s" % e]
+        return {"valid": not errors, "errors": list(errors)}
+
+    def validate(self, testsuites):
+        """A dict with the result of each testsuite of a dict of testsuites
+        """
+        names = sorted(testsuites)
+        results = self._pool.map(TestsuiteValidator._check,
+                                 [testsuites[n] for n in names])
+        return dict(zip(names, results))
+
+
+class ArchiveCache(object):
+    """Keeps the archives of testsuites on disk, named by their content hash.
+    Jobs running the same testsuite share the archive, until one of it's
+    files changes.
+    Archives handed out less than min_age seconds ago are not removed, so
+    they can still be opened by the caller.
+
+    >>> from igor.daemon.backends import files
+    >>> suite = files.Factory.testsuites_from_path("testcases/suites/")[
+    ...     "examplesuite"]
+    >>> cache = ArchiveCache(max_archives=2, min_age=0)
+    >>> fn = cache.archive_file(suite)
+    >>> fn == cache.archive_file(suite), (cache.misses, cache.hits)
+    (True, (1, 1))
+    >>> tarfile.open(fn).getnames() == [e[0] for e in suite.archive_entries()]
+    True
+    >>> cache.archive_file(suite, compression_format="gz").endswith(".tar.gz")
+    True
+    >>> for shard in suite.shard(3):
+    ...     _ = cache.archive_file(shard)
+    >>> len(os.listdir(cache.path))
+    2
+
+    >>> cache.min_age = 60
+    >>> fns = [cache.archive_file(shard) for shard in suite.shard(4)]
+    >>> all(os.path.exists(fn) for fn in fns)
+    True
+    >>> import shutil
+    >>> shutil.rmtree(cache.path)
+    """
+
+    path = None
+    max_archives = 100
+    min_age = 60
+    hits = 0
+    misses = 0
+
+    _lock = None
+    _building = None
+
+    def __init__(self, path=None, max_archives=100, min_age=60):
+        self.path = path or tempfile.mkdtemp(prefix="igord-archives-")
+        self.max_archives = max_archives
+        self.min_age = min_age
+        self._lock = threading.Lock()
+        self._building = {}
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def archive_file(self, testsuite, subdir="testcases",
+                     compression_format=compression.DEFAULT_FORMAT,
+                     level=None):
+        """The filename of the archive of a testsuite, it is created if
+        there is no archive with the same contents yet
+        """
+        key = testsuite.content_hash(subdir)
+        if level is not None:
+            key += "-%d" % level
+        filename = os.path.join(self.path, "%s.tar%s" %
+                                (key, compression.suffix(compression_format)))
+        with self._lock:
+            lock = self._building.setdefault(key, threading.Lock())
+        try:
+            with lock:
+                if os.path.exists(filename):
+                    os.utime(filename, None)
+                    with self._lock:
+                        self.hits += 1
+                    return filename
+                self.__create(testsuite, subdir, key, filename,
+                              compression_format, level)
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+        self._prune()
+        return filename
+
+    def __create(self, testsuite, subdir, key, filename, compression_format,
+                 level):
+        logger.debug("Creating archive %s for testsuite %s" %
+                     (key, testsuite.name))
+        fd, tmpname = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                testsuite.write_archive(f, subdir, compression_format, level)
+            os.rename(tmpname, filename)
         except:
-            valid = False
-        return valid
+            os.unlink(tmpname)
+            raise
+        with self._lock:
+            self.misses += 1
+
+    def _prune(self):
+        """Removes the least recently used archives
+        The mtime of an archive is the time it was last handed out.
+        """
+        archives = [os.path.join(self.path, fn)
+                    for fn in os.listdir(self.path)
+                    if not fn.endswith(".tmp")]
+        archives = sorted([(os.path.getmtime(fn), fn) for fn in archives],
+                          reverse=True)
+        handed_out_before = time.time() - self.min_age
+        for mtime, filename in archives[self.max_archives:]:
+            if mtime > handed_out_before:
+                continue
+            logger.debug("Removing archive %s" % filename)
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+
+# The archive cache used by the testsuites, set by the daemon
+archive_cache = None
+
+
+def _balanced_split(weights, n):
+    """Splits a list of weights into up to n consecutive parts, so that the
+    heaviest part is as light as possible. Returns the lengths of the parts.
+
+    >>> _balanced_split([1, 1, 1, 1], 2)
+    [2, 2]
+    >>> _balanced_split([4, 1, 1, 1, 1], 2)
+    [1, 4]
+    >>> _balanced_split([1, 2], 5)
+    [1, 1]
+    >>> _balanced_split([], 3)
+    []
+    """
+    n = min(n, len(weights))
+    if n <= 1:
+        return [len(weights)] if weights else []
+
+    prefix = [0]
+    for w in weights:
+        prefix.append(prefix[-1] + w)
+
+    # cost[i]: The heaviest part when splitting weights[:i] into k parts
+    cost = prefix[:]
+    cuts = []
+    for k in range(2, n + 1):
+        new_cost = [None] * len(prefix)
+        cut = [None] * len(prefix)
+        j = k - 1
+        for i in range(k, len(prefix)):
+            # The previous parts get heavier, the last one lighter with j,
+            # so the best j only moves forward with i
+            while j + 1 < i and max(cost[j + 1], prefix[i] - prefix[j + 1]) \
+                    <= max(cost[j], prefix[i] - prefix[j]):
+                j += 1
+            new_cost[i] = max(cost[j], prefix[i] - prefix[j])
+            cut[i] = j
+        cost = new_cost
+        cuts.append(cut)
+
+    bounds = [len(weights)]
+    for cut in reversed(cuts):
+        bounds.insert(0, cut[bounds[0]])
+    bounds.insert(0, 0)
+    return [b - a for a, b in zip(bounds, bounds[1:])]
 
 
 class Testset(object):
@@ -711,6 +1581,8 @@ class TestSession(UpdateableObject):
         logger.debug("Removing session '%s'" % self.cookie)
 
         self.remove_artifacts()
+        if not os.listdir(self.__artifacts_path()):
+            os.rmdir(self.__artifacts_path())
 
         remaining_files = os.listdir(self.dirname)
         if len(remaining_files) > 0:
@@ -775,19 +1647,23 @@ class TestSession(UpdateableObject):
                    for fn in fns]
         return fns
 
-    def get_artifacts_archive(self, selection=None):
-        """Return all artifacts as an .tar.bz2
+    def get_artifacts_archive(self, selection=None,
+                              compression_format=compression.DEFAULT_FORMAT,
+                              level=None):
+        """Return all artifacts as an .tar.bz2, or compressed differently
         """
         selection = selection or self.artifacts()
         container = io.BytesIO()
         logger.debug("Preparing artifacts archive for session %s" %
                      self.cookie)
-        with tarfile.open(fileobj=container, mode="w:bz2") as archive:
-            for artifact in selection:
-                if artifact not in self.artifacts():
-                    logger.debug("Artifact not here: %s" % artifact)
-                logger.debug("Adding artifact %s" % artifact)
-                archive.add(self.__artifacts_path(artifact), artifact)
+        with compression.CompressingWriter(container, compression_format,
+                                           level) as writer:
+            with tarfile.open(fileobj=writer, mode="w|") as archive:
+                for artifact in selection:
+                    if artifact not in self.artifacts():
+                        logger.debug("Artifact not here: %s" % artifact)
+                    logger.debug("Adding artifact %s" % artifact)
+                    archive.add(self.__artifacts_path(artifact), artifact)
         return container
 
     def __enter__(self):
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Rendering of responses as JSON, XML or YAML.
+
+Objects are turned into dicts by their __to_dict__ while the output is
+written, so the objects of a response are walked once.
+"""
+
+from igor import utils
+from lxml import etree
+import json
+import time
+import yaml
+
+
+FORMATS = {"json": "application/json",
+           "xml": "application/xml",
+           "yaml": "application/yaml"}
+
+XML_STYLESHEET = "<?xml-stylesheet type='text/xsl' href='/ui/index.xsl' ?>\n"
+
+_SCALARS = (basestring, int, long, float, bool, type(None))
+
+
+def plain(obj):
+    """The dict of an igor object, used for the values which can not be
+    written as they are
+    """
+    if hasattr(obj, "__to_dict__") and not isinstance(obj, type):
+        return obj.__to_dict__()
+    if isinstance(obj, utils.State):
+        return str(obj)
+    raise TypeError("%r is not serializable" % obj)
+
+
+def content_type(fmt):
+    return FORMATS[fmt]
+
+
+def render(obj, fmt="json", root_tag="result", compact=False):
+    """Renders obj in one of the FORMATS
+
+    >>> class Item(object):
+    ...     def __to_dict__(self):
+    ...         return {"name": u"it", "state": utils.State("running"),
+    ...                 "tags": ["a", "b"]}
+    >>> print render({"items": [Item()], "n": 1})
+    {
+      "items": [
+        {
+          "name": "it",
+          "state": "running",
+          "tags": [
+            "a",
+            "b"
+          ]
+        }
+      ],
+      "n": 1
+    }
+    >>> print render([Item()], compact=True)
+    [{"name":"it","state":"running","tags":["a","b"]}]
+    >>> print render({"items": [Item()], "n": 1}, "xml")
+    <?xml-stylesheet type='text/xsl' href='/ui/index.xsl' ?>
+    <result>
+      <items>
+        <name>it</name>
+        <state>running</state>
+        <tags>a</tags>
+        <tags>b</tags>
+      </items>
+      <n>1</n>
+    </result>
+    >>> print render({"items": [Item()], "n": 1}, "yaml")
+    items:
+    - name: it
+      state: running
+      tags:
+      - a
+      - b
+    n: 1
+    <BLANKLINE>
+    >>> import collections
+    >>> counts = collections.OrderedDict([("b", 2), ("a", 1)])
+    >>> print render({"counts": counts}, "xml", compact=True)
+    <?xml-stylesheet type='text/xsl' href='/ui/index.xsl' ?>
+    <result>
+      <counts>
+        <a>1</a>
+        <b>2</b>
+      </counts>
+    </result>
+    >>> print render(collections.defaultdict(int, a=1), "yaml")
+    a: 1
+    <BLANKLINE>
+    >>> render(None, "csv")
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Unknown format 'csv', expected one of: json, xml, yaml
+    """
+    if fmt == "json":
+        if compact:
+            return json.dumps(obj, default=plain, sort_keys=True,
+                              separators=(",", ":"))
+        return json.dumps(obj, default=plain, sort_keys=True, indent=2,
+                          separators=(",", ": "))
+    if fmt == "xml":
+        root = _xml_element(root_tag, obj)
+        return XML_STYLESHEET + etree.tostring(root, pretty_print=True).strip()
+    if fmt == "yaml":
+        # A list is written as a stream of documents
+        documents = obj if isinstance(obj, (list, tuple)) else [obj]
+        return yaml.dump_all(documents, Dumper=_YamlDumper)
+    raise RuntimeError("Unknown format '%s', expected one of: %s" %
+                       (fmt, ", ".join(sorted(FORMATS))))
+
+
+def _value(obj):
+    if isinstance(obj, _SCALARS + (dict, list, tuple)):
+        return obj
+    return plain(obj)
+
+
+def _xml_element(tag, obj):
+    """Like utils.obj2xml, lists in dicts are repeated elements
+    """
+    element = etree.Element(tag)
+    obj = _value(obj)
+    if isinstance(obj, (list, tuple)):
+        for v in obj:
+            element.append(_xml_element(tag, v))
+    elif isinstance(obj, dict):
+        for k in sorted(obj):
+            v = _value(obj[k])
+            if isinstance(v, (list, tuple)):
+                for item in v:
+                    element.append(_xml_element(str(k), item))
+            else:
+                element.append(_xml_element(str(k), v))
+    elif isinstance(obj, unicode):
+        element.text = obj
+    else:
+        element.text = unicode(str(obj), errors='ignore')
+    return element
+
+
+class _YamlDumper(getattr(yaml, "CSafeDumper", yaml.SafeDumper)):
+    def represent_data(self, data):
+        data = _value(data)
+        # The safe representers just know the exact builtin types
+        if isinstance(data, dict) and type(data) is not dict:
+            data = dict(data)
+        elif isinstance(data, list) and type(data) is not list:
+            data = list(data)
+        return super(_YamlDumper, self).represent_data(data)
+
+    def ignore_aliases(self, data):
+        return True
+
+
+def _legacy_render(obj, fmt, root_tag="result"):
+    """The former way: JSON, which is parsed again for the other formats
+    """
+    r = json.dumps(obj, default=plain, sort_keys=True, indent=2)
+    if fmt == "xml":
+        r = XML_STYLESHEET + utils.obj2xml(root_tag, json.loads(r),
+                                           as_string=True)
+    if fmt == "yaml":
+        r = yaml.dump_all(json.loads(r))
+    return r
+
+
+def benchmark(obj, number=10):
+    """Seconds to render obj number times, the former and the current way
+
+    >>> sorted(benchmark({"a": [1, 2]}, 1).keys())
+    ['json', 'json-compact', 'xml', 'yaml']
+    """
+    def timed(func):
+        begin = time.time()
+        for _ in range(number):
+            func()
+        return time.time() - begin
+
+    results = {}
+    for fmt in sorted(FORMATS):
+        results[fmt] = (timed(lambda: _legacy_render(obj, fmt)),
+                        timed(lambda: render(obj, fmt)))
+    results["json-compact"] = (results["json"][0],
+                               timed(lambda: render(obj, compact=True)))
+    return results
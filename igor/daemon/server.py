@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+The HTTP server of the daemon.
+
+The pooled server hands each connection to one of a bounded number of
+worker threads, so a slow request (an artifact upload, building an
+archive, ...) does not hold back the others. Connections are kept alive
+between requests if the response has a known length.
+Jobs live in the memory of the daemon, so the requests are served by
+threads of one process.
+"""
+
+from igor import log
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, \
+    ServerHandler
+import Queue
+import bottle
+import socket
+import threading
+
+
+logger = log.getLogger(__name__)
+
+
+class RequestBody(object):
+    """wsgi.input which does not read beyond the body of the request, so
+    the next request on the connection can be read afterwards
+    """
+
+    rfile = None
+    remaining = 0
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def __limit(self, size):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        return size
+
+    def read(self, size=-1):
+        size = self.__limit(size)
+        data = self.rfile.read(size) if size else ""
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        size = self.__limit(size)
+        data = self.rfile.readline(size) if size else ""
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def drain(self, max_size):
+        """Skip the unread body, returns False if it is too large (or the
+        client went away), the connection needs to be closed then
+        """
+        if self.remaining > max_size:
+            return False
+        while self.remaining:
+            if not self.read(64 * 1024):
+                return False
+        return True
+
+
+class KeepAliveServerHandler(ServerHandler):
+    """Answers with HTTP/1.1 and tells if the connection can be kept
+    """
+
+    http_version = "1.1"
+    keepalive = False
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        self.keepalive = "Content-Length" in self.headers or \
+            self.status[:3] in ["204", "304"] or \
+            self.environ["REQUEST_METHOD"] == "HEAD"
+        if not self.keepalive:
+            self.headers["Connection"] = "close"
+
+    def handle_error(self):
+        headers_sent = self.headers_sent
+        ServerHandler.handle_error(self)
+        if headers_sent:
+            # The response is incomplete
+            self.keepalive = False
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Serves requests of a connection until the client closes it or is
+    idle for keepalive_timeout seconds of the server
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Larger unread request bodies close the connection
+    max_drain = 64 * 1024
+
+    def setup(self):
+        WSGIRequestHandler.setup(self)
+        # The headers and the body of a response are written separately,
+        # a kept connection would wait for the delayed ACK of the client
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                   1)
+
+    def handle(self):
+        while self.read_request() and self.handle_request():
+            pass
+
+    def read_request(self):
+        self.connection.settimeout(self.server.keepalive_timeout)
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            return False
+        finally:
+            self.connection.settimeout(None)
+        if not self.raw_requestline:
+            return False
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return False
+        return self.parse_request()
+
+    def handle_request(self):
+        """Runs the app, returns True if the connection can be reused
+        """
+        environ = self.get_environ()
+        chunked = "chunked" in self.headers.get("Transfer-Encoding", "")
+        body = None
+        if not chunked:
+            body = RequestBody(self.rfile,
+                               int(self.headers.get("Content-Length") or 0))
+        if self.headers.get("Expect", "").lower() == "100-continue":
+            self.wfile.write("%s 100 Continue\r\n\r\n" %
+                             self.protocol_version)
+
+        handler = KeepAliveServerHandler(body or self.rfile, self.wfile,
+                                         self.get_stderr(), environ)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+        return handler.keepalive and not self.close_connection and \
+            body is not None and body.drain(self.max_drain)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.client_address[0], format % args))
+
+
+class PooledWSGIServer(WSGIServer):
+    """A WSGI server with a bounded pool of worker threads
+    Accepted connections wait in a queue of max_pending connections for a
+    worker, the server stops accepting new connections while it is full.
+
+    >>> import httplib, urllib2
+    >>> release = threading.Event()
+    >>> def app(environ, start_response):
+    ...     if environ["PATH_INFO"] == "/slow":
+    ...         release.wait(10)
+    ...     start_response("200 OK", [("Content-Type", "text/plain")])
+    ...     return ["ok"]
+    >>> httpd = make_server("127.0.0.1", 0, app, workers=2)
+    >>> thread = threading.Thread(target=httpd.serve_forever)
+    >>> thread.start()
+    >>> url = "http://127.0.0.1:%d" % httpd.server_port
+
+    A slow request does not delay the others:
+
+    >>> slow = threading.Thread(target=urllib2.urlopen, args=(url + "/slow",))
+    >>> slow.start()
+    >>> urllib2.urlopen(url + "/fast").read()
+    'ok'
+    >>> slow.is_alive()
+    True
+    >>> release.set()
+    >>> slow.join()
+
+    Requests share the connection, also if the body was not read:
+
+    >>> conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+    >>> conn.request("PUT", "/a", "x" * 1000)
+    >>> conn.getresponse().read()
+    'ok'
+    >>> sock = conn.sock
+    >>> conn.request("GET", "/b")
+    >>> conn.getresponse().read()
+    'ok'
+    >>> conn.sock is sock
+    True
+    >>> conn.close()
+
+    >>> httpd.shutdown()
+    >>> httpd.server_close()
+    >>> thread.join()
+    """
+
+    workers = 16
+    max_pending = 64
+    keepalive_timeout = 5
+
+    _pending = None
+    _threads = None
+
+    def __init__(self, server_address, handler_class, workers=16,
+                 max_pending=64, keepalive_timeout=5):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.keepalive_timeout = keepalive_timeout
+        self.request_queue_size = max_pending
+        self._pending = Queue.Queue(max_pending)
+        self._threads = []
+        WSGIServer.__init__(self, server_address, handler_class)
+        for n in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name="http-worker-%d" % n)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def process_request(self, request, client_address):
+        self._pending.put((request, client_address))
+
+    def _work(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        for _ in self._threads:
+            self._pending.put(None)
+        for thread in self._threads:
+            thread.join(1)
+
+
+def make_server(host, port, app, workers=16, max_pending=64,
+                keepalive_timeout=5):
+    server = PooledWSGIServer((host, port), KeepAliveRequestHandler,
+                              workers=workers, max_pending=max_pending,
+                              keepalive_timeout=keepalive_timeout)
+    server.set_app(app)
+    return server
+
+
+class PooledServer(bottle.ServerAdapter):
+    """bottle adapter for the pooled server
+    """
+
+    def run(self, app):
+        server = make_server(self.host, self.port, app, **self.options)
+        logger.info("Serving on %s:%s with %d workers" %
+                    (self.host, self.port, server.workers))
+        server.serve_forever()
+
+
+def upload_latency(size=256 * 1024 * 1024, duration=10, workers=16,
+                   chunk_size=256 * 1024):
+    """Uploads size bytes to a pooled server within duration seconds (like
+    an artifact upload of a slow client), meanwhile requests (like step
+    callbacks) are sent on another connection. Returns the number of these
+    requests and the highest latency of them, it should stay low for any
+    size.
+
+    With a single worker the requests wait for the upload:
+
+    >>> n, pooled = upload_latency(4 * 1024 * 1024, duration=1)
+    >>> n, single = upload_latency(4 * 1024 * 1024, duration=1, workers=1)
+    >>> pooled < single
+    True
+    """
+    import httplib
+    import time
+
+    received = []
+    uploading = threading.Event()
+
+    def app(environ, start_response):
+        if environ["REQUEST_METHOD"] == "PUT":
+            uploading.set()
+            body = environ["wsgi.input"]
+            for data in iter(lambda: body.read(64 * 1024), ""):
+                received.append(len(data))
+        start_response("200 OK", [("Content-Type", "text/plain"),
+                                  ("Content-Length", "2")])
+        return ["ok"]
+
+    httpd = make_server("127.0.0.1", 0, app, workers=workers)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+
+    def upload():
+        conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+        conn.putrequest("PUT", "/jobs/upload/artifact")
+        conn.putheader("Content-Length", str(size))
+        conn.endheaders()
+        chunk = "x" * chunk_size
+        pause = float(duration) * chunk_size / size
+        for offset in range(0, size, chunk_size):
+            conn.send(chunk[:size - offset])
+            time.sleep(pause)
+        conn.getresponse().read()
+        conn.close()
+
+    uploader = threading.Thread(target=upload)
+    uploader.start()
+    # Otherwise the requests could take the only worker from the upload
+    uploading.wait(10)
+    latencies = []
+    conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+    while uploader.is_alive():
+        begin = time.time()
+        conn.request("GET", "/jobs/step/skip")
+        conn.getresponse().read()
+        latencies.append(time.time() - begin)
+        time.sleep(0.01)
+    conn.close()
+    uploader.join()
+
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+    assert sum(received) == size
+    return len(latencies), max(latencies or [0])
+
+
+servers = {"pooled": PooledServer,
+           "wsgiref": bottle.WSGIRefServer}
+
+
+def max_held_requests(config, share=4):
+    """How many requests of one kind (event streams, long polls, ...) may
+    be held open, a share of the workers so that others are served, none
+    if the server does not serve requests in parallel
+
+    >>> max_held_requests(None), max_held_requests({"workers": 6})
+    (4, 1)
+    >>> max_held_requests({"type": "wsgiref"})
+    0
+    """
+    config = config or {}
+    if config.get("type", "pooled") != "pooled":
+        return 0
+    return config.get("workers", PooledWSGIServer.workers) // share
+
+
+def held_requests_limit(name, configured, config):
+    """configured, limited to max_held_requests
+    """
+    limit = max_held_requests(config)
+    if configured is None:
+        return limit
+    if configured > limit:
+        logger.warning("%s limited to %d (a quarter of the server workers)" %
+                       (name, limit))
+        return limit
+    return configured
+
+
+def run(app, config):
+    """Serves app as configured by daemon.server
+    """
+    config = dict(config or {})
+    servertype = config.pop("type", "pooled")
+    if servertype not in servers:
+        raise RuntimeError("Unknown server type '%s', expected one of: %s" %
+                           (servertype, ", ".join(servers)))
+    host = config.pop("host", "0.0.0.0")
+    port = config.pop("port", 8080)
+    if servertype != "pooled":
+        config = {}
+    bottle.run(app, server=servers[servertype](host=host, port=port,
+                                               **config),
+               reloader=False)
@@ -20,11 +20,15 @@
 
 from igor import log
 from lxml import etree
+import Queue
+import heapq
+import itertools
 import os
 import re
 import shlex
 import tempfile
 import threading
+import time
 import urllib
 import yaml
 
@@ -188,6 +192,32 @@ def synchronized(lock):
     return wrap
 
 
+def synchronized_method(lockname):
+    """Synchronization decorator for methods.
+    The lock is taken from the attribute lockname of the instance.
+
+    >>> class Counter(object):
+    ...     def __init__(self):
+    ...         self._lock = threading.Lock()
+    ...         self.n = 0
+    ...     @synchronized_method("_lock")
+    ...     def inc(self):
+    ...         self.n += 1
+    ...         return self._lock.locked()
+    >>> c = Counter()
+    >>> c.inc(), c.inc(), c.n
+    (True, True, 2)
+    """
+    def wrap(f):
+        def newFunction(self, *args, **kw):
+            with getattr(self, lockname):
+                return f(self, *args, **kw)
+        newFunction.__name__ = f.__name__
+        newFunction.__doc__ = f.__doc__
+        return newFunction
+    return wrap
+
+
 def xor(a, b):
     return bool(a) ^ bool(b)
 
@@ -202,12 +232,34 @@ def parse_bool(s):
 
 
 class PollingWorkerDaemon(threading.Thread):
+    """Calls work() every interval seconds, or earlier if woken up.
+
+    >>> class Worker(PollingWorkerDaemon):
+    ...     calls = 0
+    ...     def work(self):
+    ...         self.calls += 1
+    >>> w = Worker(interval=60)
+    >>> w.start()
+    >>> w.wakeup()
+    >>> import time
+    >>> for _ in range(100):
+    ...     if w.calls >= 2:
+    ...         break
+    ...     time.sleep(0.05)
+    >>> w.calls >= 2
+    True
+    >>> w.stop()
+    >>> w.join()
+    """
     interval = None
     _stop_event = None
+    _wakeup_condition = None
+    _has_pending_wakeup = False
 
     def __init__(self, interval=10):
         self.interval = interval
         self._stop_event = threading.Event()
+        self._wakeup_condition = threading.Condition()
         threading.Thread.__init__(self)
         self.daemon = True
 
@@ -218,16 +270,37 @@ class PollingWorkerDaemon(threading.Thread):
         self._debug("Starting")
         keep_running = True
         while keep_running:
-            self.work()
+            try:
+                self.work()
+            except Exception:
+                # The worker keeps running, work() is tried again
+                logger.exception("[%s] Work failed" % self)
             if self.is_stopped():
                 self._debug("Stopping")
                 keep_running = False
-            self._stop_event.wait(self.interval)
+            self._wait(self.interval)
         self._debug("Ending")
 
+    def _wait(self, timeout):
+        """Wait until the timeout passed or wakeup() was called
+        A wakeup which happened while work() was running is not lost.
+        """
+        with self._wakeup_condition:
+            if not self._has_pending_wakeup and not self.is_stopped():
+                self._wakeup_condition.wait(timeout)
+            self._has_pending_wakeup = False
+
+    def wakeup(self):
+        """Let the worker call work() as soon as possible
+        """
+        with self._wakeup_condition:
+            self._has_pending_wakeup = True
+            self._wakeup_condition.notify()
+
     def stop(self):
         self._debug("Requesting worker stop")
         self._stop_event.set()
+        self.wakeup()
 
     def is_stopped(self):
         return self._stop_event.is_set()
@@ -238,6 +311,170 @@ class PollingWorkerDaemon(threading.Thread):
         raise Exception("Not implemented")
 
 
+class WorkerPool(object):
+    """A fixed number of threads working on submitted tasks.
+    Exceptions raised by a task are logged and do not stop the worker.
+
+    >>> pool = WorkerPool(2)
+    >>> results = []
+    >>> pool.submit(results.append, 1)
+    >>> pool.submit(results.append, 2)
+    >>> pool.join()
+    >>> sorted(results)
+    [1, 2]
+    >>> pool.queued(), pool.in_flight()
+    (0, 0)
+    >>> pool.stop()
+    """
+    size = None
+    _tasks = None
+    _lock = None
+    _in_flight = 0
+    _workers = None
+
+    def __init__(self, size=4, name="WorkerPool"):
+        assert size > 0, "A pool needs at least one worker"
+        self.size = size
+        self._tasks = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        for n in range(size):
+            worker = threading.Thread(target=self._work,
+                                      name="%s-%d" % (name, n))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                self._tasks.task_done()
+                break
+            func, args, kwargs = task
+            with self._lock:
+                self._in_flight += 1
+            try:
+                func(*args, **kwargs)
+            except:
+                logger.exception("Task %s%s failed" % (func, args))
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                self._tasks.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to be run by the next free worker
+        """
+        self._tasks.put((func, args, kwargs))
+
+    def queued(self):
+        """Number of tasks waiting for a free worker
+        """
+        return self._tasks.qsize()
+
+    def in_flight(self):
+        """Number of tasks currently being worked on
+        """
+        return self._in_flight
+
+    def join(self):
+        """Block until all submitted tasks are done
+        """
+        self._tasks.join()
+
+    def stop(self):
+        """Let the workers end after the already submitted tasks
+        """
+        for worker in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+class DeadlineScheduler(threading.Thread):
+    """Calls callbacks at their deadline.
+    A single thread serves all deadlines, which are kept in a heap.
+
+    >>> scheduler = DeadlineScheduler()
+    >>> scheduler.start()
+    >>> fired = []
+    >>> now = time.time()
+    >>> _ = scheduler.schedule(now + 0.2, fired.append, "late")
+    >>> _ = scheduler.schedule(now + 0.1, fired.append, "early")
+    >>> handle = scheduler.schedule(now + 0.1, fired.append, "cancelled")
+    >>> scheduler.cancel(handle)
+    >>> time.sleep(0.5)
+    >>> fired
+    ['early', 'late']
+    >>> scheduler.stop()
+    >>> scheduler.join()
+    """
+    _heap = None
+    _condition = None
+    _counter = None
+    _is_stopped = False
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="DeadlineScheduler")
+        self.daemon = True
+        self._heap = []
+        self._condition = threading.Condition()
+        self._counter = itertools.count()
+
+    def schedule(self, deadline, callback, *args):
+        """Call callback(*args) once the time deadline has been reached
+
+        Returns:
+            A handle which can be used to cancel the call
+        """
+        handle = [deadline, next(self._counter), callback, args, True]
+        with self._condition:
+            heapq.heappush(self._heap, handle)
+            self._condition.notify()
+        return handle
+
+    def cancel(self, handle):
+        """Cancel a scheduled call, cancelling twice is fine
+        """
+        if handle is not None:
+            with self._condition:
+                handle[-1] = False
+
+    def run(self):
+        while True:
+            with self._condition:
+                handle = self.__next_due()
+            if handle is None:
+                break
+            deadline, _, callback, args, _ = handle
+            try:
+                callback(*args)
+            except:
+                logger.exception("Deadline callback %s failed" % callback)
+
+    def __next_due(self):
+        """Wait for the next active deadline, None if stopped
+        """
+        while not self._is_stopped:
+            while self._heap and not self._heap[0][-1]:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                self._condition.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                self._condition.wait(delay)
+                continue
+            return heapq.heappop(self._heap)
+        return None
+
+    def stop(self):
+        with self._condition:
+            self._is_stopped = True
+            self._condition.notify()
+
+
 class State(object):
     name = None
     map = None
@@ -31,7 +31,7 @@ setup(
     data_files=[('lib/systemd/system',  ['data/igord.service',
                                          'slave/igor-slave.service']),
                 ('/etc/igord',          ['data/igord.cfg.example']),
-                ('/etc/igord/hook.d',   ['data/redis-event-publisher-hook']),
+                ('/etc/igord/hook.d',   []),
                 ('bin',                 ['slave/igor-slave']),
                 ('/var/run/igord',      []),
                 ('lib/igord/testcases', []),], # FIXME testcases are missing